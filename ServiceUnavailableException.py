@@ -0,0 +1,7 @@
+
+class ServiceUnavailableException(Exception):
+    """ For when a resource is saturated and the request should be retried later """
+
+    def __init__(self, message, retry_after=1):
+        super().__init__(message)
+        self.retry_after = retry_after
@@ -0,0 +1,6 @@
+class TooManyRequestsException(Exception):
+    """ For when a client exceeded its rate limit and should retry after retry_after seconds """
+
+    def __init__(self, message, retry_after=1):
+        super().__init__(message)
+        self.retry_after = retry_after
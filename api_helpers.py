@@ -0,0 +1,130 @@
+import os
+import json
+import hashlib
+import datetime
+
+import db
+import cache
+from InvalidInputException import InvalidInputException
+
+# Request handling shared by the sync (app.py) and async (async_app.py) entry points
+
+# Per-user task summaries, stored with the task_version they were computed at and only served while the user
+# is still at that version. Writes also drop them, but as they do so before committing a concurrent read could
+# cache the old counts again. The TTL bounds how long the time dependent counts (overdue, due this week) may
+# lag, TASK_SUMMARY_CACHE_TTL=0 disables the cache
+TASK_SUMMARY_CACHE_TTL = int(os.environ.get("TASK_SUMMARY_CACHE_TTL", 30))
+summary_cache = cache.create_cache("task_summary", int(os.environ.get("TASK_SUMMARY_CACHE_SIZE", 10000)), TASK_SUMMARY_CACHE_TTL)
+
+def invalidate_task_summary(user_id):
+    summary_cache.delete(user_id)
+
+db.task_changed_hooks.append(invalidate_task_summary)
+db.user_deleted_hooks.append(invalidate_task_summary)
+
+def get_task_summary(user_id, connection):
+    if TASK_SUMMARY_CACHE_TTL <= 0: return db.get_task_summary_by_user_id(user_id, connection)
+
+    # Stored as JSON so the shared (Redis) backend can hold it too. The version is read on the same connection
+    # as the counts, so a cached entry never claims a newer version than its counts
+    task_version = db.get_task_version(user_id, connection)
+    summary = get_cached_task_summary(user_id, task_version)
+    if summary is not None: return summary
+
+    summary = db.get_task_summary_by_user_id(user_id, connection)
+    set_cached_task_summary(user_id, task_version, summary)
+    return summary
+
+def get_cached_task_summary(user_id, task_version):
+    cached = summary_cache.get(user_id)
+    if cached is None: return None
+    cached = json.loads(cached)
+    return cached["summary"] if cached["task_version"] == task_version else None
+
+def set_cached_task_summary(user_id, task_version, summary):
+    summary_cache.set(user_id, json.dumps({"task_version": task_version, "summary": summary}))
+
+def parse_task_filters(args):
+    # Raises ValueError for malformed values
+    filters = {"sort": args.get("sort", "id")}
+    if "completed" in args:
+        completed = args["completed"].lower()
+        if completed not in ("true", "false"): raise ValueError("completed")
+        filters["completed"] = completed == "true"
+    if "include_archived" in args:
+        include_archived = args["include_archived"].lower()
+        if include_archived not in ("true", "false"): raise ValueError("include_archived")
+        filters["include_archived"] = include_archived == "true"
+    if "due_before" in args:
+        filters["due_before"] = datetime.datetime.fromisoformat(args["due_before"])
+    if "due_after" in args:
+        filters["due_after"] = datetime.datetime.fromisoformat(args["due_after"])
+    if "fields" in args:
+        filters["fields"] = [field.strip() for field in args["fields"].split(",") if field.strip() != ""]
+        if len(filters["fields"]) == 0: raise ValueError("fields")
+    return filters
+
+def task_list_etag(user_id, task_version, query_string):
+    # The listing only changes when the user's task_version does, the query string selects the view of it
+    digest = hashlib.sha1(f"{user_id}:{task_version}:{query_string}".encode()).hexdigest()[:20]
+    return f"{task_version}-{digest}"
+
+def read_batch(body, key):
+    if not isinstance(body, dict) or not isinstance(body.get(key), list): return None
+    return body[key]
+
+def validate_batch(items, validate):
+    # Per-item results, None for items that passed validation
+    results, valid_indexes = [None] * len(items), []
+    for index, item in enumerate(items):
+        try:
+            validate(item)
+            valid_indexes.append(index)
+        except InvalidInputException as e:
+            results[index] = {"status": 400, "error": str(e)}
+    return results, valid_indexes
+
+def insert_task_batch_results(task_list, user_id, connection):
+    results, valid_indexes = validate_batch(task_list, lambda task: db.validate_batch_task(task, require_title=True))
+    new_task_ids = db.insert_task_batch([task_list[index] for index in valid_indexes], user_id, connection)
+    for index, task_id in zip(valid_indexes, new_task_ids):
+        results[index] = {"status": 201, "id": task_id}
+
+    return results
+
+def update_task_batch_results(task_list, user_id, connection):
+    seen_task_ids = set()
+    def validate(task):
+        db.validate_batch_task(task, require_title=False)
+        if "id" not in task.keys() or not isinstance(task["id"], int) or isinstance(task["id"], bool): raise InvalidInputException("Missing or Invalid task_id: Must be int")
+        if task["id"] in seen_task_ids: raise InvalidInputException("Invalid task_id: Duplicate task_id in batch")
+        seen_task_ids.add(task["id"])
+
+    results, valid_indexes = validate_batch(task_list, validate)
+    updated_task_ids = db.update_task_batch([task_list[index] for index in valid_indexes], user_id, connection)
+    for index in valid_indexes:
+        task_id = task_list[index]["id"]
+        if task_id in updated_task_ids:
+            results[index] = {"status": 200, "id": task_id}
+        else:
+            results[index] = {"status": 404, "id": task_id, "error": "Invalid task_id: task_id not found"}
+
+    return results
+
+def delete_task_batch_results(task_id_list, user_id, connection):
+    seen_task_ids = set()
+    def validate(task_id):
+        if not isinstance(task_id, int) or isinstance(task_id, bool): raise InvalidInputException("Invalid task_id: Must be int")
+        if task_id in seen_task_ids: raise InvalidInputException("Invalid task_id: Duplicate task_id in batch")
+        seen_task_ids.add(task_id)
+
+    results, valid_indexes = validate_batch(task_id_list, validate)
+    deleted_task_ids = db.delete_task_batch([task_id_list[index] for index in valid_indexes], user_id, connection)
+    for index in valid_indexes:
+        task_id = task_id_list[index]
+        if task_id in deleted_task_ids:
+            results[index] = {"status": 200, "id": task_id}
+        else:
+            results[index] = {"status": 404, "id": task_id, "error": "Invalid task_id: task_id not found"}
+
+    return results
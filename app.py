@@ -1,4 +1,4 @@
-from flask import Flask, Response, request, redirect, url_for, make_response, jsonify, render_template
+from flask import Flask, Response, request, redirect, url_for, make_response, jsonify, render_template, g
 from flask_cors import CORS
 from dotenv import load_dotenv
 import datetime
@@ -8,7 +8,18 @@ import auth
 from flask_swagger_ui import get_swaggerui_blueprint
 
 import db
+import metrics
+import profiling
+import api_helpers
+import json_encoding
+import events
+import ratelimit
+import compression
+import replicas
+import shards
 from InvalidInputException import InvalidInputException
+from ServiceUnavailableException import ServiceUnavailableException
+from TooManyRequestsException import TooManyRequestsException
 
 #if not load_dotenv(".env"):
 #    print("ERROR LOADING ENVIRONMENT!")
@@ -23,25 +34,124 @@ db_config = {
     "password" : os.environ.get("POSTGRES_PASSWORD"),
     "dbname" : os.environ.get("POSTGRES_DB"),
 }
+db_pool_config = {
+    "pool_size" : int(os.environ.get("POSTGRES_POOL_SIZE", 5)),
+    "max_overflow" : int(os.environ.get("POSTGRES_POOL_MAX_OVERFLOW", 10)),
+    "pool_timeout" : int(os.environ.get("POSTGRES_POOL_TIMEOUT", 30)),
+    "pool_recycle" : int(os.environ.get("POSTGRES_POOL_RECYCLE", 1800)),
+    "pool_pre_ping" : os.environ.get("POSTGRES_POOL_PRE_PING", "true").lower() == "true",
+}
 
-app = Flask(__name__)
+TASK_PAGE_MAX_LIMIT = int(os.environ.get("TASK_PAGE_MAX_LIMIT", 1000))
+TASK_STREAM_BATCH_SIZE = int(os.environ.get("TASK_STREAM_BATCH_SIZE", 1000))
+TASK_BATCH_MAX_SIZE = int(os.environ.get("TASK_BATCH_MAX_SIZE", 1000))
+TASK_SEARCH_DEFAULT_LIMIT = int(os.environ.get("TASK_SEARCH_DEFAULT_LIMIT", 50))
 
-db_engine, db_connection = db.create_db_connection(db_config["host"], db_config["port"], db_config["username"], db_config["password"], db_config["dbname"])
+app = Flask(__name__)
+app.json = json_encoding.FastJSONProvider(app)
+# First, so its after_request runs last and the profile covers commits and compression
+profiling.instrument_flask(app)
+metrics.instrument_flask(app)
+compression.instrument_flask(app)
+
+db_engine = db.create_db_engine(db_config["host"], db_config["port"], db_config["username"], db_config["password"], db_config["dbname"], **db_pool_config)
+metrics.instrument_engine(db_engine)
+profiling.instrument_engine(db_engine)
+replica_router = replicas.create_replica_router(db_engine, db_config["username"], db_config["password"], db_config["dbname"], **db_pool_config)
+for replica_engine in replica_router.replicas:
+    metrics.instrument_engine(replica_engine)
+    profiling.instrument_engine(replica_engine)
+shard_map = shards.create_shard_map(db_engine, db_config["username"], db_config["password"], db_config["dbname"], **db_pool_config)
+for shard_engine in shard_map.engines[1:]:
+    metrics.instrument_engine(shard_engine)
+    profiling.instrument_engine(shard_engine)
 app.config["DB"] = {
     "engine": db_engine,
-    "connection": db_connection
+    "replicas": replica_router,
+    "shards": shard_map,
 }
+app.config["TASK_EVENTS"] = events.create_task_event_hub(**db_config)
+
+def single_threaded_worker():
+    # gunicorn's sync worker has a single thread, a request holding it long blocks every other one and gets the
+    # worker killed by the timeout
+    return request.environ.get("SERVER_SOFTWARE", "").startswith("gunicorn") and not request.environ.get("wsgi.multithread")
+
+def get_user_shard():
+    # Shard of the authenticated user, shard 0 (which holds the directory) before authentication
+    user_id = g.get("user_id")
+    if user_id is None: return 0
+    shard = app.config["DB"]["shards"].cached_shard(user_id)
+    return shard if shard is not None else app.config["DB"]["shards"].shard_of(user_id, get_db_connection(0))
+
+def get_db_connection(shard=None):
+    # Lazily check out one pooled connection per request and shard (default the user's), released in teardown
+    if shard is None: shard = get_user_shard()
+    connections = g.setdefault("db_connections", {})
+    if shard not in connections:
+        connections[shard] = app.config["DB"]["shards"].engines[shard].connect()
+    return connections[shard]
+
+def get_read_connection():
+    # Connection for reads only: a replica when configured, the primary for users pinned by a recent write.
+    # Replicas (POSTGRES_REPLICAS) only serve users on shard 0
+    if "db_read_connection" not in g:
+        shard = get_user_shard()
+        index = app.config["DB"]["replicas"].read_replica(g.get("user_id")) if shard == 0 else None
+        g.db_read_connection = get_db_connection(shard) if index is None else app.config["DB"]["replicas"].replicas[index].connect()
+    return g.db_read_connection
+
+def read_engine(user_id):
+    shard = app.config["DB"]["shards"].shard_of(user_id)
+    return app.config["DB"]["replicas"].read_engine(user_id) if shard == 0 else app.config["DB"]["shards"].engines[shard]
+
+@app.after_request
+def commit_db_connection(response):
+    connections = g.get("db_connections", {})
+    # Shard 0 last, a new user's directory entry is only committed once the user exists on its shard
+    for shard in sorted(connections, reverse=True):
+        connection = connections[shard]
+        if response.status_code < 400:
+            connection.commit()
+            # Later reads of the writing user wait for the replicas to catch up
+            if shard == 0 and request.method != "GET": app.config["DB"]["replicas"].record_write(g.get("user_id"), connection)
+        else:
+            connection.rollback()
+    return response
+
+@app.errorhandler(ServiceUnavailableException)
+def service_unavailable(e):
+    response = make_response(str(e), 503)
+    response.headers["Retry-After"] = str(e.retry_after)
+    return response
+
+@app.errorhandler(TooManyRequestsException)
+def too_many_requests(e):
+    response = make_response(str(e), 429)
+    response.headers["Retry-After"] = str(e.retry_after)
+    return response
+
+@app.teardown_appcontext
+def close_db_connection(exception):
+    connections = g.pop("db_connections", {})
+    read_connection = g.pop("db_read_connection", None)
+    if read_connection is not None and read_connection not in connections.values():
+        read_connection.close()
+    for connection in connections.values():
+        # close() rolls back anything left uncommitted (e.g. on unhandled exceptions)
+        connection.close()
 
 
 CORS(app)
 app.secret_key = os.environ.get("FLASK_SECRET")
-db.jwt_secret_key = app.secret_key
+auth.jwt_secret_key = app.secret_key
 
 ##################################################
 SWAGGER_URL = '/docs'
 swagger_config = '/swagger.json' 
 
 @app.route("/swagger.json", methods=["GET"])
+@ratelimit.limit_by_client("client")
 def swagger():
     response = make_response(render_template("swagger.json", **{"HOST": HOST, "PORT": PORT}), 200)
     response.headers["Content-Type"] = "application/json"
@@ -59,7 +169,38 @@ app.register_blueprint(swaggerui_blueprint, url_prefix=SWAGGER_URL)
 
 ##################################################
 
+@app.route("/health", methods=["GET"])
+def health():
+    return make_response({"status": "ok", "db_pool": db.get_pool_status(app.config["DB"]["engine"]), "user_cache": auth.user_cache.stats(), "rate_limiter": ratelimit.rate_limiter.stats(), "replicas": app.config["DB"]["replicas"].stats(), "shards": app.config["DB"]["shards"].stats(), "task_events": app.config["TASK_EVENTS"].stats()}, 200)
+
+@app.route("/metrics", methods=["GET"])
+def metrics_endpoint():
+    body, content_type = metrics.render()
+    return Response(body, 200, content_type=content_type)
+
+@app.route("/admin/profile", methods=["POST"])
+@ratelimit.limit_by_client("client")
+def profile_worker():
+    if not profiling.admin_authorized(request.headers.get("X-Admin-Token")):
+        return make_response("Not Found", 404)
+    # The profile would only show this worker's background threads
+    if single_threaded_worker():
+        return make_response("Not Implemented: Profiling needs a threaded worker (see gunicorn.conf.py)", 501)
+    try:
+        seconds = float(request.args.get("seconds", min(10, profiling.PROFILING_MAX_SECONDS)))
+        interval = float(request.args.get("interval", 0.005))
+    except ValueError:
+        return make_response("Bad request: seconds and interval must be numbers", 400)
+    if not 0 < seconds <= profiling.PROFILING_MAX_SECONDS or not 0 < interval <= seconds:
+        return make_response(f"Bad request: seconds must be between 0 and {profiling.PROFILING_MAX_SECONDS}, interval between 0 and seconds", 400)
+
+    # Streamed, the sampling runs on a background thread while this one waits for the result
+    return Response(profiling.start_profile(seconds, interval), 200, mimetype="text/plain")
+
+##################################################
+
 @app.route("/register", methods=["POST"])
+@ratelimit.limit_by_client("auth")
 def register():
     if ("username" not in request.json or "password" not in request.json):
         return make_response("Bad request", 400)
@@ -67,13 +208,26 @@ def register():
 
     try:
         hashed_password = auth.hash_password(plaintext_password).decode()
-        db.insert_user(username,hashed_password, app.config["DB"]["connection"])
+        shard = app.config["DB"]["shards"].place(username)
+        g.user_id = db.insert_user(username,hashed_password, get_db_connection(shard))
+        db.insert_user_directory_entry(g.user_id, username, shard, get_db_connection(0))
     except InvalidInputException as e:
         return make_response(str(e), 404)
 
     return make_response({"username": username, "password": plaintext_password}, 201)
 
+def find_user(username):
+    # (user, shard), the directory names the shard when there are several
+    shard_map = app.config["DB"]["shards"]
+    if not shard_map.sharded: return db.get_user_by_username(username, get_db_connection(0)), 0
+
+    entry = db.get_user_directory_entry(username, get_db_connection(0))
+    if entry is None: return None, 0
+    shard_map.remember(entry["user_id"], entry["shard"])
+    return db.get_user_by_username(username, get_db_connection(entry["shard"])), entry["shard"]
+
 @app.route("/login", methods=["POST"])
+@ratelimit.limit_by_client("auth")
 def login(): 
     if ("username" not in request.json or "password" not in request.json):
         return make_response("Bad request", 400)
@@ -81,7 +235,7 @@ def login():
     username, plaintext_password = str(request.json.get("username")), str(request.json.get("password"))
 
     try:
-        user = db.get_user_by_username(username, app.config["DB"]["connection"])
+        user, shard = find_user(username)
     except InvalidInputException as e:
         return make_response(str(e), 404)
 
@@ -100,6 +254,13 @@ def login():
 
     if (not user_found or not user_password_verified):
         return make_response("Unauthorized", 401) 
+
+    # Transparently upgrade hashes created with a different bcrypt cost, best effort only
+    if auth.password_needs_rehash(hashed_password):
+        try:
+            db.update_user_password_hash(user["id"], auth.hash_password(plaintext_password).decode(), get_db_connection(shard))
+        except ServiceUnavailableException:
+            pass
     
     token = auth.gen_jwt(user)
 
@@ -107,20 +268,117 @@ def login():
 
 ##################################################
 
+def stream_task_list(engine, user_id, cursor, ndjson, filters):
+    # Uses its own connection as the response body is produced after the request handler returns. engine is
+    # the one the ETag's task_version was read from, another replica could lag behind it
+    with engine.connect() as connection:
+        first = True
+        if not ndjson: yield b"["
+        for batch in db.iter_task_list_by_user_id(user_id, connection, cursor, TASK_STREAM_BATCH_SIZE, **filters):
+            if ndjson:
+                yield b"\n".join(map(json_encoding.dumps_bytes, batch)) + b"\n"
+            else:
+                # Encoding the batch as one array and stripping its brackets keeps the loop in C
+                yield (b"" if first else b",") + json_encoding.dumps_bytes(batch)[1:-1]
+            first = False
+        if not ndjson: yield b"]"
+
 @app.route("/tasks", methods=["GET"])
-@auth.JWT_required(app.config["DB"]["connection"])
+@auth.JWT_required(get_read_connection)
 def get_tasks(user_id):
+    cursor = request.args.get("cursor")
+    limit = request.args.get("limit")
+    output_format = request.args.get("format", "json")
+    stream = request.args.get("stream", "false").lower() == "true"
+
+    if limit is not None and (not limit.isdigit() or int(limit) < 1):
+        return make_response("Bad request", 400)
+    if output_format not in ("json", "ndjson"):
+        return make_response("Bad request", 400)
+    try:
+        filters = api_helpers.parse_task_filters(request.args)
+    except ValueError:
+        return make_response("Bad request", 400)
 
     try:
-        task_list = db.get_task_list_by_user_id(user_id, app.config["DB"]["connection"])
+        # Validate cursor and filters up front, streamed bodies can no longer change the status code
+        db.task_list_query(user_id, cursor, **filters)
+
+        # Unchanged listings are answered from the user's task_version alone, without reading Task
+        etag = api_helpers.task_list_etag(user_id, db.get_task_version(user_id, get_read_connection()), request.query_string.decode())
+        if request.if_none_match.contains_weak(etag):
+            response = make_response("", 304)
+            response.set_etag(etag, weak=True)
+            return response
+
+        if stream or output_format == "ndjson":
+            mimetype = "application/x-ndjson" if output_format == "ndjson" else "application/json"
+            response = Response(stream_task_list(get_read_connection().engine, user_id, cursor, output_format == "ndjson", filters), 200, mimetype=mimetype)
+        elif limit is None:
+            task_list = db.get_task_list_by_user_id(user_id, get_read_connection(), cursor=cursor, **filters)
+            response = make_response(jsonify(task_list), 200)
+        else:
+            task_list, next_cursor = db.get_task_page_by_user_id(user_id, get_read_connection(), min(int(limit), TASK_PAGE_MAX_LIMIT), cursor, **filters)
+            response = make_response(jsonify(task_list), 200)
+            if next_cursor is not None:
+                response.headers["X-Next-Cursor"] = next_cursor
     except InvalidInputException as e:
         return make_response(str(e), 404)
 
-    return make_response(jsonify(task_list), 200)
-    return make_response(jsonify(TASKS), 200)
+    response.set_etag(etag, weak=True)
+    return response
+
+@app.route("/tasks/stream", methods=["GET"])
+@auth.JWT_required(get_read_connection)
+def stream_task_events(user_id):
+    # Every open stream holds a worker thread here, many idle subscribers are better served by async_app.py
+    if single_threaded_worker():
+        return make_response("Not Implemented: Event streams need a threaded worker (see gunicorn.conf.py) or async_app.py", 501)
+    hub = app.config["TASK_EVENTS"]
+    last_version = events.parse_event_id(request.headers.get("Last-Event-ID"))
+    subscription = hub.subscribe(user_id)
+    try:
+        # Read after subscribing, so every later change is either replayed or delivered live
+        replay = hub.replay(user_id, last_version, db.get_task_version(user_id, get_db_connection())) if last_version is not None else []
+    except Exception:
+        hub.unsubscribe(subscription)
+        raise
+
+    event_stream = events.EventStream(subscription, replay, last_version)
+    return Response(events.stream(hub, subscription, event_stream), 200, mimetype="text/event-stream", headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+@app.route("/tasks/summary", methods=["GET"])
+@auth.JWT_required(get_read_connection)
+def get_task_summary(user_id):
+    try:
+        summary = api_helpers.get_task_summary(user_id, get_read_connection())
+    except InvalidInputException as e:
+        return make_response(str(e), 404)
+
+    return make_response(summary, 200)
+
+@app.route("/tasks/search", methods=["GET"])
+@auth.JWT_required(get_read_connection)
+def search_tasks(user_id):
+    text = request.args.get("q")
+    limit = request.args.get("limit", str(TASK_SEARCH_DEFAULT_LIMIT))
+    mode = request.args.get("mode", "websearch")
+
+    if text is None or not limit.isdigit() or int(limit) < 1:
+        return make_response("Bad request", 400)
+
+    try:
+        task_list, next_cursor = db.search_tasks_by_user_id(user_id, text, get_read_connection(), min(int(limit), TASK_PAGE_MAX_LIMIT), request.args.get("cursor"), mode)
+    except InvalidInputException as e:
+        return make_response(str(e), 404)
+
+    response = make_response(jsonify(task_list), 200)
+    if next_cursor is not None:
+        response.headers["X-Next-Cursor"] = next_cursor
+    return response
 
 @app.route("/tasks", methods=["POST"])
-@auth.JWT_required(app.config["DB"]["connection"])
+@auth.JWT_required(get_read_connection)
 def add_task(user_id):
     if ("title" not in request.json):
         return make_response("Bad request", 400)
@@ -129,7 +387,7 @@ def add_task(user_id):
     task["user_id"] = user_id
 
     try:
-        db.insert_task(task, app.config["DB"]["connection"])
+        db.insert_task(task, get_db_connection())
     except InvalidInputException as e:
         return make_response(str(e), 404)
 
@@ -137,23 +395,23 @@ def add_task(user_id):
     return make_response(task, 200)
 
 @app.route("/tasks/<int:task_id>", methods=["PUT"])
-@auth.JWT_required(app.config["DB"]["connection"])
+@auth.JWT_required(get_read_connection)
 def update_task_by_id(task_id, user_id):
     task = request.json
     task["id"] = task_id
 
     try:
-        db.update_task(task, user_id, app.config["DB"]["connection"])
+        db.update_task(task, user_id, get_db_connection())
     except InvalidInputException as e:
         return make_response(str(e), 404)
 
     return make_response("Success", 200)
 
 @app.route("/tasks/<int:task_id>", methods=["DELETE"])
-@auth.JWT_required(app.config["DB"]["connection"])
+@auth.JWT_required(get_read_connection)
 def delete_task_by_id(task_id, user_id):
     try:
-        db.delete_task_by_id(task_id, user_id, app.config["DB"]["connection"])
+        db.delete_task_by_id(task_id, user_id, get_db_connection())
     except InvalidInputException as e:
         return make_response(str(e), 404)
 
@@ -161,6 +419,84 @@ def delete_task_by_id(task_id, user_id):
 
 ##################################################
 
+@app.route("/tasks/batch", methods=["POST"])
+@auth.JWT_required(get_read_connection)
+def add_task_batch(user_id):
+    task_list = api_helpers.read_batch(request.get_json(silent=True), "tasks")
+    if task_list is None:
+        return make_response("Bad request", 400)
+    if len(task_list) > TASK_BATCH_MAX_SIZE:
+        return make_response(f"Batch too large: At most {TASK_BATCH_MAX_SIZE} items", 413)
+
+    return make_response(jsonify(api_helpers.insert_task_batch_results(task_list, user_id, get_db_connection())), 200)
+
+@app.route("/tasks/batch", methods=["PATCH"])
+@auth.JWT_required(get_read_connection)
+def update_task_batch(user_id):
+    task_list = api_helpers.read_batch(request.get_json(silent=True), "tasks")
+    if task_list is None:
+        return make_response("Bad request", 400)
+    if len(task_list) > TASK_BATCH_MAX_SIZE:
+        return make_response(f"Batch too large: At most {TASK_BATCH_MAX_SIZE} items", 413)
+
+    return make_response(jsonify(api_helpers.update_task_batch_results(task_list, user_id, get_db_connection())), 200)
+
+@app.route("/tasks/batch", methods=["DELETE"])
+@auth.JWT_required(get_read_connection)
+def delete_task_batch(user_id):
+    task_id_list = api_helpers.read_batch(request.get_json(silent=True), "ids")
+    if task_id_list is None:
+        return make_response("Bad request", 400)
+    if len(task_id_list) > TASK_BATCH_MAX_SIZE:
+        return make_response(f"Batch too large: At most {TASK_BATCH_MAX_SIZE} items", 413)
+
+    return make_response(jsonify(api_helpers.delete_task_batch_results(task_id_list, user_id, get_db_connection())), 200)
+
+##################################################
+
+def stream_task_export(user_id, output_format, filters):
+    # Uses its own connection as the response body is produced after the request handler returns
+    with read_engine(user_id).connect() as connection:
+        yield from db.export_tasks(user_id, connection, output_format, **filters)
+
+@app.route("/tasks/export", methods=["GET"])
+@auth.JWT_required(get_read_connection)
+def export_tasks(user_id):
+    output_format = request.args.get("format", "ndjson")
+    if output_format not in db.TASK_TRANSFER_FORMATS:
+        return make_response("Bad request", 400)
+    try:
+        filters = api_helpers.parse_task_filters(request.args)
+    except ValueError:
+        return make_response("Bad request", 400)
+
+    try:
+        # Validate filters up front, streamed bodies can no longer change the status code
+        db.task_export_query(user_id, output_format, **filters)
+    except InvalidInputException as e:
+        return make_response(str(e), 404)
+
+    return Response(stream_task_export(user_id, output_format, filters), 200, mimetype=db.TASK_TRANSFER_MEDIA_TYPES[output_format],
+                    headers={"Content-Disposition": f'attachment; filename="tasks.{output_format}"'})
+
+@app.route("/tasks/import", methods=["POST"])
+@auth.JWT_required(get_read_connection)
+def import_tasks(user_id):
+    input_format = request.args.get("format", "ndjson")
+    if input_format not in db.TASK_TRANSFER_FORMATS:
+        return make_response("Bad request", 400)
+
+    try:
+        # The body is read in chunks as COPY consumes it, never held in memory as a whole
+        chunks = iter(lambda: request.stream.read(db.TASK_TRANSFER_CHUNK_SIZE), b"")
+        imported = db.import_tasks(user_id, chunks, get_db_connection(), input_format)
+    except InvalidInputException as e:
+        return make_response(str(e), 404)
+
+    return make_response({"imported": imported}, 200)
+
+##################################################
+
 if __name__ == "__main__":
     # Propagate exceptions for easier debugging
     app.config["PROPAGATE_EXCEPTIONS"] = True
@@ -0,0 +1,82 @@
+import os
+import sys
+import time
+import argparse
+import threading
+import datetime
+
+import sqlalchemy as sa
+from dotenv import load_dotenv
+
+import db
+import shards
+
+# Background archival of completed tasks, run as its own process next to the app, e.g.
+# 'python archive.py' (or 'python archive.py --env .env.testing --once').
+# Tasks completed more than ARCHIVE_AFTER_DAYS days ago are moved to TaskArchive, ARCHIVE_BATCH_SIZE at a time.
+# Every batch is its own short transaction followed by ARCHIVE_BATCH_DELAY seconds of sleep, so row locks,
+# WAL volume and replica lag stay bounded. Once nothing is left it waits ARCHIVE_INTERVAL seconds.
+# Only one archiver works at a time (session advisory lock), further ones wait as standbys. Every shard
+# (POSTGRES_SHARDS) is archived by its own thread.
+
+ARCHIVE_LOCK_ID = 4274302
+
+class TaskArchiver:
+    """ Moves completed tasks older than archive_after into TaskArchive in throttled batches """
+
+    def __init__(self, engine, archive_after=datetime.timedelta(days=30), batch_size=1000, batch_delay=0.1, interval=300):
+        self.engine = engine
+        self.archive_after = archive_after
+        self.batch_size = batch_size
+        self.batch_delay = batch_delay
+        self.interval = interval
+
+    def run_once(self, connection):
+        # Archives everything due at the time of the call, returns the number of archived tasks
+        completed_before = datetime.datetime.now() - self.archive_after
+        archived = 0
+        while True:
+            with connection.begin():
+                moved = db.archive_completed_tasks(connection, completed_before, self.batch_size)
+            archived += moved
+            if moved < self.batch_size: return archived
+            time.sleep(self.batch_delay)
+
+    def run(self, once=False):
+        with self.engine.connect() as connection:
+            connection.execute(sa.text("SELECT pg_advisory_lock(:lock_id)"), {"lock_id": ARCHIVE_LOCK_ID})
+            connection.commit()
+            while True:
+                archived = self.run_once(connection)
+                print(f"Archived {archived} tasks", flush=True)
+                if once: return archived
+                time.sleep(self.interval)
+
+def create_task_archiver(engine):
+    return TaskArchiver(engine,
+                        datetime.timedelta(days=float(os.environ.get("ARCHIVE_AFTER_DAYS", 30))),
+                        int(os.environ.get("ARCHIVE_BATCH_SIZE", 1000)),
+                        float(os.environ.get("ARCHIVE_BATCH_DELAY", 0.1)),
+                        float(os.environ.get("ARCHIVE_INTERVAL", 300)))
+
+def main():
+    parser = argparse.ArgumentParser(description="Move completed tasks to the archive")
+    parser.add_argument("--env", default=".env", help="dotenv file with the POSTGRES_* and ARCHIVE_* settings")
+    parser.add_argument("--once", action="store_true", help="archive what is due and exit")
+    args = parser.parse_args()
+
+    load_dotenv(args.env)
+    engine = db.create_db_engine(os.environ.get("POSTGRES_HOST"), os.environ.get("POSTGRES_PORT"), os.environ.get("POSTGRES_USER"), os.environ.get("POSTGRES_PASSWORD"), os.environ.get("POSTGRES_DB"))
+    engines = shards.create_shard_map(engine, os.environ.get("POSTGRES_USER"), os.environ.get("POSTGRES_PASSWORD"), os.environ.get("POSTGRES_DB"), pool_size=1, max_overflow=0).engines
+    try:
+        threads = [threading.Thread(target=create_task_archiver(engine).run, args=(args.once,), name=f"archiver-shard-{shard}") for shard, engine in enumerate(engines)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    finally:
+        for engine in engines:
+            engine.dispose()
+
+if __name__ == "__main__":
+    sys.exit(main())
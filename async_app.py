@@ -0,0 +1,584 @@
+import os
+import asyncio
+import datetime
+from functools import wraps
+from contextlib import asynccontextmanager
+
+from starlette.applications import Starlette
+from starlette.responses import Response, PlainTextResponse, JSONResponse, StreamingResponse
+from starlette.routing import Route
+from starlette.middleware import Middleware
+from starlette.middleware.cors import CORSMiddleware
+from starlette.templating import Jinja2Templates
+
+import db
+import auth
+import async_db
+import api_helpers
+import json_encoding
+import events
+import ratelimit
+import compression
+import replicas
+import shards
+import metrics
+from InvalidInputException import InvalidInputException
+from ServiceUnavailableException import ServiceUnavailableException
+from TooManyRequestsException import TooManyRequestsException
+
+# ASGI entry point serving the same API as app.py on an async database layer, run with e.g.
+# 'uvicorn async_app:app --host 0.0.0.0 --port 5000 --workers 4'
+
+HOST = os.environ.get("FLASK_HOST")
+PORT = os.environ.get("FLASK_PORT")
+
+db_config = {
+    "host" : os.environ.get("POSTGRES_HOST"),
+    "port" : os.environ.get("POSTGRES_PORT"),
+    "username" : os.environ.get("POSTGRES_USER"),
+    "password" : os.environ.get("POSTGRES_PASSWORD"),
+    "dbname" : os.environ.get("POSTGRES_DB"),
+}
+db_pool_config = {
+    "pool_size" : int(os.environ.get("POSTGRES_POOL_SIZE", 5)),
+    "max_overflow" : int(os.environ.get("POSTGRES_POOL_MAX_OVERFLOW", 10)),
+    "pool_timeout" : int(os.environ.get("POSTGRES_POOL_TIMEOUT", 30)),
+    "pool_recycle" : int(os.environ.get("POSTGRES_POOL_RECYCLE", 1800)),
+    "pool_pre_ping" : os.environ.get("POSTGRES_POOL_PRE_PING", "true").lower() == "true",
+}
+
+TASK_PAGE_MAX_LIMIT = int(os.environ.get("TASK_PAGE_MAX_LIMIT", 1000))
+TASK_STREAM_BATCH_SIZE = int(os.environ.get("TASK_STREAM_BATCH_SIZE", 1000))
+TASK_BATCH_MAX_SIZE = int(os.environ.get("TASK_BATCH_MAX_SIZE", 1000))
+TASK_SEARCH_DEFAULT_LIMIT = int(os.environ.get("TASK_SEARCH_DEFAULT_LIMIT", 50))
+
+db_engine = async_db.create_async_db_engine(db_config["host"], db_config["port"], db_config["username"], db_config["password"], db_config["dbname"], **db_pool_config)
+task_event_hub = events.create_task_event_hub(**db_config)
+
+# The router health-checks the replicas through small sync engines, requests use the async ones (same order)
+replica_router = replicas.create_replica_router(db.create_db_engine(db_config["host"], db_config["port"], db_config["username"], db_config["password"], db_config["dbname"], pool_size=1, max_overflow=0),
+                                                db_config["username"], db_config["password"], db_config["dbname"], pool_size=1, max_overflow=0)
+replica_engines = [async_db.create_async_db_engine(host, port, db_config["username"], db_config["password"], db_config["dbname"], **db_pool_config)
+                   for host, port in replicas.parse_replica_hosts(os.environ.get("POSTGRES_REPLICAS"))]
+for index, replica_engine in enumerate(replica_engines):
+    replica_router.watch(index, replica_engine.sync_engine)
+    metrics.instrument_engine(replica_engine.sync_engine)
+
+# Placement and the user -> shard cache come from the shard map, requests use the async engines (same order)
+shard_map = shards.create_shard_map(replica_router.primary, db_config["username"], db_config["password"], db_config["dbname"], pool_size=1, max_overflow=0)
+shard_engines = [db_engine] + [async_db.create_async_db_engine(host, port, db_config["username"], db_config["password"], dbname, **db_pool_config)
+                               for host, port, dbname in shards.parse_shard_dsns(os.environ.get("POSTGRES_SHARDS"), db_config["dbname"])]
+for shard_engine in shard_engines:
+    metrics.instrument_engine(shard_engine.sync_engine)
+
+templates = Jinja2Templates(directory=os.path.join(os.path.dirname(os.path.abspath(__file__)), "templates"))
+
+auth.jwt_secret_key = os.environ.get("FLASK_SECRET")
+
+# With CACHE_REDIS_URL the caches and rate limit buckets are Redis round trips, made on a thread (see off_loop)
+SHARED_CACHE = bool(os.environ.get("CACHE_REDIS_URL"))
+
+##################################################
+
+async def off_loop(func, *args):
+    # Runs blocking cache/rate limiter calls without stalling the event loop, in-process ones stay inline
+    if not SHARED_CACHE: return func(*args)
+    return await asyncio.to_thread(func, *args)
+
+class TaskJSONResponse(JSONResponse):
+    # Same encoding (and datetime format) as app.py
+    def render(self, content):
+        return json_encoding.dumps_bytes(content)
+
+async def read_json(request):
+    try:
+        return await request.json()
+    except ValueError:
+        return None
+
+def parse_etags(header):
+    # Weak comparison as in werkzeug's if_none_match.contains_weak
+    if header is None: return set()
+    etags = set()
+    for etag in header.split(","):
+        etag = etag.strip()
+        etags.add(etag if etag.startswith("W/") else "W/" + etag)
+    return etags
+
+def parse_task_dates(task):
+    # asyncpg needs real datetimes where psycopg2 lets Postgres parse the string
+    if isinstance(task.get("due_date"), str):
+        try:
+            task["due_date"] = datetime.datetime.fromisoformat(task["due_date"])
+        except ValueError:
+            raise InvalidInputException("Invalid due_date: Must be an ISO 8601 datetime")
+    return task
+
+async def user_shard(user_id):
+    # Shard of the user, shard 0 (which holds the directory) for requests without a user
+    if user_id is None: return 0
+    shard = await off_loop(shard_map.cached_shard, user_id)
+    if shard is not None: return shard
+
+    async with db_engine.connect() as connection:
+        shard = await async_db.get_user_shard(user_id, connection)
+    await off_loop(shard_map.remember, user_id, shard)
+    return shard or 0
+
+def token_payload(request):
+    # Decoded once per request, shard routing and JWT_required share the result
+    if not hasattr(request.state, "jwt_payload"):
+        auth_header = request.headers.get("Authorization")
+        request.state.jwt_payload = auth.verify_jwt(auth_header) if auth_header is not None else None
+    return request.state.jwt_payload
+
+def token_user_id(request):
+    # User of the request's token, if valid, to pick its shard before the connection is opened
+    jwt_payload = token_payload(request)
+    return jwt_payload["user_id"] if jwt_payload is not None else None
+
+async def handle_in_transaction(handler, request, shard):
+    async with shard_engines[shard].connect() as connection:
+        response = await handler(request, connection)
+        if response.status_code < 400:
+            await connection.commit()
+            # Later reads of the writing user wait for the replicas to catch up
+            user_id = getattr(request.state, "user_id", None)
+            if replica_engines and shard == 0 and request.method != "GET" and user_id is not None:
+                await off_loop(replica_router.pin, user_id, await async_db.get_current_wal_lsn(connection))
+        else:
+            await connection.rollback()
+        return response
+
+def with_connection(handler):
+    # One pooled connection per request on the user's shard, committed unless the response is an error
+    @wraps(handler)
+    async def inner(request):
+        return await handle_in_transaction(handler, request, await user_shard(token_user_id(request)))
+
+    return inner
+
+def with_directory_connection(handler):
+    # Like with_connection on shard 0, which holds the directory (/register and /login)
+    @wraps(handler)
+    async def inner(request):
+        return await handle_in_transaction(handler, request, 0)
+
+    return inner
+
+async def on_shard(shard, connection, func, *args):
+    # Runs func on shard 0 with the request's connection, on other shards with its own, committed right away
+    if shard == 0: return await func(*args, connection)
+    async with shard_engines[shard].connect() as shard_connection:
+        result = await func(*args, shard_connection)
+        await shard_connection.commit()
+        return result
+
+async def read_engine(user_id):
+    # Replicas (POSTGRES_REPLICAS) only serve users on shard 0
+    shard = await user_shard(user_id)
+    index = await off_loop(replica_router.read_replica, user_id) if shard == 0 else None
+    return shard_engines[shard] if index is None else replica_engines[index]
+
+def with_read_connection(handler):
+    # Like with_connection for read-only handlers, on a replica unless the token's user is pinned by a recent write
+    @wraps(handler)
+    async def inner(request):
+        async with (await read_engine(token_user_id(request))).connect() as connection:
+            return await handler(request, connection)
+
+    return inner
+
+def JWT_required(handler):
+    @wraps(handler)
+    async def inner(request, connection):
+        auth_header = request.headers.get("Authorization")
+
+        if auth_header is None:
+            return PlainTextResponse("Unauthorized: Missing token", 401)
+
+        jwt_payload = token_payload(request)
+
+        if jwt_payload is None:
+            return PlainTextResponse("Unauthorized: Invalid token", 401)
+
+        user_id = jwt_payload["user_id"]
+        await off_loop(ratelimit.rate_limiter.check, "user", user_id)
+        request.state.user_id = user_id
+
+        if await off_loop(auth.user_cache.get, user_id) is None:
+            if (await async_db.get_user_by_id(user_id, connection) is None):
+                return PlainTextResponse(f"Invalid User: User with id '{user_id}' not found!", 401)
+            await off_loop(auth.user_cache.set, user_id, "1")
+
+        return await handler(request, connection, user_id)
+
+    return inner
+
+def limit_by_client(budget):
+    # Checked before with_connection, rejected clients never take a pooled connection
+    def decorator(handler):
+        @wraps(handler)
+        async def inner(request):
+            await off_loop(ratelimit.rate_limiter.check, budget, ratelimit.client_address(request.client.host if request.client else None, request.headers.get("X-Forwarded-For")))
+            return await handler(request)
+
+        return inner
+
+    return decorator
+
+async def service_unavailable(request, e):
+    return PlainTextResponse(str(e), 503, headers={"Retry-After": str(e.retry_after)})
+
+async def too_many_requests(request, e):
+    return PlainTextResponse(str(e), 429, headers={"Retry-After": str(e.retry_after)})
+
+##################################################
+
+@limit_by_client("client")
+async def swagger(request):
+    return templates.TemplateResponse(request, "swagger.json", {"HOST": HOST, "PORT": PORT}, media_type="application/json")
+
+##################################################
+
+async def health(request):
+    return TaskJSONResponse({"status": "ok", "db_pool": db.get_pool_status(db_engine), "user_cache": auth.user_cache.stats(), "rate_limiter": ratelimit.rate_limiter.stats(), "replicas": replica_router.stats(), "shards": shard_map.stats(), "task_events": task_event_hub.stats()}, 200)
+
+async def metrics_endpoint(request):
+    body, content_type = metrics.render()
+    return Response(body, 200, media_type=content_type)
+
+##################################################
+
+@limit_by_client("auth")
+@with_directory_connection
+async def register(request, connection):
+    body = await read_json(request)
+    if (not isinstance(body, dict) or "username" not in body or "password" not in body):
+        return PlainTextResponse("Bad request", 400)
+    username, plaintext_password = str(body.get("username")), str(body.get("password"))
+
+    try:
+        # bcrypt runs on the password process pool, awaited without blocking the event loop
+        hashed_password = (await asyncio.wrap_future(auth.submit_hash_password(plaintext_password))).decode()
+        shard = shard_map.place(username)
+        if shard == 0:
+            request.state.user_id = await async_db.insert_user(username, hashed_password, connection)
+            await async_db.insert_user_directory_entry(request.state.user_id, username, shard, connection)
+        else:
+            # The directory entry is committed after the user, as in app.py
+            async with shard_engines[shard].connect() as user_connection:
+                request.state.user_id = await async_db.insert_user(username, hashed_password, user_connection)
+                await async_db.insert_user_directory_entry(request.state.user_id, username, shard, connection)
+                await user_connection.commit()
+    except InvalidInputException as e:
+        return PlainTextResponse(str(e), 404)
+
+    return TaskJSONResponse({"username": username, "password": plaintext_password}, 201)
+
+async def find_user(username, directory):
+    # (user, shard), the directory names the shard when there are several
+    if not shard_map.sharded: return await async_db.get_user_by_username(username, directory), 0
+
+    entry = await async_db.get_user_directory_entry(username, directory)
+    if entry is None: return None, 0
+    await off_loop(shard_map.remember, entry["user_id"], entry["shard"])
+    return await on_shard(entry["shard"], directory, async_db.get_user_by_username, username), entry["shard"]
+
+@limit_by_client("auth")
+@with_directory_connection
+async def login(request, connection):
+    body = await read_json(request)
+    if (not isinstance(body, dict) or "username" not in body or "password" not in body):
+        return PlainTextResponse("Bad request", 400)
+
+    username, plaintext_password = str(body.get("username")), str(body.get("password"))
+
+    try:
+        user, shard = await find_user(username, connection)
+    except InvalidInputException as e:
+        return PlainTextResponse(str(e), 404)
+
+    user_found = user is not None
+
+    # IF user is not found use dummy compare to avoid timing attacks
+    if (not user_found):
+        hashed_password = auth.DUMMY_HASH
+    else:
+        hashed_password = user["password_hash"]
+
+    try:
+        user_password_verified = await asyncio.wrap_future(auth.submit_check_password_hash(plaintext_password, hashed_password))
+    except InvalidInputException as e:
+        return PlainTextResponse(str(e), 404)
+
+    if (not user_found or not user_password_verified):
+        return PlainTextResponse("Unauthorized", 401)
+
+    # Transparently upgrade hashes created with a different bcrypt cost, best effort only
+    if auth.password_needs_rehash(hashed_password):
+        try:
+            new_hashed_password = (await asyncio.wrap_future(auth.submit_hash_password(plaintext_password))).decode()
+            await on_shard(shard, connection, async_db.update_user_password_hash, user["id"], new_hashed_password)
+        except ServiceUnavailableException:
+            pass
+
+    token = auth.gen_jwt(user)
+
+    return TaskJSONResponse({"access_token": token}, 200)
+
+##################################################
+
+async def stream_task_list(engine, user_id, cursor, ndjson, filters):
+    # Uses its own connection as the response body is produced after the request handler returns. engine is
+    # the one the ETag's task_version was read from, another replica could lag behind it
+    async with engine.connect() as connection:
+        first = True
+        if not ndjson: yield b"["
+        async for batch in async_db.iter_task_list_by_user_id(user_id, connection, cursor, TASK_STREAM_BATCH_SIZE, **filters):
+            if ndjson:
+                yield b"\n".join(map(json_encoding.dumps_bytes, batch)) + b"\n"
+            else:
+                yield (b"" if first else b",") + json_encoding.dumps_bytes(batch)[1:-1]
+            first = False
+        if not ndjson: yield b"]"
+
+@with_read_connection
+@JWT_required
+async def get_tasks(request, connection, user_id):
+    cursor = request.query_params.get("cursor")
+    limit = request.query_params.get("limit")
+    output_format = request.query_params.get("format", "json")
+    stream = request.query_params.get("stream", "false").lower() == "true"
+
+    if limit is not None and (not limit.isdigit() or int(limit) < 1):
+        return PlainTextResponse("Bad request", 400)
+    if output_format not in ("json", "ndjson"):
+        return PlainTextResponse("Bad request", 400)
+    try:
+        filters = api_helpers.parse_task_filters(request.query_params)
+    except ValueError:
+        return PlainTextResponse("Bad request", 400)
+
+    try:
+        # Validate cursor and filters up front, streamed bodies can no longer change the status code
+        db.task_list_query(user_id, cursor, **filters)
+
+        # Unchanged listings are answered from the user's task_version alone, without reading Task
+        etag = 'W/"' + api_helpers.task_list_etag(user_id, await async_db.get_task_version(user_id, connection), request.url.query) + '"'
+        if_none_match = parse_etags(request.headers.get("If-None-Match"))
+        if etag in if_none_match or "W/*" in if_none_match:
+            return Response(status_code=304, headers={"ETag": etag})
+
+        if stream or output_format == "ndjson":
+            media_type = "application/x-ndjson" if output_format == "ndjson" else "application/json"
+            return StreamingResponse(stream_task_list(connection.engine, user_id, cursor, output_format == "ndjson", filters), 200, media_type=media_type, headers={"ETag": etag})
+
+        if limit is None:
+            task_list = await async_db.get_task_list_by_user_id(user_id, connection, cursor=cursor, **filters)
+            return TaskJSONResponse(task_list, 200, headers={"ETag": etag})
+
+        task_list, next_cursor = await async_db.get_task_page_by_user_id(user_id, connection, min(int(limit), TASK_PAGE_MAX_LIMIT), cursor, **filters)
+    except InvalidInputException as e:
+        return PlainTextResponse(str(e), 404)
+
+    headers = {"ETag": etag}
+    if next_cursor is not None:
+        headers["X-Next-Cursor"] = next_cursor
+    return TaskJSONResponse(task_list, 200, headers=headers)
+
+@with_connection
+@JWT_required
+async def stream_task_events(request, connection, user_id):
+    last_version = events.parse_event_id(request.headers.get("Last-Event-ID"))
+    # The first subscription waits for the listener thread to connect
+    subscription = await asyncio.to_thread(task_event_hub.subscribe, user_id, asyncio.get_running_loop())
+    try:
+        # Read after subscribing, so every later change is either replayed or delivered live
+        replay = task_event_hub.replay(user_id, last_version, await async_db.get_task_version(user_id, connection)) if last_version is not None else []
+    except Exception:
+        task_event_hub.unsubscribe(subscription)
+        raise
+
+    event_stream = events.EventStream(subscription, replay, last_version)
+    return StreamingResponse(events.stream_async(task_event_hub, subscription, event_stream), 200, media_type="text/event-stream", headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+@with_read_connection
+@JWT_required
+async def get_task_summary(request, connection, user_id):
+    try:
+        # api_helpers.get_task_summary with the cache calls off the event loop
+        cached = api_helpers.TASK_SUMMARY_CACHE_TTL > 0
+        task_version = await async_db.get_task_version(user_id, connection) if cached else None
+        summary = await off_loop(api_helpers.get_cached_task_summary, user_id, task_version) if cached else None
+        if summary is None:
+            summary = await async_db.get_task_summary_by_user_id(user_id, connection)
+            if cached: await off_loop(api_helpers.set_cached_task_summary, user_id, task_version, summary)
+    except InvalidInputException as e:
+        return PlainTextResponse(str(e), 404)
+
+    return TaskJSONResponse(summary, 200)
+
+@with_read_connection
+@JWT_required
+async def search_tasks(request, connection, user_id):
+    text = request.query_params.get("q")
+    limit = request.query_params.get("limit", str(TASK_SEARCH_DEFAULT_LIMIT))
+    mode = request.query_params.get("mode", "websearch")
+
+    if text is None or not limit.isdigit() or int(limit) < 1:
+        return PlainTextResponse("Bad request", 400)
+
+    try:
+        task_list, next_cursor = await async_db.search_tasks_by_user_id(user_id, text, connection, min(int(limit), TASK_PAGE_MAX_LIMIT), request.query_params.get("cursor"), mode)
+    except InvalidInputException as e:
+        return PlainTextResponse(str(e), 404)
+
+    headers = {}
+    if next_cursor is not None:
+        headers["X-Next-Cursor"] = next_cursor
+    return TaskJSONResponse(task_list, 200, headers=headers)
+
+@with_connection
+@JWT_required
+async def add_task(request, connection, user_id):
+    task = await read_json(request)
+    if (not isinstance(task, dict) or "title" not in task):
+        return PlainTextResponse("Bad request", 400)
+
+    task["user_id"] = user_id
+
+    try:
+        await async_db.insert_task(parse_task_dates(dict(task)), connection)
+    except InvalidInputException as e:
+        return PlainTextResponse(str(e), 404)
+
+    return TaskJSONResponse(task, 200)
+
+@with_connection
+@JWT_required
+async def update_task_by_id(request, connection, user_id):
+    task = await read_json(request)
+    if not isinstance(task, dict):
+        return PlainTextResponse("Bad request", 400)
+    task["id"] = request.path_params["task_id"]
+
+    try:
+        await async_db.update_task(parse_task_dates(task), user_id, connection)
+    except InvalidInputException as e:
+        return PlainTextResponse(str(e), 404)
+
+    return PlainTextResponse("Success", 200)
+
+@with_connection
+@JWT_required
+async def delete_task_by_id(request, connection, user_id):
+    try:
+        await async_db.delete_task_by_id(request.path_params["task_id"], user_id, connection)
+    except InvalidInputException as e:
+        return PlainTextResponse(str(e), 404)
+
+    return PlainTextResponse("Success", 200)
+
+##################################################
+
+async def run_batch(request, connection, user_id, key, batch_results):
+    items = api_helpers.read_batch(await read_json(request), key)
+    if items is None:
+        return PlainTextResponse("Bad request", 400)
+    if len(items) > TASK_BATCH_MAX_SIZE:
+        return PlainTextResponse(f"Batch too large: At most {TASK_BATCH_MAX_SIZE} items", 413)
+
+    return TaskJSONResponse(await async_db.run(batch_results, items, user_id, connection=connection), 200)
+
+@with_connection
+@JWT_required
+async def add_task_batch(request, connection, user_id):
+    return await run_batch(request, connection, user_id, "tasks", api_helpers.insert_task_batch_results)
+
+@with_connection
+@JWT_required
+async def update_task_batch(request, connection, user_id):
+    return await run_batch(request, connection, user_id, "tasks", api_helpers.update_task_batch_results)
+
+@with_connection
+@JWT_required
+async def delete_task_batch(request, connection, user_id):
+    return await run_batch(request, connection, user_id, "ids", api_helpers.delete_task_batch_results)
+
+##################################################
+
+async def stream_task_export(user_id, output_format, filters):
+    # Uses its own connection as the response body is produced after the request handler returns
+    async with (await read_engine(user_id)).connect() as connection:
+        async for chunk in async_db.export_tasks(user_id, connection, output_format, **filters):
+            yield chunk
+
+@with_read_connection
+@JWT_required
+async def export_tasks(request, connection, user_id):
+    output_format = request.query_params.get("format", "ndjson")
+    if output_format not in db.TASK_TRANSFER_FORMATS:
+        return PlainTextResponse("Bad request", 400)
+    try:
+        filters = api_helpers.parse_task_filters(request.query_params)
+    except ValueError:
+        return PlainTextResponse("Bad request", 400)
+
+    try:
+        # Validate filters up front, streamed bodies can no longer change the status code
+        db.task_export_query(user_id, output_format, **filters)
+    except InvalidInputException as e:
+        return PlainTextResponse(str(e), 404)
+
+    return StreamingResponse(stream_task_export(user_id, output_format, filters), 200, media_type=db.TASK_TRANSFER_MEDIA_TYPES[output_format],
+                             headers={"Content-Disposition": f'attachment; filename="tasks.{output_format}"'})
+
+@with_connection
+@JWT_required
+async def import_tasks(request, connection, user_id):
+    input_format = request.query_params.get("format", "ndjson")
+    if input_format not in db.TASK_TRANSFER_FORMATS:
+        return PlainTextResponse("Bad request", 400)
+
+    try:
+        imported = await async_db.import_tasks(user_id, request.stream(), connection, input_format)
+    except InvalidInputException as e:
+        return PlainTextResponse(str(e), 404)
+
+    return TaskJSONResponse({"imported": imported}, 200)
+
+##################################################
+
+@asynccontextmanager
+async def lifespan(app):
+    # The schema is managed by migrations.py, not on startup
+    yield
+    auth.password_pool.shutdown()
+    for engine in shard_engines + replica_engines:
+        await engine.dispose()
+
+routes = [
+    Route("/swagger.json", swagger, methods=["GET"]),
+    Route("/health", health, methods=["GET"]),
+    Route("/metrics", metrics_endpoint, methods=["GET"]),
+    Route("/register", register, methods=["POST"]),
+    Route("/login", login, methods=["POST"]),
+    Route("/tasks", get_tasks, methods=["GET"]),
+    Route("/tasks/stream", stream_task_events, methods=["GET"]),
+    Route("/tasks/summary", get_task_summary, methods=["GET"]),
+    Route("/tasks/search", search_tasks, methods=["GET"]),
+    Route("/tasks/export", export_tasks, methods=["GET"]),
+    Route("/tasks/import", import_tasks, methods=["POST"]),
+    Route("/tasks", add_task, methods=["POST"]),
+    Route("/tasks/batch", add_task_batch, methods=["POST"]),
+    Route("/tasks/batch", update_task_batch, methods=["PATCH"]),
+    Route("/tasks/batch", delete_task_batch, methods=["DELETE"]),
+    Route("/tasks/{task_id:int}", update_task_by_id, methods=["PUT"]),
+    Route("/tasks/{task_id:int}", delete_task_by_id, methods=["DELETE"]),
+]
+
+app = Starlette(routes=routes,
+                lifespan=lifespan,
+                middleware=[Middleware(CORSMiddleware, allow_origins=["*"], allow_methods=["*"], allow_headers=["*"]), Middleware(compression.CompressionMiddleware)],
+                exception_handlers={ServiceUnavailableException: service_unavailable, TooManyRequestsException: too_many_requests})
@@ -0,0 +1,163 @@
+import asyncio
+
+import asyncpg
+import sqlalchemy as sa
+from sqlalchemy.ext.asyncio import create_async_engine
+
+import db
+from InvalidInputException import InvalidInputException
+
+# Async versions of the db.py query functions. Each one runs the db.py function unchanged on
+# AsyncConnection.run_sync's sync facade, so the SQL is shared while the IO (asyncpg) is awaited
+# on the event loop instead of blocking a thread.
+
+def create_async_db_engine(host, port, username, password, dbname, pool_size=5, max_overflow=10, pool_timeout=30, pool_recycle=1800, pool_pre_ping=True):
+
+    connection_string = f"postgresql+asyncpg://{username}:{password}@{host}:{port}/{dbname}"
+
+    engine = create_async_engine(connection_string,
+                                 pool_size=pool_size,
+                                 max_overflow=max_overflow,
+                                 pool_timeout=pool_timeout,
+                                 pool_recycle=pool_recycle,
+                                 pool_pre_ping=pool_pre_ping,
+                                 )
+
+    return engine
+
+async def run(func, *args, connection, **kwargs):
+    return await connection.run_sync(lambda sync_connection: func(*args, connection=sync_connection, **kwargs))
+
+##################################################
+
+async def get_current_wal_lsn(connection):
+    return await run(db.get_current_wal_lsn, connection=connection)
+
+async def insert_user(username, hashed_password_string, connection):
+    return await run(db.insert_user, username, hashed_password_string, connection=connection)
+
+async def get_user_by_username(username, connection):
+    return await run(db.get_user_by_username, username, connection=connection)
+
+async def get_user_by_id(user_id, connection):
+    return await run(db.get_user_by_id, user_id, connection=connection)
+
+async def update_user_password_hash(user_id, hashed_password_string, connection):
+    return await run(db.update_user_password_hash, user_id, hashed_password_string, connection=connection)
+
+async def delete_user_by_id(user_id, connection):
+    return await run(db.delete_user_by_id, user_id, connection=connection)
+
+async def insert_user_directory_entry(user_id, username, shard, connection):
+    return await run(db.insert_user_directory_entry, user_id, username, shard, connection=connection)
+
+async def get_user_directory_entry(username, connection):
+    return await run(db.get_user_directory_entry, username, connection=connection)
+
+async def get_user_shard(user_id, connection):
+    return await run(db.get_user_shard, user_id, connection=connection)
+
+async def get_task_version(user_id, connection):
+    return await run(db.get_task_version, user_id, connection=connection)
+
+async def insert_task(task, connection):
+    return await run(db.insert_task, task, connection=connection)
+
+async def get_task_by_id(task_id, connection, include_archived=False):
+    return await run(db.get_task_by_id, task_id, connection=connection, include_archived=include_archived)
+
+async def get_task_list_by_user_id(user_id, connection, **filters):
+    return await run(db.get_task_list_by_user_id, user_id, connection=connection, **filters)
+
+async def get_task_page_by_user_id(user_id, connection, limit, cursor=None, **filters):
+    return await run(db.get_task_page_by_user_id, user_id, connection=connection, limit=limit, cursor=cursor, **filters)
+
+async def iter_task_list_by_user_id(user_id, connection, cursor=None, batch_size=1000, **filters):
+    # Server-side cursor, fetched from Postgres in batches
+    query = db.task_list_query(user_id, cursor, **filters).execution_options(yield_per=batch_size)
+    result = await connection.stream(query)
+    fields = db.task_list_fields(filters.get("fields"), filters.get("sort", "id"))
+
+    async for partition in result.tuples().partitions(batch_size):
+        yield db.task_rows_to_dicts(partition, fields)
+
+async def get_task_summary_by_user_id(user_id, connection):
+    return await run(db.get_task_summary_by_user_id, user_id, connection=connection)
+
+async def search_tasks_by_user_id(user_id, text, connection, limit, cursor=None, mode="websearch"):
+    return await run(db.search_tasks_by_user_id, user_id, text, connection=connection, limit=limit, cursor=cursor, mode=mode)
+
+async def update_task(task, user_id, connection):
+    return await run(db.update_task, task, user_id, connection=connection)
+
+async def delete_task_by_id(task_id, user_id, connection):
+    return await run(db.delete_task_by_id, task_id, user_id, connection=connection)
+
+async def insert_task_batch(task_list, user_id, connection):
+    return await run(db.insert_task_batch, task_list, user_id, connection=connection)
+
+async def update_task_batch(task_list, user_id, connection):
+    return await run(db.update_task_batch, task_list, user_id, connection=connection)
+
+async def delete_task_batch(task_id_list, user_id, connection):
+    return await run(db.delete_task_batch, task_id_list, user_id, connection=connection)
+
+async def import_tasks(user_id, chunks, connection, format="ndjson"):
+    # chunks: async iterable of the uploaded bytes. COPY runs on the asyncpg connection inside the
+    # transaction SQLAlchemy began for the staging table
+    if not isinstance(user_id, int): raise InvalidInputException("Invalid user_id: Must be int")
+
+    encoder = db.TaskImportEncoder(format)
+    chunks = chunks.__aiter__()
+    pending = []
+    while encoder.columns is None:
+        try:
+            pending.append(encoder.feed(await chunks.__anext__()))
+        except StopAsyncIteration:
+            pending.append(encoder.finish())
+    async def encoded():
+        for data in pending:
+            if data: yield data
+        async for chunk in chunks:
+            data = encoder.feed(chunk)
+            if data: yield data
+        data = encoder.finish()
+        if data: yield data
+
+    await connection.execute(sa.text(db.TASK_IMPORT_TABLE_SQL))
+    driver_connection = (await connection.get_raw_connection()).driver_connection
+    try:
+        await driver_connection.copy_to_table("task_import", source=encoded(), columns=list(encoder.columns), format="csv")
+    except (asyncpg.DataError, asyncpg.IntegrityConstraintViolationError) as e:
+        raise db.task_import_error(e.message, e.context, encoder.header_lines)
+
+    return await run(db.merge_task_import, user_id, connection=connection)
+
+async def export_tasks(user_id, connection, format="ndjson", max_chunks=4, **filters):
+    # Async generator of the export. asyncpg hands COPY output to a callback, awaiting a short queue there
+    # makes the COPY wait for the consumer
+    query, options = db.task_export_query(user_id, format, **filters)
+    driver_connection = (await connection.get_raw_connection()).driver_connection
+    chunks = asyncio.Queue(max_chunks)
+    done = object()
+
+    async def copy():
+        try:
+            await driver_connection.copy_from_query(query, output=chunks.put, **options)
+        finally:
+            await chunks.put(done)
+
+    task = asyncio.create_task(copy())
+    try:
+        while (chunk := await chunks.get()) is not done:
+            yield bytes(chunk)
+        await task
+    finally:
+        if not task.done():
+            # Consumer gone early (e.g. client disconnected), the COPY is left unfinished on the connection
+            task.cancel()
+            try:
+                await task
+            except (asyncio.CancelledError, Exception):
+                pass
+            await connection.invalidate()
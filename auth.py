@@ -1,26 +1,113 @@
+import os
 import json
 import bcrypt
 import jwt
 import secrets
 import datetime 
+import time
+import threading
+from concurrent.futures import ProcessPoolExecutor, Future
 
 import db
+import cache
+import metrics
+import profiling
+import ratelimit
 from InvalidInputException import InvalidInputException
+from ServiceUnavailableException import ServiceUnavailableException
 
 jwt_secret_key = ""
 
-# TO avoid timing attacks a random hash is precomputed to compare when users are not found
-DUMMY_HASH = bcrypt.hashpw(secrets.token_bytes(32), bcrypt.gensalt()).decode()
-
-def hash_password(password):
+# Ids of users verified to exist, keeps JWT_required off the database for most requests
+user_cache = cache.create_cache("verified_user", int(os.environ.get("AUTH_USER_CACHE_SIZE", 10000)), int(os.environ.get("AUTH_USER_CACHE_TTL", 60)))
+
+BCRYPT_ROUNDS = int(os.environ.get("BCRYPT_ROUNDS", 12))
+
+# TO avoid timing attacks a random hash is compared when users are not found (with the configured cost so
+# it takes as long as checking a real hash). Random digest characters give a valid hash without paying for
+# a bcrypt run on every worker boot
+BCRYPT_ALPHABET = "./ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789"
+DUMMY_HASH = bcrypt.gensalt(BCRYPT_ROUNDS).decode() + "".join(secrets.choice(BCRYPT_ALPHABET) for _ in range(31))
+
+class PasswordPool:
+    """ Runs bcrypt work on a size-limited process pool, failing fast when max_queue jobs are already waiting """
+
+    def __init__(self, size, max_queue, retry_after):
+        self.size = size
+        self.max_queue = max_queue
+        self.retry_after = retry_after
+        self._executor = None
+        self._slots = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def _ensure_started(self):
+        # Created lazily and per process, so gunicorn workers forked from a preloaded app get their own pool
+        with self._lock:
+            if self._pid != os.getpid():
+                self._executor = ProcessPoolExecutor(max_workers=self.size)
+                self._slots = threading.BoundedSemaphore(self.size + self.max_queue)
+                self._pid = os.getpid()
+
+    def submit(self, func, *args):
+        start = time.perf_counter()
+        if self.size == 0:
+            future = Future()
+            try:
+                future.set_result(func(*args))
+            except Exception as e:
+                future.set_exception(e)
+            metrics.observe_bcrypt(func.__name__, time.perf_counter() - start)
+            return future
+
+        self._ensure_started()
+        slots = self._slots
+        if not slots.acquire(blocking=False):
+            raise ServiceUnavailableException("Service Unavailable: Too many concurrent password operations", self.retry_after)
+        try:
+            future = self._executor.submit(func, *args)
+        except Exception:
+            slots.release()
+            raise
+        future.add_done_callback(lambda _: slots.release())
+        future.add_done_callback(lambda _: metrics.observe_bcrypt(func.__name__, time.perf_counter() - start))
+        return future
+
+    def run(self, func, *args):
+        return self.submit(func, *args).result()
+
+    def shutdown(self):
+        # Servers that exit by re-raising SIGTERM (uvicorn) skip the atexit join, which would orphan the workers
+        with self._lock:
+            if self._executor is not None and self._pid == os.getpid():
+                self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+            self._pid = None
+
+password_pool = PasswordPool(int(os.environ.get("PASSWORD_POOL_SIZE", 2)), int(os.environ.get("PASSWORD_POOL_MAX_QUEUE", 16)), int(os.environ.get("PASSWORD_POOL_RETRY_AFTER", 1)))
+
+# submit_* return a concurrent.futures.Future so async callers can await the result without blocking
+def submit_hash_password(password):
     if not isinstance(password, str) or password.strip() == "": raise InvalidInputException("Invalid password: Must be a non-empty string")
-    salt = bcrypt.gensalt()
-    return bcrypt.hashpw(password.encode(), salt)
+    salt = bcrypt.gensalt(BCRYPT_ROUNDS)
+    return password_pool.submit(bcrypt.hashpw, password.encode(), salt)
 
-def check_password_hash(password, hashed_password):
+def submit_check_password_hash(password, hashed_password):
     if not isinstance(password, str) or password.strip() == "": raise InvalidInputException("Invalid password: Must be a non-empty string")
     if not isinstance(hashed_password, str) or password.strip() == "": raise Exception("Something went wrong")
-    return bcrypt.checkpw(password.encode(), hashed_password.encode())
+    return password_pool.submit(bcrypt.checkpw, password.encode(), hashed_password.encode())
+
+def hash_password(password):
+    with profiling.phase("bcrypt"):
+        return submit_hash_password(password).result()
+
+def check_password_hash(password, hashed_password):
+    with profiling.phase("bcrypt"):
+        return submit_check_password_hash(password, hashed_password).result()
+
+def password_needs_rehash(hashed_password):
+    # bcrypt hashes are formatted as $2b$<cost>$<salt+hash>
+    return int(hashed_password.split("$")[2]) != BCRYPT_ROUNDS
 
 def gen_jwt(user):
     payload = {
@@ -32,36 +119,47 @@ def gen_jwt(user):
 
 def verify_jwt(token):
     token = token[len("Bearer "):]
-    print("TOKEN: ", token)
     try:
-        payload = jwt.decode(token, jwt_secret_key, algorithms=['HS256'])
+        with profiling.phase("jwt"):
+            payload = jwt.decode(token, jwt_secret_key, algorithms=['HS256'])
         return json.loads(payload['sub'])
     except jwt.ExpiredSignatureError:
         return None  
     except jwt.InvalidTokenError:
         return None 
 
-from flask import request, make_response
+def invalidate_user(user_id):
+    user_cache.delete(user_id)
+
+db.user_deleted_hooks.append(invalidate_user)
+
+from flask import request, make_response, g
 from functools import wraps
 
-def JWT_required(connection):
+def JWT_required(get_connection):
     def decorator(func):
         @wraps(func)
         def inner_func(*args, **kwargs):
-            auth_header = request.headers.get("Authorization")
+            with profiling.phase("auth"):
+                auth_header = request.headers.get("Authorization")
 
-            if auth_header is None:
-                return make_response("Unauthorized: Missing token", 401)
+                if auth_header is None:
+                    return make_response("Unauthorized: Missing token", 401)
 
-            jwt_payload = verify_jwt(auth_header)
+                jwt_payload = verify_jwt(auth_header)
 
-            if jwt_payload is None:
-                return make_response("Unauthorized: Invalid token", 401)
+                if jwt_payload is None:
+                    return make_response("Unauthorized: Invalid token", 401)
 
-            user_id = jwt_payload["user_id"]
+                user_id = jwt_payload["user_id"]
+                ratelimit.rate_limiter.check("user", user_id)
+                # Routes reads and read-your-writes pinning (see replicas.py)
+                g.user_id = user_id
 
-            if (db.get_user_by_id(user_id, connection) is None):
-                return make_response(f"Invalid User: User with id '{user_id}' not found!", 401) 
+                if user_cache.get(user_id) is None:
+                    if (db.get_user_by_id(user_id, get_connection()) is None):
+                        return make_response(f"Invalid User: User with id '{user_id}' not found!", 401) 
+                    user_cache.set(user_id, "1")
 
             return func(*args, user_id=user_id, **kwargs)
 
@@ -0,0 +1,97 @@
+import os
+import sys
+import time
+import argparse
+
+import httpx
+from dotenv import load_dotenv
+
+import migrations
+from benchmarks import loadgen, seed
+
+# Rows/sec of the COPY based POST /tasks/import and GET /tasks/export against POST /tasks/batch and
+# GET /tasks?format=ndjson, with the server's peak memory after each step (stays flat when streaming), e.g.
+# 'python -m benchmarks.bulk_transfer --env .env.testing --rows 1000000 --app async'
+
+BATCH_SIZE = 1000
+
+def ndjson_rows(rows):
+    for start in range(0, rows, BATCH_SIZE):
+        yield "".join(f'{{"title": "bulk-task-{i}", "description": "Synthetic bulk task", "due_date": "2025-01-01T00:00:00", "is_completed": false}}\n'
+                      for i in range(start, min(rows, start + BATCH_SIZE))).encode()
+
+def csv_rows(rows):
+    yield b"title,description,due_date,is_completed\n"
+    for start in range(0, rows, BATCH_SIZE):
+        yield "".join(f"bulk-task-{i},Synthetic bulk task,2025-01-01T00:00:00,false\n" for i in range(start, min(rows, start + BATCH_SIZE))).encode()
+
+def peak_rss(process):
+    # Largest of the server process and its children (the gunicorn worker)
+    with open(f"/proc/{process.pid}/task/{process.pid}/children") as f:
+        pids = [process.pid] + [int(pid) for pid in f.read().split()]
+    peaks = []
+    for pid in pids:
+        with open(f"/proc/{pid}/status") as f:
+            peaks.append(int(dict(line.split(":", 1) for line in f)["VmHWM"].split()[0]))
+    return f"{max(peaks) // 1024} MB"
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark bulk task import/export")
+    parser.add_argument("--env", default=".env", help="dotenv file with the POSTGRES_* settings")
+    parser.add_argument("--rows", type=int, default=100000)
+    parser.add_argument("--app", choices=("sync", "async"), default="sync")
+    parser.add_argument("--port", type=int, default=5115)
+    args = parser.parse_args()
+
+    load_dotenv(args.env)
+    engine = seed.create_engine_from_env()
+    seed.seed(engine, 1, 0, reset=True)
+    migrations.migrate(engine)
+    engine.dispose()
+
+    base_url = f"http://127.0.0.1:{args.port}"
+    if args.app == "sync":
+        command = [sys.executable, "-m", "gunicorn", "-b", f"127.0.0.1:{args.port}", "-w", "1", "--threads", "4", "--timeout", "600", "app:app"]
+    else:
+        command = [sys.executable, "-m", "uvicorn", "async_app:app", "--port", str(args.port), "--log-level", "warning", "--timeout-graceful-shutdown", "1"]
+    process = loadgen.start_server(command, base_url, dict(os.environ))
+    try:
+        with httpx.Client(base_url=base_url, timeout=None) as client:
+            token = client.post("/login", json={"username": seed.benchmark_username(0), "password": seed.BENCHMARK_PASSWORD}).json()["access_token"]
+            headers = {"Authorization": f"Bearer {token}"}
+
+            def report(name, rows, elapsed):
+                print(f"{name:<28} {rows:>9} rows  {elapsed:7.2f} s  {rows / elapsed:>10,.0f} rows/s  server peak RSS {peak_rss(process)}")
+
+            def import_rows(name, body, format):
+                start = time.perf_counter()
+                response = client.post(f"/tasks/import?format={format}", content=body, headers=headers)
+                response.raise_for_status()
+                report(name, response.json()["imported"], time.perf_counter() - start)
+
+            def export_rows(name, url):
+                start = time.perf_counter()
+                lines = 0
+                with client.stream("GET", url, headers=headers) as response:
+                    response.raise_for_status()
+                    for chunk in response.iter_bytes():
+                        lines += chunk.count(b"\n")
+                report(name, lines, time.perf_counter() - start)
+
+            start = time.perf_counter()
+            for body in ndjson_rows(args.rows):
+                tasks = [{"title": f"bulk-task-{i}", "description": "Synthetic bulk task", "due_date": "2025-01-01T00:00:00", "is_completed": False} for i in range(body.count(b"\n"))]
+                client.post("/tasks/batch", json={"tasks": tasks}, headers=headers).raise_for_status()
+            report("POST /tasks/batch", args.rows, time.perf_counter() - start)
+
+            import_rows("POST /tasks/import (ndjson)", ndjson_rows(args.rows), "ndjson")
+            import_rows("POST /tasks/import (csv)", csv_rows(args.rows), "csv")
+
+            export_rows("GET /tasks?format=ndjson", "/tasks?format=ndjson")
+            export_rows("GET /tasks/export (ndjson)", "/tasks/export")
+            export_rows("GET /tasks/export (csv)", "/tasks/export?format=csv")
+    finally:
+        loadgen.stop_server(process)
+
+if __name__ == "__main__":
+    main()
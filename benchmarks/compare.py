@@ -0,0 +1,56 @@
+import sys
+import json
+import argparse
+
+# Flags regressions of a benchmark result against a stored baseline, exits with 1 if any are found, e.g.
+# 'python -m benchmarks.compare benchmarks/baseline.json benchmarks/results/current.json'
+
+def percent_change(baseline, current):
+    if baseline in (None, 0) or current is None: return None
+    return (current - baseline) / baseline * 100
+
+def compare(baseline, current, max_throughput_drop, max_latency_increase, max_query_increase):
+    # Returns (scenario, metric, baseline, current, change %, regressed) rows
+    rows = []
+    for scenario, base in baseline["scenarios"].items():
+        result = current["scenarios"].get(scenario)
+        if result is None: continue
+
+        change = percent_change(base["throughput_rps"], result["throughput_rps"])
+        rows.append((scenario, "throughput_rps", base["throughput_rps"], result["throughput_rps"], change, change is not None and change < -max_throughput_drop))
+
+        for percentile in ("p50", "p95", "p99"):
+            change = percent_change(base["latency_ms"][percentile], result["latency_ms"][percentile])
+            rows.append((scenario, f"{percentile}_ms", base["latency_ms"][percentile], result["latency_ms"][percentile], change, change is not None and change > max_latency_increase))
+
+        base_queries, queries = base.get("db_queries_per_request"), result.get("db_queries_per_request")
+        regressed = base_queries is not None and queries is not None and queries > base_queries + max_query_increase
+        rows.append((scenario, "db_queries_per_request", base_queries, queries, percent_change(base_queries, queries), regressed))
+
+    return rows
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare benchmark results against a baseline")
+    parser.add_argument("baseline")
+    parser.add_argument("current")
+    parser.add_argument("--max-throughput-drop", type=float, default=10, help="allowed throughput drop in percent")
+    parser.add_argument("--max-latency-increase", type=float, default=15, help="allowed latency increase in percent")
+    parser.add_argument("--max-query-increase", type=float, default=0, help="allowed increase in queries per request")
+    args = parser.parse_args()
+
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    with open(args.current) as f:
+        current = json.load(f)
+
+    rows = compare(baseline, current, args.max_throughput_drop, args.max_latency_increase, args.max_query_increase)
+    for scenario, metric, base, result, change, regressed in rows:
+        change = f"{change:+.1f}%" if change is not None else "n/a"
+        print(f"{scenario:>12} {metric:>22}: {base} -> {result} ({change}){'  REGRESSION' if regressed else ''}")
+
+    regressions = sum(1 for row in rows if row[5])
+    print(f"{regressions} regression(s)")
+    sys.exit(1 if regressions else 0)
+
+if __name__ == "__main__":
+    main()
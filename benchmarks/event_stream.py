@@ -0,0 +1,78 @@
+import os
+import sys
+import time
+import asyncio
+import argparse
+import statistics
+
+import httpx
+from dotenv import load_dotenv
+
+import migrations
+from benchmarks import loadgen, seed
+
+# Holds many idle GET /tasks/stream subscribers on the async app (uvicorn async_app:app) and measures how
+# long a task change takes to reach all of them, e.g.
+# 'python -m benchmarks.event_stream --env .env.testing --subscribers 2000 --rounds 5'
+
+async def subscribe(client, headers, ready, received, rounds):
+    async with client.stream("GET", "/tasks/stream", headers=headers) as response:
+        response.raise_for_status()
+        ready.release()
+        events = 0
+        async for line in response.aiter_lines():
+            if line.startswith("event: created"):
+                received[events].append(time.perf_counter())
+                events += 1
+                if events == rounds: return
+
+async def run(base_url, headers, subscribers, rounds):
+    limits = httpx.Limits(max_connections=subscribers + 1, max_keepalive_connections=subscribers + 1)
+    received = [[] for _ in range(rounds)]
+    async with httpx.AsyncClient(base_url=base_url, limits=limits, timeout=None) as client:
+        ready = asyncio.Semaphore(0)
+        tasks = [asyncio.create_task(subscribe(client, headers, ready, received, rounds)) for _ in range(subscribers)]
+        for _ in range(subscribers):
+            await ready.acquire()
+
+        latencies = []
+        for round_index in range(rounds):
+            start = time.perf_counter()
+            (await client.post("/tasks", json={"title": f"event-{round_index}"}, headers=headers)).raise_for_status()
+            while len(received[round_index]) < subscribers:
+                await asyncio.sleep(0.01)
+            latencies.append((max(received[round_index]) - start) * 1000)
+
+        await asyncio.gather(*tasks)
+    return latencies
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark task event fan-out to idle SSE subscribers")
+    parser.add_argument("--env", default=".env", help="dotenv file with the POSTGRES_* settings")
+    parser.add_argument("--subscribers", type=int, default=1000)
+    parser.add_argument("--rounds", type=int, default=5)
+    parser.add_argument("--port", type=int, default=5113)
+    args = parser.parse_args()
+
+    load_dotenv(args.env)
+    engine = seed.create_engine_from_env()
+    seed.seed(engine, 1, 0, reset=True)
+    migrations.migrate(engine)
+    engine.dispose()
+
+    base_url = f"http://127.0.0.1:{args.port}"
+    env = dict(os.environ, TASK_EVENTS_MAX_SUBSCRIBERS=str(args.subscribers + 100), TASK_EVENTS_KEEPALIVE="30")
+    process = loadgen.start_server([sys.executable, "-m", "uvicorn", "async_app:app", "--port", str(args.port), "--log-level", "warning", "--timeout-graceful-shutdown", "1", "--limit-concurrency", str(args.subscribers + 100)],
+                                   base_url, env)
+    try:
+        token = httpx.post(f"{base_url}/login", json={"username": seed.benchmark_username(0), "password": seed.BENCHMARK_PASSWORD}, timeout=60).json()["access_token"]
+        latencies = asyncio.run(run(base_url, {"Authorization": f"Bearer {token}"}, args.subscribers, args.rounds))
+        with open(f"/proc/{process.pid}/status") as f:
+            status = dict(line.split(":", 1) for line in f)
+        print(f"{args.subscribers} subscribers: event delivered to all in median {statistics.median(latencies):.0f} ms, max {max(latencies):.0f} ms; "
+              f"server threads {status['Threads'].strip()}, RSS {status['VmRSS'].strip()}")
+    finally:
+        loadgen.stop_server(process)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,80 @@
+import time
+import asyncio
+import subprocess
+
+import httpx
+
+# Closed-loop load generator: `concurrency` clients each send their next request as soon as the previous one completes
+
+def percentile(sorted_values, p):
+    if len(sorted_values) == 0: return None
+    index = min(len(sorted_values) - 1, int(round(p / 100 * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+def summarize(latencies, statuses, elapsed):
+    latencies = sorted(latencies)
+    return {
+        "requests": len(latencies),
+        "errors": sum(1 for status in statuses if status >= 400),
+        "throughput_rps": round(len(latencies) / elapsed, 1),
+        "latency_ms": {
+            "p50": round(percentile(latencies, 50) * 1000, 2) if latencies else None,
+            "p95": round(percentile(latencies, 95) * 1000, 2) if latencies else None,
+            "p99": round(percentile(latencies, 99) * 1000, 2) if latencies else None,
+            "max": round(latencies[-1] * 1000, 2) if latencies else None,
+        },
+    }
+
+async def _client_loop(client, send_request, worker, iterations, deadline, latencies, statuses):
+    # iterations[worker] keeps counting across warmup and measurement so requests never repeat
+    while time.perf_counter() < deadline:
+        start = time.perf_counter()
+        response = await send_request(client, worker, iterations[worker])
+        latencies.append(time.perf_counter() - start)
+        statuses.append(response.status_code)
+        iterations[worker] += 1
+
+async def run_load_async(base_url, send_request, concurrency, duration, warmup=1.0, iterations=None):
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    iterations = iterations if iterations is not None else [0] * concurrency
+    async with httpx.AsyncClient(base_url=base_url, limits=limits, timeout=60) as client:
+        if warmup > 0:
+            deadline = time.perf_counter() + warmup
+            await asyncio.gather(*[_client_loop(client, send_request, worker, iterations, deadline, [], []) for worker in range(concurrency)])
+
+        latencies, statuses = [], []
+        start = time.perf_counter()
+        deadline = start + duration
+        await asyncio.gather(*[_client_loop(client, send_request, worker, iterations, deadline, latencies, statuses) for worker in range(concurrency)])
+        return summarize(latencies, statuses, time.perf_counter() - start)
+
+def run_load(base_url, send_request, concurrency, duration, warmup=1.0, iterations=None):
+    # send_request(client, worker, iteration) -> awaitable httpx.Response, worker is the index of the simulated client.
+    # Pass the same iterations list to consecutive runs to continue the per-worker counters
+    return asyncio.run(run_load_async(base_url, send_request, concurrency, duration, warmup, iterations))
+
+# Load from a single address trips the per-client rate limits, they stay off unless the environment sets them
+RATE_LIMITS_DISABLED = {"RATE_LIMIT_USER": "0", "RATE_LIMIT_CLIENT": "0", "RATE_LIMIT_AUTH": "0"}
+
+def start_server(command, base_url, env, timeout=30, poll_interval=0.2):
+    process = subprocess.Popen(command, env={**RATE_LIMITS_DISABLED, **env}, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.perf_counter() + timeout
+    while time.perf_counter() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"Server exited with code {process.returncode}: {' '.join(command)}")
+        try:
+            if httpx.get(f"{base_url}/health", timeout=1).status_code == 200:
+                return process
+        except httpx.HTTPError:
+            pass
+        time.sleep(poll_interval)
+
+    process.terminate()
+    raise RuntimeError(f"Server did not become healthy within {timeout}s: {' '.join(command)}")
+
+def stop_server(process):
+    process.terminate()
+    try:
+        process.wait(timeout=10)
+    except subprocess.TimeoutExpired:
+        process.kill()
@@ -0,0 +1,65 @@
+import os
+import sys
+import time
+import argparse
+
+from dotenv import load_dotenv
+
+from benchmarks import loadgen, serving_modes
+
+# Overhead of the rate limiter: raw bucket checks per second, then GET /tasks on gunicorn with the limits
+# off and on (budgets large enough that nothing is rejected), e.g.
+# 'python -m benchmarks.rate_limiting --env .env.testing --concurrency 50 --duration 10'
+
+def bench_store(keys, iterations):
+    import ratelimit
+
+    limiter = ratelimit.RateLimiter(ratelimit.create_rate_limit_store("benchmark_rate_limit"), {"user": (10 ** 9, 10 ** 9)})
+    start = time.perf_counter()
+    for i in range(iterations):
+        limiter.check("user", i % keys)
+    elapsed = time.perf_counter() - start
+    limiter.clear()
+    return elapsed / iterations
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark rate limiter overhead")
+    parser.add_argument("--env", default=".env", help="dotenv file with the POSTGRES_* settings")
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--duration", type=float, default=10)
+    parser.add_argument("--threads", type=int, default=8, help="gunicorn threads per worker")
+    parser.add_argument("--keys", type=int, default=10000, help="distinct users in the bucket check loop")
+    parser.add_argument("--iterations", type=int, default=200000)
+    parser.add_argument("--port", type=int, default=5114)
+    args = parser.parse_args()
+
+    load_dotenv(args.env)
+    per_check = bench_store(args.keys, args.iterations)
+    backend = "redis" if os.environ.get("CACHE_REDIS_URL") else "memory"
+    print(f"bucket check ({backend}): {per_check * 1e6:.2f} us, {1 / per_check:,.0f} checks/s")
+
+    base_url = f"http://127.0.0.1:{args.port}"
+    command = [sys.executable, "-m", "gunicorn", "-b", f"127.0.0.1:{args.port}", "-w", "1", "--threads", str(args.threads), "app:app"]
+    limits = {
+        "off": loadgen.RATE_LIMITS_DISABLED,
+        "on": {"RATE_LIMIT_USER": "1000000000/1", "RATE_LIMIT_CLIENT": "1000000000/1", "RATE_LIMIT_AUTH": "1000000000/1"},
+    }
+    headers = None
+    for name, limit_env in limits.items():
+        process = loadgen.start_server(command, base_url, dict(os.environ, **limit_env))
+        try:
+            if headers is None:
+                headers = serving_modes.bootstrap(base_url, 50)
+
+            async def get_tasks(client, worker, iteration):
+                return await client.get("/tasks", headers=headers)
+
+            result = loadgen.run_load(base_url, get_tasks, args.concurrency, args.duration)
+        finally:
+            loadgen.stop_server(process)
+
+        latency = result["latency_ms"]
+        print(f"limits {name:>3}: {result['throughput_rps']:>8} req/s  p50 {latency['p50']} ms  p99 {latency['p99']} ms  errors {result['errors']}/{result['requests']}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,76 @@
+import os
+import random
+import argparse
+import datetime
+
+import bcrypt
+import sqlalchemy as sa
+from dotenv import load_dotenv
+
+import db
+
+# Seeds synthetic users and tasks for benchmarking, e.g.
+# 'python -m benchmarks.seed --env .env.testing --users 100 --tasks 1000 --reset'
+
+BENCHMARK_PASSWORD = "benchmark-password"
+INSERT_CHUNK_SIZE = 10000
+
+def benchmark_username(index):
+    return f"bench-user-{index}"
+
+def create_engine_from_env():
+    return db.create_db_engine(os.environ.get("POSTGRES_HOST"), os.environ.get("POSTGRES_PORT"), os.environ.get("POSTGRES_USER"), os.environ.get("POSTGRES_PASSWORD"), os.environ.get("POSTGRES_DB"))
+
+def seed(engine, users, tasks_per_user, seed=0, reset=False):
+    # Returns {username: [task ids]}, generated data only depends on the arguments
+    rng = random.Random(seed)
+    if reset:
+        db.recreate_test_schema(engine)
+
+    # One hash for all users, with the server's cost so logins do not trigger rehashing
+    password_hash = bcrypt.hashpw(BENCHMARK_PASSWORD.encode(), bcrypt.gensalt(int(os.environ.get("BCRYPT_ROUNDS", 12)))).decode()
+    start_date = datetime.datetime(2025, 1, 1)
+
+    task_ids = {}
+    with engine.begin() as connection:
+        query = db.user_table.insert().returning(db.user_table.c.id, sort_by_parameter_order=True)
+        user_ids = connection.execute(query, [{"username": benchmark_username(i), "password_hash": password_hash} for i in range(users)]).scalars().all()
+
+        rows = []
+        for user_index, user_id in enumerate(user_ids):
+            for task_index in range(tasks_per_user):
+                rows.append({
+                    "user_id": user_id,
+                    "title": f"Task {task_index} of {benchmark_username(user_index)}",
+                    "description": "Synthetic benchmark task " * rng.randint(1, 8),
+                    "due_date": start_date + datetime.timedelta(minutes=rng.randint(0, 60 * 24 * 365)) if rng.random() < 0.8 else None,
+                    "is_completed": rng.random() < 0.3,
+                })
+
+        query = db.task_table.insert().returning(db.task_table.c.user_id, db.task_table.c.id, sort_by_parameter_order=True)
+        usernames = {user_id: benchmark_username(i) for i, user_id in enumerate(user_ids)}
+        for start in range(0, len(rows), INSERT_CHUNK_SIZE):
+            for user_id, task_id in connection.execute(query, rows[start:start + INSERT_CHUNK_SIZE]):
+                task_ids.setdefault(usernames[user_id], []).append(task_id)
+
+        connection.execute(sa.text('ANALYZE "User"'))
+        connection.execute(sa.text('ANALYZE "Task"'))
+
+    return task_ids
+
+def main():
+    parser = argparse.ArgumentParser(description="Seed synthetic benchmark data")
+    parser.add_argument("--env", default=".env", help="dotenv file with the POSTGRES_* settings")
+    parser.add_argument("--users", type=int, default=100)
+    parser.add_argument("--tasks", type=int, default=1000, help="tasks per user")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--reset", action="store_true", help="drop and recreate the schema first")
+    args = parser.parse_args()
+
+    load_dotenv(args.env)
+    engine = create_engine_from_env()
+    task_ids = seed(engine, args.users, args.tasks, args.seed, args.reset)
+    print(f"Seeded {len(task_ids)} users with {sum(len(ids) for ids in task_ids.values())} tasks")
+
+if __name__ == "__main__":
+    main()
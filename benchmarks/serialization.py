@@ -0,0 +1,58 @@
+import time
+import random
+import datetime
+import argparse
+
+from flask import Flask
+from flask.json.provider import DefaultJSONProvider
+
+import db
+import json_encoding
+
+# Rows/sec of the task read path after the query: mapping rows to dicts and encoding the JSON body, e.g.
+# 'python -m benchmarks.serialization --rows 10000'. Compares the previous per-field indexing with Flask's
+# default JSON provider against db.task_rows_to_dicts with json_encoding (orjson when installed).
+
+def make_rows(count, seed=0):
+    rng = random.Random(seed)
+    start_date = datetime.datetime(2025, 1, 1)
+    return [(i, 1, f"Task {i}", "Synthetic benchmark task " * rng.randint(1, 8),
+             start_date + datetime.timedelta(minutes=rng.randint(0, 525600)) if rng.random() < 0.8 else None, rng.random() < 0.3)
+            for i in range(count)]
+
+def measure(func, repeat):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark task row mapping and JSON serialization")
+    parser.add_argument("--rows", type=int, default=10000)
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    rows = make_rows(args.rows)
+    tasks = db.task_rows_to_dicts(rows)
+    app = Flask(__name__)
+    default_json, fast_json = DefaultJSONProvider(app), json_encoding.FastJSONProvider(app)
+
+    cases = {
+        "map per field": lambda: [db.task_row_to_dict(task) for task in rows],
+        "map task_rows_to_dicts": lambda: db.task_rows_to_dicts(rows),
+        "encode flask default": lambda: default_json.response(tasks).get_data(),
+        "encode json_encoding": lambda: fast_json.response(tasks).get_data(),
+        "total before": lambda: default_json.response([db.task_row_to_dict(task) for task in rows]).get_data(),
+        "total after": lambda: fast_json.response(db.task_rows_to_dicts(rows)).get_data(),
+    }
+
+    print(f"{args.rows} tasks, best of {args.repeat}, orjson {'on' if json_encoding.orjson else 'off'}, JSON_DATETIME_FORMAT={json_encoding.JSON_DATETIME_FORMAT}")
+    with app.app_context():
+        for name, func in cases.items():
+            elapsed = measure(func, args.repeat)
+            print(f"{name:>24}: {args.rows / elapsed:>12,.0f} rows/s ({elapsed * 1000:.1f} ms)")
+
+if __name__ == "__main__":
+    main()
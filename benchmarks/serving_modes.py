@@ -0,0 +1,74 @@
+import os
+import sys
+import json
+import argparse
+
+import httpx
+from dotenv import load_dotenv
+
+from benchmarks import loadgen
+
+# Compares the sync (gunicorn app:app) and async (uvicorn async_app:app) serving modes on GET /tasks
+# at high concurrency. Run from the repository root against a disposable database, e.g.
+# 'python -m benchmarks.serving_modes --env .env.testing --concurrency 200 --duration 20'
+
+def bootstrap(base_url, task_count):
+    with httpx.Client(base_url=base_url, timeout=60) as client:
+        client.post("/register", json={"username": "benchmark-user", "password": "benchmark-password"})
+        response = client.post("/login", json={"username": "benchmark-user", "password": "benchmark-password"})
+        response.raise_for_status()
+        headers = {"Authorization": f"Bearer {response.json()['access_token']}"}
+
+        for start in range(0, task_count, 1000):
+            tasks = [{"title": f"benchmark-task-{i}", "description": "benchmark"} for i in range(start, min(task_count, start + 1000))]
+            client.post("/tasks/batch", json={"tasks": tasks}, headers=headers).raise_for_status()
+
+    return headers
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--env", default=".env", help="dotenv file with the POSTGRES_* settings")
+    parser.add_argument("--concurrency", type=int, default=200)
+    parser.add_argument("--duration", type=float, default=20)
+    parser.add_argument("--tasks", type=int, default=50, help="tasks returned by each GET /tasks")
+    parser.add_argument("--workers", type=int, default=1, help="worker processes per server")
+    parser.add_argument("--threads", type=int, default=8, help="gunicorn threads per worker (sync mode)")
+    parser.add_argument("--sync-port", type=int, default=5101)
+    parser.add_argument("--async-port", type=int, default=5102)
+    parser.add_argument("--output", help="write results as JSON to this file")
+    args = parser.parse_args()
+
+    load_dotenv(args.env)
+    env = dict(os.environ)
+
+    modes = {
+        "sync": [sys.executable, "-m", "gunicorn", "-b", f"127.0.0.1:{args.sync_port}", "-w", str(args.workers), "--threads", str(args.threads), "app:app"],
+        "async": [sys.executable, "-m", "uvicorn", "async_app:app", "--host", "127.0.0.1", "--port", str(args.async_port), "--workers", str(args.workers), "--log-level", "warning"],
+    }
+    urls = {"sync": f"http://127.0.0.1:{args.sync_port}", "async": f"http://127.0.0.1:{args.async_port}"}
+
+    results = {"config": vars(args), "modes": {}}
+    headers = None
+    for mode, command in modes.items():
+        process = loadgen.start_server(command, urls[mode], env)
+        try:
+            if headers is None:
+                headers = bootstrap(urls[mode], args.tasks)
+
+            async def get_tasks(client, worker, iteration):
+                return await client.get("/tasks", headers=headers)
+
+            results["modes"][mode] = loadgen.run_load(urls[mode], get_tasks, args.concurrency, args.duration)
+        finally:
+            loadgen.stop_server(process)
+
+    for mode, result in results["modes"].items():
+        latency = result["latency_ms"]
+        print(f"{mode:>5}: {result['throughput_rps']:>8} req/s  p50 {latency['p50']} ms  p99 {latency['p99']} ms  errors {result['errors']}/{result['requests']}")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+if __name__ == "__main__":
+    main()
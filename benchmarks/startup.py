@@ -0,0 +1,57 @@
+import os
+import sys
+import time
+import argparse
+import statistics
+import subprocess
+
+from dotenv import load_dotenv
+
+import migrations
+from benchmarks import loadgen, seed
+
+# Measures worker cold start (importing app.py and gunicorn boot until /health answers) for growing
+# amounts of stored tasks, e.g. 'python -m benchmarks.startup --env .env.testing --sizes 0,100000,1000000'.
+# Startup must not touch the data, so the times should stay flat as the tables grow.
+
+def time_import(env):
+    start = time.perf_counter()
+    subprocess.run([sys.executable, "-c", "import app"], env=env, check=True, stdout=subprocess.DEVNULL)
+    return time.perf_counter() - start
+
+def time_boot(command, base_url, env):
+    start = time.perf_counter()
+    process = loadgen.start_server(command, base_url, env, poll_interval=0.01)
+    elapsed = time.perf_counter() - start
+    loadgen.stop_server(process)
+    return elapsed
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark worker cold start against the stored data size")
+    parser.add_argument("--env", default=".env", help="dotenv file with the POSTGRES_* settings")
+    parser.add_argument("--sizes", default="0,10000,100000", help="comma separated total task counts")
+    parser.add_argument("--users", type=int, default=100)
+    parser.add_argument("--workers", type=int, default=4, help="gunicorn workers")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--port", type=int, default=5112)
+    args = parser.parse_args()
+
+    load_dotenv(args.env)
+    env = dict(os.environ)
+    base_url = f"http://127.0.0.1:{args.port}"
+    command = [sys.executable, "-m", "gunicorn", "-b", f"127.0.0.1:{args.port}", "-w", str(args.workers), "app:app"]
+    engine = seed.create_engine_from_env()
+
+    for size in (int(size) for size in args.sizes.split(",")):
+        seed.seed(engine, args.users, size // args.users, reset=True)
+        migrations.migrate(engine)
+
+        import_times = [time_import(env) for _ in range(args.repeat)]
+        boot_times = [time_boot(command, base_url, env) for _ in range(args.repeat)]
+        print(f"{size:>10} tasks: import app {statistics.median(import_times) * 1000:.0f} ms, "
+              f"gunicorn -w {args.workers} until healthy {statistics.median(boot_times) * 1000:.0f} ms (median of {args.repeat})")
+
+    engine.dispose()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,148 @@
+import os
+import sys
+import json
+import math
+import argparse
+import datetime
+import subprocess
+
+import httpx
+from dotenv import load_dotenv
+from prometheus_client.parser import text_string_to_metric_families
+
+from benchmarks import loadgen, seed
+
+# Drives the real endpoints at a fixed concurrency against freshly seeded data and records throughput,
+# latency percentiles and database queries per request (from /metrics), e.g.
+# 'python -m benchmarks.suite --env .env.testing --users 50 --tasks 1000 --output benchmarks/results/current.json'
+# Compare two result files with 'python -m benchmarks.compare'.
+
+SCENARIOS = ("register", "login", "get_tasks", "post_task", "put_task", "delete_task")
+
+def db_query_count(client):
+    # Total queries executed by the server so far, summed over db.py functions
+    total = 0
+    for family in text_string_to_metric_families(client.get("/metrics").text):
+        if family.name == "db_query_duration_seconds":
+            total += sum(sample.value for sample in family.samples if sample.name.endswith("_count"))
+    return total
+
+def login_users(base_url, usernames):
+    tokens = []
+    with httpx.Client(base_url=base_url, timeout=60) as client:
+        for username in usernames:
+            response = client.post("/login", json={"username": username, "password": seed.BENCHMARK_PASSWORD})
+            response.raise_for_status()
+            tokens.append({"Authorization": f"Bearer {response.json()['access_token']}"})
+    return tokens
+
+def build_scenarios(run_id, usernames, tokens, task_ids, concurrency):
+    # Workers are spread over the logged in users, workers sharing a user take turns through its task ids
+    workers_per_user = math.ceil(concurrency / len(tokens))
+
+    def user_of(worker):
+        return worker % len(tokens)
+
+    def task_id_of(worker, iteration):
+        ids = task_ids[usernames[user_of(worker)]]
+        index = iteration * workers_per_user + worker // len(tokens)
+        return ids[index] if index < len(ids) else 0
+
+    async def register(client, worker, iteration):
+        return await client.post("/register", json={"username": f"bench-register-{run_id}-{worker}-{iteration}", "password": seed.BENCHMARK_PASSWORD})
+
+    async def login(client, worker, iteration):
+        return await client.post("/login", json={"username": usernames[(worker + iteration) % len(usernames)], "password": seed.BENCHMARK_PASSWORD})
+
+    async def get_tasks(client, worker, iteration):
+        return await client.get("/tasks", headers=tokens[user_of(worker)])
+
+    async def post_task(client, worker, iteration):
+        return await client.post("/tasks", json={"title": f"bench-task-{worker}-{iteration}", "description": "created by benchmark"}, headers=tokens[user_of(worker)])
+
+    async def put_task(client, worker, iteration):
+        task_ids_of_user = task_ids[usernames[user_of(worker)]]
+        task_id = task_ids_of_user[(iteration * workers_per_user + worker // len(tokens)) % len(task_ids_of_user)]
+        return await client.put(f"/tasks/{task_id}", json={"title": f"bench-updated-{iteration}", "is_completed": iteration % 2 == 0}, headers=tokens[user_of(worker)])
+
+    async def delete_task(client, worker, iteration):
+        return await client.delete(f"/tasks/{task_id_of(worker, iteration)}", headers=tokens[user_of(worker)])
+
+    return {"register": register, "login": login, "get_tasks": get_tasks, "post_task": post_task, "put_task": put_task, "delete_task": delete_task}
+
+def run_scenario(base_url, send_request, concurrency, duration, warmup):
+    iterations = [0] * concurrency
+    if warmup > 0:
+        loadgen.run_load(base_url, send_request, concurrency, warmup, warmup=0, iterations=iterations)
+
+    with httpx.Client(base_url=base_url, timeout=60) as client:
+        queries_before = db_query_count(client)
+        result = loadgen.run_load(base_url, send_request, concurrency, duration, warmup=0, iterations=iterations)
+        queries = db_query_count(client) - queries_before
+
+    result["db_queries_per_request"] = round(queries / result["requests"], 2) if result["requests"] else None
+    return result
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], text=True, stderr=subprocess.DEVNULL).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the API endpoints")
+    parser.add_argument("--env", default=".env", help="dotenv file with the POSTGRES_* settings")
+    parser.add_argument("--url", help="benchmark an already running server instead of starting gunicorn")
+    parser.add_argument("--port", type=int, default=5111)
+    parser.add_argument("--workers", type=int, default=1, help="gunicorn workers")
+    parser.add_argument("--threads", type=int, default=8, help="gunicorn threads per worker")
+    parser.add_argument("--users", type=int, default=50, help="seeded users")
+    parser.add_argument("--tasks", type=int, default=1000, help="seeded tasks per user")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--duration", type=float, default=15, help="seconds per scenario")
+    parser.add_argument("--warmup", type=float, default=2, help="seconds of warmup per scenario")
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS), help="comma separated subset of " + ", ".join(SCENARIOS))
+    parser.add_argument("--output", help="result file (default benchmarks/results/<timestamp>.json)")
+    args = parser.parse_args()
+
+    load_dotenv(args.env)
+    scenarios = args.scenarios.split(",")
+    for scenario in scenarios:
+        if scenario not in SCENARIOS: parser.error(f"unknown scenario '{scenario}'")
+
+    base_url = args.url or f"http://127.0.0.1:{args.port}"
+    process = None
+    if args.url is None:
+        command = [sys.executable, "-m", "gunicorn", "-b", f"127.0.0.1:{args.port}", "-w", str(args.workers), "--threads", str(args.threads), "app:app"]
+        process = loadgen.start_server(command, base_url, dict(os.environ))
+
+    try:
+        task_ids = seed.seed(seed.create_engine_from_env(), args.users, args.tasks, args.seed, reset=True)
+        usernames = [seed.benchmark_username(i) for i in range(args.users)]
+        tokens = login_users(base_url, usernames[:min(args.users, args.concurrency)])
+        run_id = datetime.datetime.now().strftime("%Y%m%d%H%M%S")
+        send_requests = build_scenarios(run_id, usernames, tokens, task_ids, args.concurrency)
+
+        results = {
+            "meta": {"timestamp": datetime.datetime.now().isoformat(), "git_commit": git_commit(), "config": vars(args)},
+            "scenarios": {},
+        }
+        for scenario in scenarios:
+            result = run_scenario(base_url, send_requests[scenario], args.concurrency, args.duration, args.warmup)
+            results["scenarios"][scenario] = result
+            latency = result["latency_ms"]
+            print(f"{scenario:>12}: {result['throughput_rps']:>8} req/s  p50 {latency['p50']} ms  p95 {latency['p95']} ms  p99 {latency['p99']} ms  "
+                  f"{result['db_queries_per_request']} queries/req  errors {result['errors']}/{result['requests']}")
+    finally:
+        if process is not None:
+            loadgen.stop_server(process)
+
+    output = args.output or os.path.join("benchmarks", "results", f"{run_id}.json")
+    os.makedirs(os.path.dirname(output) or ".", exist_ok=True)
+    with open(output, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"Results written to {output}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,93 @@
+import os
+import time
+import threading
+from collections import OrderedDict
+
+class TTLCache:
+    """ Bounded in-process LRU cache where entries expire after ttl seconds """
+
+    def __init__(self, maxsize=10000, ttl=60, clock=time.monotonic):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.clock = clock
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[1] <= self.clock():
+                if entry is not None: del self._entries[key]
+                self.misses += 1
+                return None
+
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = (value, self.clock() + self.ttl)
+            self._entries.move_to_end(key)
+            # Evict least recently used entries to keep memory bounded
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        return {"backend": "memory", "size": len(self._entries), "maxsize": self.maxsize, "hits": self.hits, "misses": self.misses}
+
+class RedisCache:
+    """ Cache shared between worker processes, entries expire after ttl seconds """
+
+    def __init__(self, url, namespace, ttl=60):
+        # Optional dependency, only needed when a shared backend is configured
+        import redis
+
+        self.client = redis.Redis.from_url(url)
+        self.namespace = namespace
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+
+    def _key(self, key):
+        return f"{self.namespace}:{key}"
+
+    def get(self, key):
+        value = self.client.get(self._key(key))
+        if value is None:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        return value.decode()
+
+    def set(self, key, value):
+        self.client.set(self._key(key), value, ex=self.ttl)
+
+    def delete(self, key):
+        self.client.delete(self._key(key))
+
+    def clear(self):
+        for key in self.client.scan_iter(match=self._key("*")):
+            self.client.delete(key)
+
+    def stats(self):
+        return {"backend": "redis", "hits": self.hits, "misses": self.misses}
+
+def create_cache(namespace, maxsize=10000, ttl=60):
+    # With CACHE_REDIS_URL set all gunicorn workers share entries (and invalidations)
+    redis_url = os.environ.get("CACHE_REDIS_URL")
+    if redis_url:
+        return RedisCache(redis_url, namespace, ttl)
+
+    return TTLCache(maxsize, ttl)
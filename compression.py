@@ -0,0 +1,161 @@
+import os
+import zlib
+
+# Response compression negotiated from Accept-Encoding, shared by app.py (after_request hook) and
+# async_app.py (ASGI middleware). Brotli is used when the optional brotli package is installed and the
+# client accepts it, gzip otherwise. Bodies below COMPRESSION_MIN_SIZE bytes are sent as they are, streamed
+# listings are compressed chunk by chunk (flushed, so clients still receive every chunk right away) and
+# event streams are never compressed.
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+COMPRESSION_MIN_SIZE = int(os.environ.get("COMPRESSION_MIN_SIZE", 1024))
+COMPRESSION_GZIP_LEVEL = int(os.environ.get("COMPRESSION_GZIP_LEVEL", 6))
+COMPRESSION_BROTLI_QUALITY = int(os.environ.get("COMPRESSION_BROTLI_QUALITY", 4))
+# Comma separated in order of preference, empty disables compression
+COMPRESSION_ENCODINGS = [encoding.strip() for encoding in os.environ.get("COMPRESSION_ENCODINGS", "br,gzip").split(",") if encoding.strip() != ""]
+
+COMPRESSIBLE_TYPES = ("application/json", "application/x-ndjson", "text/csv", "text/plain", "text/html")
+
+def available_encodings():
+    return [encoding for encoding in COMPRESSION_ENCODINGS if encoding == "gzip" or (encoding == "br" and brotli is not None)]
+
+def choose_encoding(accept_encoding):
+    # Preferred available encoding the client accepts (q > 0), or None
+    if not accept_encoding: return None
+    accepted = {}
+    for item in accept_encoding.split(","):
+        name, _, params = item.strip().partition(";")
+        quality = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                quality = float(params[2:])
+            except ValueError:
+                quality = 0.0
+        accepted[name.strip().lower()] = quality
+
+    for encoding in available_encodings():
+        if accepted.get(encoding, accepted.get("*", 0)) > 0:
+            return encoding
+    return None
+
+def is_compressible(content_type):
+    return content_type is not None and content_type.split(";")[0].strip().lower() in COMPRESSIBLE_TYPES
+
+def compress(data, encoding):
+    if encoding == "br":
+        return brotli.compress(data, quality=COMPRESSION_BROTLI_QUALITY)
+    return zlib.compress(data, COMPRESSION_GZIP_LEVEL, wbits=31)
+
+class StreamCompressor:
+    """ Compresses a body chunk by chunk, every chunk is flushed so it reaches the client without waiting for more """
+
+    def __init__(self, encoding):
+        self.encoding = encoding
+        if encoding == "br":
+            self._compressor = brotli.Compressor(quality=COMPRESSION_BROTLI_QUALITY)
+        else:
+            self._compressor = zlib.compressobj(COMPRESSION_GZIP_LEVEL, zlib.DEFLATED, 31)
+
+    def compress(self, chunk):
+        if self.encoding == "br":
+            return self._compressor.process(chunk) + self._compressor.flush()
+        return self._compressor.compress(chunk) + self._compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self):
+        if self.encoding == "br":
+            return self._compressor.finish()
+        return self._compressor.flush(zlib.Z_FINISH)
+
+def compress_chunks(chunks, encoding):
+    compressor = StreamCompressor(encoding)
+    try:
+        for chunk in chunks:
+            data = compressor.compress(chunk.encode() if isinstance(chunk, str) else chunk)
+            if data: yield data
+        yield compressor.finish()
+    finally:
+        # Lets the wrapped generator release its connection when the client goes away
+        if hasattr(chunks, "close"): chunks.close()
+
+##################################################
+
+from flask import request
+
+def compress_flask_response(response):
+    if not is_compressible(response.content_type) or "Content-Encoding" in response.headers: return response
+    response.vary.add("Accept-Encoding")
+    if response.status_code < 200 or response.status_code in (204, 304): return response
+    encoding = choose_encoding(request.headers.get("Accept-Encoding"))
+    if encoding is None: return response
+
+    if response.is_streamed:
+        response.response = compress_chunks(response.response, encoding)
+        response.headers.pop("Content-Length", None)
+    else:
+        data = response.get_data()
+        if len(data) < COMPRESSION_MIN_SIZE: return response
+        response.set_data(compress(data, encoding))
+    response.headers["Content-Encoding"] = encoding
+    return response
+
+def instrument_flask(app):
+    app.after_request(compress_flask_response)
+
+class CompressionMiddleware:
+    """ ASGI middleware applying the same policy as compress_flask_response """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        accept_encoding = next((value.decode("latin-1") for name, value in scope["headers"] if name == b"accept-encoding"), None)
+        encoding = choose_encoding(accept_encoding)
+        start = None
+        compressor = None
+
+        async def send_compressed(message):
+            nonlocal start, compressor
+            if message["type"] == "http.response.start":
+                # Held back until the first body message tells whether the response is streamed
+                start = message
+                return
+            if message["type"] != "http.response.body":
+                return await send(message)
+            body, more_body = message.get("body", b""), message.get("more_body", False)
+
+            if start is not None:
+                response_start, start = start, None
+                headers = list(response_start["headers"])
+                content_type = next((value.decode("latin-1") for name, value in headers if name == b"content-type"), None)
+                compressible = is_compressible(content_type) and all(name != b"content-encoding" for name, _ in headers)
+                if compressible: headers.append((b"vary", b"Accept-Encoding"))
+                if (not compressible or encoding is None or response_start["status"] < 200 or response_start["status"] in (204, 304)
+                        or (not more_body and len(body) < COMPRESSION_MIN_SIZE)):
+                    await send({**response_start, "headers": headers})
+                    return await send(message)
+
+                headers = [(name, value) for name, value in headers if name != b"content-length"] + [(b"content-encoding", encoding.encode())]
+                if not more_body:
+                    body = compress(body, encoding)
+                    await send({**response_start, "headers": headers + [(b"content-length", str(len(body)).encode())]})
+                    return await send({"type": "http.response.body", "body": body})
+                await send({**response_start, "headers": headers})
+                compressor = StreamCompressor(encoding)
+
+            if compressor is None:
+                return await send(message)
+            data = compressor.compress(body)
+            if more_body:
+                if data: await send({"type": "http.response.body", "body": data, "more_body": True})
+            else:
+                await send({"type": "http.response.body", "body": data + compressor.finish()})
+
+        await self.app(scope, receive, send_compressed)
@@ -1,9 +1,29 @@
 import os
-from dotenv import load_dotenv
+import sys
+import re
+import time
+import csv
+import json
+import queue
+import weakref
+import threading
+import base64
+import binascii
+import datetime
+import contextvars
+from functools import wraps
+import psycopg2
 import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
 
 from InvalidInputException import InvalidInputException
 
+# orjson parses imported NDJSON lines when installed (see json_encoding.py)
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    json_loads = json.loads
+
 metadata = sa.MetaData()
 
 user_table = sa.Table("User",
@@ -11,6 +31,8 @@ user_table = sa.Table("User",
                      sa.Column("id", sa.Integer, primary_key=True),
                       sa.Column("username", sa.String, unique=True),
                      sa.Column("password_hash", sa.String),
+                     # Bumped in the same transaction as every write to the user's tasks (used for ETags)
+                     sa.Column("task_version", sa.BigInteger, nullable=False, server_default="0"),
                      )
 
 task_table = sa.Table("Task",
@@ -21,23 +43,161 @@ task_table = sa.Table("Task",
                      sa.Column("description", sa.String),
                      sa.Column("due_date", sa.DateTime),
                      sa.Column("is_completed", sa.Boolean),
+                     # Set by the task_completed_at triggers when is_completed turns true, cleared when it turns false again
+                     sa.Column("completed_at", sa.DateTime),
+                     )
+
+# Completed tasks moved out of Task by the archiver (archive.py), keeping their ids. Read-only, only listed on request
+task_archive_table = sa.Table("TaskArchive",
+                     metadata,
+                     sa.Column("id", sa.Integer, primary_key=True, autoincrement=False),
+                     sa.Column("user_id", sa.Integer, sa.ForeignKey("User.id")),
+                     sa.Column("title", sa.String),
+                     sa.Column("description", sa.String),
+                     sa.Column("due_date", sa.DateTime),
+                     sa.Column("is_completed", sa.Boolean),
+                     sa.Column("completed_at", sa.DateTime),
+                     sa.Column("archived_at", sa.DateTime, nullable=False, server_default=sa.func.now()),
+                     )
+
+# Shard of every user, kept on the first database (shard 0). Resolves usernames at login when users are
+# spread over several databases (see shards.py), with a single database every user is on shard 0
+user_directory_table = sa.Table("UserDirectory",
+                     metadata,
+                     sa.Column("user_id", sa.Integer, primary_key=True, autoincrement=False),
+                     sa.Column("username", sa.String, nullable=False, unique=True),
+                     sa.Column("shard", sa.Integer, nullable=False, server_default="0"),
                      )
 
-def create_db_connection(host, port, username, password, dbname):
+# Full-text document of a task, title terms rank above description terms. Indexed as an expression (GIN), so
+# Postgres keeps it in sync on every insert/update without widening the rows the task listings read.
+# Queries must use this exact expression for the index to apply
+TASK_SEARCH_VECTOR_SQL = "(setweight(to_tsvector('simple'::regconfig, coalesce(title, '')), 'A') || setweight(to_tsvector('simple'::regconfig, coalesce(description, '')), 'B'))"
+task_search_vector = sa.literal_column(TASK_SEARCH_VECTOR_SQL, postgresql.TSVECTOR)
+
+# Composite indexes backing the per-user task listings (keyset on id / due_date) and open task filter
+sa.Index("ix_task_user_id_id", task_table.c.user_id, task_table.c.id)
+sa.Index("ix_task_user_id_due_date", task_table.c.user_id, task_table.c.due_date, task_table.c.id)
+sa.Index("ix_task_user_id_open", task_table.c.user_id, task_table.c.id, postgresql_where=task_table.c.is_completed.isnot(True))
+# Covers the task summary aggregate (index-only scan)
+sa.Index("ix_task_user_id_is_completed_due_date", task_table.c.user_id, task_table.c.is_completed, task_table.c.due_date)
+task_table.append_constraint(sa.Index("ix_task_search_vector", sa.text(TASK_SEARCH_VECTOR_SQL), postgresql_using="gin"))
+# Archival candidates, oldest completion first
+sa.Index("ix_task_completed_at", task_table.c.completed_at, postgresql_where=task_table.c.is_completed.is_(True))
+sa.Index("ix_task_archive_user_id_id", task_archive_table.c.user_id, task_archive_table.c.id)
+sa.Index("ix_task_archive_user_id_due_date", task_archive_table.c.user_id, task_archive_table.c.due_date, task_archive_table.c.id)
+
+# Same statements as migrations 6 and 7. Only inserts of completed tasks and updates changing is_completed call the function
+for statement in ("""CREATE OR REPLACE FUNCTION task_set_completed_at() RETURNS trigger AS $$
+                     BEGIN
+                         NEW.completed_at := CASE WHEN NEW.is_completed IS TRUE THEN coalesce(NEW.completed_at, now()) END;
+                         RETURN NEW;
+                     END
+                     $$ LANGUAGE plpgsql""",
+                  'CREATE OR REPLACE TRIGGER task_completed_at_insert BEFORE INSERT ON "Task" FOR EACH ROW WHEN (NEW.is_completed IS TRUE) EXECUTE FUNCTION task_set_completed_at()',
+                  'CREATE OR REPLACE TRIGGER task_completed_at_update BEFORE UPDATE OF is_completed ON "Task" FOR EACH ROW WHEN (OLD.is_completed IS DISTINCT FROM NEW.is_completed) EXECUTE FUNCTION task_set_completed_at()'):
+    sa.event.listen(task_table, "after_create", sa.DDL(statement))
+
+# Columns returned by the task read queries, in the order task_row_to_dict/task_rows_to_dicts unpack them
+TASK_COLUMNS = (task_table.c.id, task_table.c.user_id, task_table.c.title, task_table.c.description, task_table.c.due_date, task_table.c.is_completed)
+TASK_FIELDS = ("id", "user_id", "title", "description", "due_date", "is_completed")
+
+TASK_SORT_ORDERS = ("id", "-id", "due_date", "-due_date")
+TASK_SEARCH_MODES = ("websearch", "prefix")
+TASK_EDITABLE_COLUMNS = ("title", "description", "due_date", "is_completed")
+# Task ids are INTEGER, ids outside this range match no task (and would fail the cast to INTEGER[])
+TASK_ID_RANGE = range(-2**31, 2**31)
+
+# Called with the user_id after a user is deleted (e.g. to invalidate caches)
+user_deleted_hooks = []
+# Called with the user_id after any write to the user's tasks (from bump_task_version)
+task_changed_hooks = []
+
+# NOTIFY channel of task change events, delivered by Postgres when the writing transaction commits (see events.py)
+TASK_EVENTS_CHANNEL = "task_events"
+
+TASK_SUMMARY_DUE_SOON = datetime.timedelta(days=7)
+
+# Name of the query function currently executing, lets engine event listeners attribute SQL to it
+current_function = contextvars.ContextVar("db_current_function", default=None)
+# Called with the function name and its duration in seconds after every query function (see profiling.py)
+query_function_hooks = []
+
+def query_function(func):
+    @wraps(func)
+    def inner(*args, **kwargs):
+        token = current_function.set(func.__name__)
+        start = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            current_function.reset(token)
+            for hook in query_function_hooks:
+                hook(func.__name__, time.perf_counter() - start)
+
+    return inner
+
+def create_db_engine(host, port, username, password, dbname, pool_size=5, max_overflow=10, pool_timeout=30, pool_recycle=1800, pool_pre_ping=True):
 
     connection_string = f"postgresql://{username}:{password}@{host}:{port}/{dbname}"
 
-    engine = sa.create_engine(connection_string)
-    connection = engine.connect()
+    # Connections are checked out per request and returned to the pool afterwards.
+    # pre_ping discards connections killed by Postgres/network, recycle bounds their lifetime
+    engine = sa.create_engine(connection_string,
+                              pool_size=pool_size,
+                              max_overflow=max_overflow,
+                              pool_timeout=pool_timeout,
+                              pool_recycle=pool_recycle,
+                              pool_pre_ping=pool_pre_ping,
+                              )
 
+    # No connection is opened until first use. A forked child (gunicorn --preload) starts with an empty pool
+    # instead of sharing the parent's sockets, close=False leaves those to the parent
+    engine_ref = weakref.ref(engine)
+    def reset_pool_after_fork():
+        if engine_ref() is not None: engine_ref().dispose(close=False)
+    os.register_at_fork(after_in_child=reset_pool_after_fork)
+
+    return engine
+
+def recreate_test_schema(engine):
+    # Drops all data! Only for tests and benchmarks, deployments use migrations.py
     metadata.drop_all(engine)
 
     metadata.create_all(engine)
 
+def create_test_db_connection(host, port, username, password, dbname, **pool_options):
+    # Empty schema for the tests, see recreate_test_schema
+    engine = create_db_engine(host, port, username, password, dbname, **pool_options)
+    connection = engine.connect()
+
+    recreate_test_schema(engine)
+
     return engine, connection
 
+def get_pool_status(engine):
+    pool = engine.pool
+    return {
+        "size": pool.size(),
+        "checked_in": pool.checkedin(),
+        "checked_out": pool.checkedout(),
+        "overflow": pool.overflow(),
+    }
+
+@query_function
+def get_current_wal_lsn(connection):
+    # WAL position on the primary, a replica that replayed up to it sees everything committed so far.
+    # As text, asyncpg would decode pg_lsn to an int
+    return connection.execute(sa.select(sa.cast(sa.func.pg_current_wal_lsn(), sa.Text))).scalar()
+
+@query_function
+def get_replay_lsn(connection):
+    # WAL position replayed by a replica, None on a primary
+    return connection.execute(sa.select(sa.cast(sa.func.pg_last_wal_replay_lsn(), sa.Text))).scalar()
+
 ##################################################
 
+@query_function
 def insert_user(username, hashed_password_string, connection):
     if not isinstance(username, str) or username.strip() == "": raise InvalidInputException("Invalid username: Must be a non-empty string")
     if not isinstance(hashed_password_string, str) or hashed_password_string.strip() == "": raise InvalidInputException("Invalid hashed_password_string: Must be a non-empty string")
@@ -46,6 +206,7 @@ def insert_user(username, hashed_password_string, connection):
     new_user_id = connection.execute(query)
     return new_user_id.fetchone()[0]
     
+@query_function
 def get_user_by_username(username, connection):
     if not isinstance(username, str) or username.strip() == "": raise InvalidInputException("Invalid username: Must be a non-empty string")
 
@@ -56,6 +217,7 @@ def get_user_by_username(username, connection):
     
     return {"id": user[0], "username": user[1], "password_hash": user[2]}
 
+@query_function
 def get_user_by_id(user_id, connection):
     if not isinstance(user_id, int): raise InvalidInputException("Invalid user_id: Must be int")
 
@@ -66,64 +228,817 @@ def get_user_by_id(user_id, connection):
     
     return {"id": user[0], "username": user[1], "password_hash": user[2]}
 
+@query_function
+def update_user_password_hash(user_id, hashed_password_string, connection):
+    if not isinstance(user_id, int): raise InvalidInputException("Invalid user_id: Must be int")
+    if not isinstance(hashed_password_string, str) or hashed_password_string.strip() == "": raise InvalidInputException("Invalid hashed_password_string: Must be a non-empty string")
+
+    query = sa.update(user_table).where(user_table.c.id == user_id).values(password_hash=hashed_password_string)
+    result = connection.execute(query)
+    if result.rowcount == 0: raise InvalidInputException("Invalid user_id: user_id not found")
+
+@query_function
+def delete_user_by_id(user_id, connection):
+    if not isinstance(user_id, int): raise InvalidInputException("Invalid user_id: Must be int")
+
+    connection.execute(task_table.delete().where(task_table.c.user_id == user_id))
+    connection.execute(task_archive_table.delete().where(task_archive_table.c.user_id == user_id))
+    connection.execute(user_directory_table.delete().where(user_directory_table.c.user_id == user_id))
+    result = connection.execute(user_table.delete().where(user_table.c.id == user_id))
+    if result.rowcount == 0: raise InvalidInputException("Invalid user_id: user_id not found")
+
+    for hook in user_deleted_hooks:
+        hook(user_id)
+
+@query_function
+def get_task_version(user_id, connection):
+    if not isinstance(user_id, int): raise InvalidInputException("Invalid user_id: Must be int")
+
+    query = sa.select(user_table.c.task_version).where(user_table.c.id == user_id)
+    return connection.execute(query).scalar()
+
+@query_function
+def bump_task_version(user_id, connection, changes=()):
+    # changes: (type, task_id) pairs published as task events, numbered by the new version and their position
+    if user_id is None: return None
+
+    query = sa.update(user_table).where(user_table.c.id == user_id).values(task_version=user_table.c.task_version + 1).returning(user_table.c.task_version)
+    if not changes:
+        task_version = connection.execute(query).scalar()
+    else:
+        # Bump and NOTIFY in one round trip, one notification per change
+        bumped = query.cte("bumped")
+        change = sa.func.unnest(sa.literal([change_type for change_type, _ in changes], postgresql.ARRAY(sa.String)),
+                                sa.literal([task_id for _, task_id in changes], postgresql.ARRAY(sa.Integer))).table_valued("type", "id", with_ordinality="ordinality").render_derived(name="change")
+        payload = sa.func.json_build_object("user_id", user_id, "version", bumped.c.task_version, "index", change.c.ordinality - 1, "count", len(changes),
+                                            "type", change.c.type, "id", change.c.id)
+        notify = sa.select(bumped.c.task_version, sa.func.pg_notify(TASK_EVENTS_CHANNEL, sa.cast(payload, sa.Text))).select_from(bumped).join(change, sa.true())
+        task_version = connection.execute(notify).scalar()
+
+    for hook in task_changed_hooks:
+        hook(user_id)
+
+    return task_version
+
+@query_function
 def insert_task(task, connection):
     if not isinstance(task, dict): raise InvalidInputException("Task must be of type dict")
     if "title" not in task.keys(): raise InvalidInputException("title is required for creating a task")
 
     query = task_table.insert().values(**task).returning(task_table.c.id)
-    new_task_id = connection.execute(query)
-    return new_task_id.fetchone()[0]
+    new_task_id = connection.execute(query).fetchone()[0]
+    bump_task_version(task.get("user_id"), connection, [("created", new_task_id)])
+    return new_task_id
 
-def get_task_by_id(task_id, connection):
+@query_function
+def get_task_by_id(task_id, connection, include_archived=False):
     if not isinstance(task_id, int): raise InvalidInputException("Invalid task_id: Must be int")
+    if not isinstance(include_archived, bool): raise InvalidInputException("Invalid include_archived: Must be bool")
 
-    query = task_table.select().where(task_table.c.id == task_id)
+    tasks = task_source(include_archived)
+    query = sa.select(*[tasks.c[field] for field in TASK_FIELDS]).where(tasks.c.id == task_id)
     task = connection.execute(query).fetchone()
 
     if task is None: return None
     
+    return task_row_to_dict(task)
+
+
+def task_row_to_dict(task):
     return {"id": task[0], "user_id": task[1], "title": task[2], "description": task[3], "due_date": task[4], "is_completed": task[5]}
 
+def task_rows_to_dicts(tasks, fields=TASK_FIELDS):
+    # Unpacking into a dict literal is the cheapest per-row mapping (see benchmarks/serialization.py)
+    if fields is not TASK_FIELDS:
+        return [dict(zip(fields, task)) for task in tasks]
+    return [{"id": id, "user_id": user_id, "title": title, "description": description, "due_date": due_date, "is_completed": is_completed}
+            for id, user_id, title, description, due_date, is_completed in tasks]
+
+def task_list_fields(fields=None, sort="id"):
+    # Columns selected by a listing. The cursor is built from id (and due_date when sorted by it), so they are always included
+    if fields is None: return TASK_FIELDS
+    if not isinstance(fields, (list, tuple)) or any(field not in TASK_FIELDS for field in fields): raise InvalidInputException(f"Invalid fields: Must be a subset of {', '.join(TASK_FIELDS)}")
+    required = ("id", "due_date") if sort in ("due_date", "-due_date") else ("id",)
+    return tuple(field for field in TASK_FIELDS if field in fields or field in required)
+
+def encode_cursor(task, sort="id"):
+    cursor = {"sort": sort, "id": task["id"]}
+    if sort in ("due_date", "-due_date"):
+        cursor["due_date"] = task["due_date"].isoformat() if task["due_date"] is not None else None
+    return base64.urlsafe_b64encode(json.dumps(cursor).encode()).decode()
+
+def decode_cursor(cursor, sort="id"):
+    try:
+        cursor = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        task_id = cursor["id"]
+        due_date = cursor.get("due_date")
+        if due_date is not None:
+            due_date = datetime.datetime.fromisoformat(due_date)
+    except (binascii.Error, ValueError, KeyError, TypeError, AttributeError):
+        raise InvalidInputException("Invalid cursor")
+    if not isinstance(task_id, int) or cursor.get("sort") != sort: raise InvalidInputException("Invalid cursor")
+
+    return {"id": task_id, "due_date": due_date}
+
+def task_source(include_archived=False):
+    # Task, or Task and TaskArchive as one relation. Ids stay unique across both, archived tasks keep theirs.
+    # Filters on the UNION ALL are pushed into both sides by Postgres, so each still uses its (user_id, ...) indexes
+    if not include_archived: return task_table
+    archived_columns = [task_archive_table.c[field] for field in TASK_FIELDS]
+    return sa.union_all(sa.select(*TASK_COLUMNS), sa.select(*archived_columns)).subquery("task_all")
+
+def task_list_query(user_id, cursor=None, completed=None, due_before=None, due_after=None, sort="id", fields=None, include_archived=False):
+    if sort not in TASK_SORT_ORDERS: raise InvalidInputException(f"Invalid sort: Must be one of {', '.join(TASK_SORT_ORDERS)}")
+    if completed is not None and not isinstance(completed, bool): raise InvalidInputException("Invalid completed: Must be bool")
+    if due_before is not None and not isinstance(due_before, datetime.datetime): raise InvalidInputException("Invalid due_before: Must be datetime")
+    if due_after is not None and not isinstance(due_after, datetime.datetime): raise InvalidInputException("Invalid due_after: Must be datetime")
+    if not isinstance(include_archived, bool): raise InvalidInputException("Invalid include_archived: Must be bool")
+
+    # Projection happens in SQL, unselected columns (e.g. long descriptions) are never read or sent by Postgres
+    fields = task_list_fields(fields, sort)
+    tasks = task_source(include_archived)
+    columns = TASK_COLUMNS if fields is TASK_FIELDS and not include_archived else [tasks.c[field] for field in fields]
+    query = sa.select(*columns).where(tasks.c.user_id == user_id)
+
+    # 'IS NOT TRUE' matches the predicate of the partial index on open tasks (NULL counts as open)
+    if completed is True:
+        query = query.where(tasks.c.is_completed.is_(True))
+    elif completed is False:
+        query = query.where(tasks.c.is_completed.isnot(True))
+    if due_before is not None:
+        query = query.where(tasks.c.due_date < due_before)
+    if due_after is not None:
+        query = query.where(tasks.c.due_date >= due_after)
+
+    # Keyset pagination: resume after the (due_date, id) / id of the last row of the previous page.
+    # Ascending due_date sorts NULLs last, descending sorts them first (Postgres defaults, matching the index)
+    id_column, due_date_column = tasks.c.id, tasks.c.due_date
+    if sort == "id":
+        query = query.order_by(id_column.asc())
+    elif sort == "-id":
+        query = query.order_by(id_column.desc())
+    elif sort == "due_date":
+        query = query.order_by(due_date_column.asc(), id_column.asc())
+    else:
+        query = query.order_by(due_date_column.desc(), id_column.desc())
+
+    if cursor is None: return query
 
-def get_task_list_by_user_id(user_id, connection):
+    last = decode_cursor(cursor, sort)
+    if sort == "id":
+        query = query.where(id_column > last["id"])
+    elif sort == "-id":
+        query = query.where(id_column < last["id"])
+    elif sort == "due_date" and last["due_date"] is None:
+        query = query.where(due_date_column.is_(None), id_column > last["id"])
+    elif sort == "due_date":
+        query = query.where(sa.or_(due_date_column > last["due_date"],
+                                   sa.and_(due_date_column == last["due_date"], id_column > last["id"]),
+                                   due_date_column.is_(None)))
+    elif last["due_date"] is None:
+        query = query.where(sa.or_(sa.and_(due_date_column.is_(None), id_column < last["id"]),
+                                   due_date_column.isnot(None)))
+    else:
+        query = query.where(sa.or_(due_date_column < last["due_date"],
+                                   sa.and_(due_date_column == last["due_date"], id_column < last["id"])))
+
+    return query
+
+@query_function
+def get_task_list_by_user_id(user_id, connection, **filters):
     if not isinstance(user_id, int): raise InvalidInputException("Invalid user_id: Must be int")
 
-    query = task_table.select().where(task_table.c.user_id == user_id)
-    task_list = connection.execute(query)
+    query = task_list_query(user_id, **filters)
+    return task_rows_to_dicts(connection.execute(query).tuples(), task_list_fields(filters.get("fields"), filters.get("sort", "id")))
 
-    if task_list is None: return []
-    
-    return_list = []
-    for task in task_list:
-        return_list.append({"id": task[0], "user_id": task[1], "title": task[2], "description": task[3], "due_date": task[4], "is_completed": task[5]})
+@query_function
+def get_task_page_by_user_id(user_id, connection, limit, cursor=None, **filters):
+    if not isinstance(user_id, int): raise InvalidInputException("Invalid user_id: Must be int")
+    if not isinstance(limit, int) or limit < 1: raise InvalidInputException("Invalid limit: Must be a positive int")
+
+    # Fetch one extra row to know whether another page exists
+    query = task_list_query(user_id, cursor, **filters).limit(limit + 1)
+    task_list = task_rows_to_dicts(connection.execute(query).tuples(), task_list_fields(filters.get("fields"), filters.get("sort", "id")))
 
-    return return_list
+    next_cursor = None
+    if len(task_list) > limit:
+        task_list = task_list[:limit]
+        next_cursor = encode_cursor(task_list[-1], filters.get("sort", "id"))
 
+    return task_list, next_cursor
+
+@query_function
+def iter_task_list_by_user_id(user_id, connection, cursor=None, batch_size=1000, **filters):
+    if not isinstance(user_id, int): raise InvalidInputException("Invalid user_id: Must be int")
+
+    # Server-side cursor: rows are fetched from Postgres in batches instead of all at once.
+    # The query is executed right away, the returned generator yields lists of up to batch_size tasks
+    query = task_list_query(user_id, cursor, **filters)
+    result = connection.execution_options(stream_results=True, yield_per=batch_size).execute(query)
+    fields = task_list_fields(filters.get("fields"), filters.get("sort", "id"))
+
+    return (task_rows_to_dicts(partition, fields) for partition in result.tuples().partitions())
+
+@query_function
+def get_task_summary_by_user_id(user_id, connection, now=None):
+    if not isinstance(user_id, int): raise InvalidInputException("Invalid user_id: Must be int")
+    if now is None: now = datetime.datetime.now()
+
+    # One pass over the user's tasks, 'IS NOT TRUE' counts tasks without is_completed as open like the listings do
+    is_open = task_table.c.is_completed.isnot(True)
+    due_date = task_table.c.due_date
+    query = sa.select(sa.func.count().label("total"),
+                      sa.func.count().filter(is_open).label("open"),
+                      sa.func.count().filter(task_table.c.is_completed.is_(True)).label("completed"),
+                      sa.func.count().filter(is_open, due_date < now).label("overdue"),
+                      sa.func.count().filter(is_open, due_date >= now, due_date < now + TASK_SUMMARY_DUE_SOON).label("due_this_week"),
+                      ).where(task_table.c.user_id == user_id)
+
+    return dict(connection.execute(query).one()._mapping)
+
+def task_search_query(text, mode="websearch"):
+    if not isinstance(text, str) or text.strip() == "": raise InvalidInputException("Invalid q: Must be a non-empty string")
+    if mode not in TASK_SEARCH_MODES: raise InvalidInputException(f"Invalid mode: Must be one of {', '.join(TASK_SEARCH_MODES)}")
+
+    if mode == "websearch":
+        # Quoted phrases, 'or' and '-' exclusions, never raises on user input
+        return sa.func.websearch_to_tsquery(sa.literal_column("'simple'::regconfig"), text)
+
+    # Search-as-you-type: every word must match as a prefix, e.g. 'gro mil' -> 'gro:* & mil:*'
+    words = re.findall(r"\w+", text)
+    if not words: raise InvalidInputException("Invalid q: Must contain a word")
+    return sa.func.to_tsquery(sa.literal_column("'simple'::regconfig"), " & ".join(f"{word}:*" for word in words))
+
+def encode_search_cursor(rank, task_id):
+    return base64.urlsafe_b64encode(json.dumps({"sort": "rank", "rank": rank, "id": task_id}).encode()).decode()
+
+def decode_search_cursor(cursor):
+    try:
+        cursor = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        rank, task_id = cursor["rank"], cursor["id"]
+    except (binascii.Error, ValueError, KeyError, TypeError, AttributeError):
+        raise InvalidInputException("Invalid cursor")
+    if not isinstance(task_id, int) or not isinstance(rank, (int, float)) or cursor.get("sort") != "rank": raise InvalidInputException("Invalid cursor")
+
+    return {"rank": rank, "id": task_id}
+
+@query_function
+def search_tasks_by_user_id(user_id, text, connection, limit, cursor=None, mode="websearch"):
+    if not isinstance(user_id, int): raise InvalidInputException("Invalid user_id: Must be int")
+    if not isinstance(limit, int) or limit < 1: raise InvalidInputException("Invalid limit: Must be a positive int")
+
+    # The GIN index finds the matching tasks, the user_id index narrows them to the user (bitmap AND)
+    tsquery = task_search_query(text, mode)
+    # float8 so the rank in the cursor compares equal to the recomputed one (ts_rank_cd returns real)
+    rank = sa.cast(sa.func.ts_rank_cd(task_search_vector, tsquery), postgresql.DOUBLE_PRECISION)
+    query = (sa.select(*TASK_COLUMNS, rank)
+             .where(task_table.c.user_id == user_id, task_search_vector.op("@@")(tsquery))
+             .order_by(rank.desc(), task_table.c.id.desc())
+             .limit(limit + 1))
+
+    # Keyset on (rank, id) of the last row of the previous page
+    if cursor is not None:
+        last = decode_search_cursor(cursor)
+        query = query.where(sa.or_(rank < last["rank"], sa.and_(rank == last["rank"], task_table.c.id < last["id"])))
+
+    rows = connection.execute(query).all()
+    task_list = task_rows_to_dicts(row[:-1] for row in rows[:limit])
+
+    next_cursor = None
+    if len(rows) > limit:
+        next_cursor = encode_search_cursor(rows[limit - 1][-1], task_list[-1]["id"])
+
+    return task_list, next_cursor
+
+@query_function
 def update_task(task, user_id, connection):
     if "id" not in task.keys() or not isinstance(task["id"], int): raise InvalidInputException("Missing or Invalid task_id: Must be int")
 
     query = sa.update(task_table).where(task_table.c.user_id == user_id).where(task_table.c.id == task["id"]).values(**task)
     result = connection.execute(query)
     if result.rowcount == 0: raise InvalidInputException("Invalid task_id: task_id not found")
+    bump_task_version(user_id, connection, [("updated", task["id"])])
 
+@query_function
 def delete_task_by_id(task_id, user_id, connection):
     if not isinstance(task_id, int): raise InvalidInputException("Invalid task_id: Must be int")
 
     query = task_table.delete().where(task_table.c.user_id == user_id).where(task_table.c.id == task_id)
     result = connection.execute(query)
     if result.rowcount == 0: raise InvalidInputException("Invalid task_id: task_id not found")
+    bump_task_version(user_id, connection, [("deleted", task_id)])
+
+def validate_batch_task(task, require_title):
+    if not isinstance(task, dict): raise InvalidInputException("Task must be of type dict")
+    if require_title and "title" not in task.keys(): raise InvalidInputException("title is required for creating a task")
+
+    unknown_columns = set(task.keys()) - set(TASK_EDITABLE_COLUMNS) - set(["id"])
+    if unknown_columns: raise InvalidInputException(f"Invalid fields: {', '.join(sorted(unknown_columns))}")
+    if "title" in task and (not isinstance(task["title"], str) or task["title"].strip() == ""): raise InvalidInputException("Invalid title: Must be a non-empty string")
+    if "description" in task and task["description"] is not None and not isinstance(task["description"], str): raise InvalidInputException("Invalid description: Must be a string")
+    if "is_completed" in task and task["is_completed"] is not None and not isinstance(task["is_completed"], bool): raise InvalidInputException("Invalid is_completed: Must be bool")
+
+    # Invalid dates would otherwise abort the transaction of the whole batch
+    task = dict(task)
+    if task.get("due_date") is not None:
+        try:
+            task["due_date"] = datetime.datetime.fromisoformat(task["due_date"]) if isinstance(task["due_date"], str) else task["due_date"]
+        except ValueError:
+            raise InvalidInputException("Invalid due_date: Must be an ISO 8601 datetime")
+        if not isinstance(task["due_date"], datetime.datetime): raise InvalidInputException("Invalid due_date: Must be an ISO 8601 datetime")
+
+    return task
+
+@query_function
+def insert_task_batch(task_list, user_id, connection):
+    if not isinstance(user_id, int): raise InvalidInputException("Invalid user_id: Must be int")
+    if len(task_list) == 0: return []
+
+    task_list = [validate_batch_task(task, require_title=True) for task in task_list]
+    rows = [{column: task.get(column) for column in TASK_EDITABLE_COLUMNS} | {"user_id": user_id} for task in task_list]
+
+    # executemany with RETURNING is sent as multi-row INSERT statements, ids come back in input order
+    query = task_table.insert().returning(task_table.c.id, sort_by_parameter_order=True)
+    new_task_ids = [row[0] for row in connection.execute(query, rows)]
+    bump_task_version(user_id, connection, [("created", task_id) for task_id in new_task_ids])
+    return new_task_ids
+
+@query_function
+def update_task_batch(task_list, user_id, connection):
+    if not isinstance(user_id, int): raise InvalidInputException("Invalid user_id: Must be int")
+
+    task_list = [validate_batch_task(task, require_title=False) for task in task_list]
+    for task in task_list:
+        if "id" not in task.keys() or not isinstance(task["id"], int) or isinstance(task["id"], bool): raise InvalidInputException("Missing or Invalid task_id: Must be int")
+
+    # One UPDATE ... FROM (VALUES ...) per distinct set of updated fields, usually just one
+    groups = {}
+    for task in task_list:
+        groups.setdefault(tuple(sorted(set(task.keys()) - set(["id"]))), []).append(task)
+
+    updated_ids = set()
+    for columns, group in groups.items():
+        group = [task for task in group if task["id"] in TASK_ID_RANGE]
+        if len(group) == 0: continue
+        if len(columns) == 0:
+            query = sa.select(task_table.c.id).where(task_table.c.user_id == user_id, task_table.c.id == sa.any_(sa.literal([task["id"] for task in group], postgresql.ARRAY(sa.Integer))))
+        else:
+            values = sa.values(sa.column("id", sa.Integer), *[sa.column(column, task_table.c[column].type) for column in columns], name="batch").data(
+                [(task["id"], *[task[column] for column in columns]) for task in group])
+            query = sa.update(task_table).where(task_table.c.id == values.c.id, task_table.c.user_id == user_id) \
+                .values({column: sa.cast(values.c[column], task_table.c[column].type) for column in columns}) \
+                .returning(task_table.c.id)
+        updated_ids.update(row[0] for row in connection.execute(query))
+
+    if updated_ids: bump_task_version(user_id, connection, [("updated", task_id) for task_id in sorted(updated_ids)])
+    return updated_ids
+
+@query_function
+def delete_task_batch(task_id_list, user_id, connection):
+    if not isinstance(user_id, int): raise InvalidInputException("Invalid user_id: Must be int")
+    for task_id in task_id_list:
+        if not isinstance(task_id, int) or isinstance(task_id, bool): raise InvalidInputException("Invalid task_id: Must be int")
+    task_id_list = [task_id for task_id in task_id_list if task_id in TASK_ID_RANGE]
+    if len(task_id_list) == 0: return set()
+
+    query = task_table.delete().where(task_table.c.user_id == user_id) \
+        .where(task_table.c.id == sa.any_(sa.literal(list(task_id_list), postgresql.ARRAY(sa.Integer)))) \
+        .returning(task_table.c.id)
+    deleted_ids = set(row[0] for row in connection.execute(query))
+    if deleted_ids: bump_task_version(user_id, connection, [("deleted", task_id) for task_id in sorted(deleted_ids)])
+    return deleted_ids
 
 ##################################################
 
-if __name__ == "__main__":
-    if not load_dotenv(".env"):
-        print("ERROR LOADING ENVIRONMENT!")
+# Bulk import/export through COPY. Uploads are streamed into a staging table whose types and constraints make
+# COPY itself reject malformed rows, one INSERT ... SELECT then moves them into Task. Exports stream
+# COPY (listing query) TO STDOUT, rows leave Postgres as the query produces them.
+
+TASK_TRANSFER_FORMATS = ("ndjson", "csv")
+TASK_TRANSFER_MEDIA_TYPES = {"ndjson": "application/x-ndjson", "csv": "text/csv"}
+TASK_TRANSFER_CHUNK_SIZE = 65536
+# id and user_id (e.g. of an export) are accepted and ignored, imported tasks get new ids and the importing user
+TASK_IMPORT_IGNORED_COLUMNS = ("id", "user_id")
+TASK_IMPORT_KEYS = frozenset(TASK_EDITABLE_COLUMNS + TASK_IMPORT_IGNORED_COLUMNS)
+
+# Dropped by merge_task_import, ON COMMIT DROP covers transactions that commit without merging
+TASK_IMPORT_TABLE_SQL = """CREATE TEMPORARY TABLE task_import (
+                               line BIGINT GENERATED ALWAYS AS IDENTITY,
+                               id VARCHAR,
+                               user_id VARCHAR,
+                               title VARCHAR NOT NULL CHECK (btrim(title) <> ''),
+                               description VARCHAR,
+                               due_date TIMESTAMP WITHOUT TIME ZONE,
+                               is_completed BOOLEAN
+                           ) ON COMMIT DROP"""
+task_import_table = sa.table("task_import", sa.column("line"), *[sa.column(column) for column in TASK_EDITABLE_COLUMNS])
+
+# NDJSON is exported as COPY csv of one row_to_json column: JSON escapes every control character, so with
+# control characters as delimiter and quote no field is ever quoted and each line is the plain JSON object
+TASK_EXPORT_COPY_OPTIONS = {
+    "ndjson": {"format": "csv", "delimiter": "\x02", "quote": "\x01"},
+    "csv": {"format": "csv", "header": True},
+}
+
+def csv_string(value):
+    # COPY csv reads an unquoted empty field as NULL and "" as an empty string
+    return "" if value is None else '"' + value.replace('"', '""') + '"'
+
+# Postgres boolean literals, for is_completed in CSV uploads
+CSV_BOOLEANS = {"t": True, "true": True, "y": True, "yes": True, "on": True, "1": True,
+                "f": False, "false": False, "n": False, "no": False, "off": False, "0": False}
+
+def task_import_row(task):
+    # One uploaded task as a CSV line for COPY, checked like validate_batch_task. due_dates with an offset are
+    # stored in UTC, Postgres would drop the offset
+    if not isinstance(task, dict): raise InvalidInputException("Task must be of type dict")
+    if "title" not in task: raise InvalidInputException("title is required for creating a task")
+    if not task.keys() <= TASK_IMPORT_KEYS: raise InvalidInputException(f"Invalid fields: {', '.join(sorted(task.keys() - TASK_IMPORT_KEYS))}")
+
+    title, description, due_date, is_completed = task["title"], task.get("description"), task.get("due_date"), task.get("is_completed")
+    if not isinstance(title, str) or title.strip() == "": raise InvalidInputException("Invalid title: Must be a non-empty string")
+    if description is not None and not isinstance(description, str): raise InvalidInputException("Invalid description: Must be a string")
+    if is_completed is not None and not isinstance(is_completed, bool): raise InvalidInputException("Invalid is_completed: Must be bool")
+    if due_date is not None:
+        try:
+            parsed_due_date = datetime.datetime.fromisoformat(due_date)
+        except (TypeError, ValueError):
+            raise InvalidInputException("Invalid due_date: Must be an ISO 8601 datetime")
+        if parsed_due_date.tzinfo is not None: due_date = parsed_due_date.astimezone(datetime.timezone.utc).replace(tzinfo=None).isoformat()
+
+    return f"{csv_string(title)},{csv_string(description)},{csv_string(due_date)},{'' if is_completed is None else 't' if is_completed else 'f'}\n"
+
+class TaskImportEncoder:
+    """ Turns an NDJSON or CSV upload, fed in chunks of any size, into the CSV rows COPY loads into task_import """
+
+    def __init__(self, format="ndjson"):
+        if format not in TASK_TRANSFER_FORMATS: raise InvalidInputException(f"Invalid format: Must be one of {', '.join(TASK_TRANSFER_FORMATS)}")
+        self.format = format
+        # COPY column list, for CSV None until the header line arrived
+        self.columns = TASK_EDITABLE_COLUMNS if format == "ndjson" else None
+        # Columns of a CSV upload, from its header line
+        self.header = None
+        # Lines of the upload before the first COPY line, to report upload line numbers for COPY errors
+        self.header_lines = 0
+        self.line = 0
+        self._pending = b""
+        # Lines of a CSV record with a quoted field spanning lines, and the line it started on
+        self._record = []
+        self._record_line = 0
+
+    def feed(self, chunk):
+        data = self._pending + chunk
+        end = data.rfind(b"\n") + 1
+        self._pending = data[end:]
+        return self._encode(data[:end])
+
+    def finish(self):
+        data, self._pending = self._pending, b""
+        rows = self._encode(data)
+        if self.format == "csv":
+            if self.columns is None: raise InvalidInputException("Invalid CSV: Missing header line")
+            if self._record: raise InvalidInputException(f"Invalid line {self._record_line}: Unterminated quoted field")
+        return rows
+
+    def _encode(self, data):
+        if self.format == "csv": return self._encode_csv(data)
+        rows = []
+        for line in data.splitlines():
+            self.line += 1
+            if line.strip() == b"": continue
+            try:
+                rows.append(task_import_row(json_loads(line)))
+            except ValueError:
+                raise InvalidInputException(f"Invalid line {self.line}: Must be a JSON object")
+            except InvalidInputException as e:
+                raise InvalidInputException(f"Invalid line {self.line}: {e}")
+        return "".join(rows).encode()
+
+    def _encode_csv(self, data):
+        # Parsed and written again like NDJSON rows, so nothing of the upload reaches COPY unescaped (a '\.'
+        # line would end the COPY early)
+        rows = []
+        for line in data.splitlines(keepends=True):
+            self.line += 1
+            if self.columns is None:
+                self._parse_header(line)
+                continue
+            if not self._record: self._record_line = self.line
+            self._record.append(line)
+            record = b"".join(self._record)
+            # Quotes come in pairs ("" inside a field), an odd count leaves a quoted field open
+            if record.count(b'"') % 2 == 1: continue
+            self._record = []
+            if record.strip() == b"": continue
+            try:
+                rows.append(task_import_row(self._csv_task(record)))
+            except InvalidInputException as e:
+                raise InvalidInputException(f"Invalid line {self._record_line}: {e}")
+        return "".join(rows).encode()
+
+    def _csv_task(self, record):
+        try:
+            values = next(csv.reader([record.decode("utf-8")]))
+        except (UnicodeDecodeError, csv.Error):
+            raise InvalidInputException("Malformed CSV")
+        if len(values) != len(self.header): raise InvalidInputException(f"Expected {len(self.header)} fields")
+
+        # Empty fields are NULL, as COPY reads unquoted ones
+        task = {column: value if value != "" else None for column, value in zip(self.header, values) if column not in TASK_IMPORT_IGNORED_COLUMNS}
+        if task.get("is_completed") is not None:
+            if task["is_completed"].strip().lower() not in CSV_BOOLEANS: raise InvalidInputException("Invalid is_completed: Must be bool")
+            task["is_completed"] = CSV_BOOLEANS[task["is_completed"].strip().lower()]
+        return task
+
+    def _parse_header(self, header):
+        try:
+            columns = tuple(column.strip() for column in next(csv.reader([header.decode("utf-8-sig")])))
+        except (UnicodeDecodeError, csv.Error, StopIteration):
+            raise InvalidInputException("Invalid CSV: Malformed header line")
+        unknown_columns = set(columns) - TASK_IMPORT_KEYS
+        if unknown_columns: raise InvalidInputException(f"Invalid CSV: Unknown columns {', '.join(sorted(unknown_columns))}")
+        if len(set(columns)) != len(columns): raise InvalidInputException("Invalid CSV: Duplicate columns")
+        if "title" not in columns: raise InvalidInputException("title is required for creating a task")
+        self.header = columns
+        self.columns = TASK_EDITABLE_COLUMNS
+        self.header_lines = 1
+
+def task_import_error(message, context, header_lines=0):
+    # COPY errors carry the COPY line in their context ('COPY task_import, line 3, column due_date: "x"')
+    match = re.search(r"line (\d+)", context or "")
+    if match is None: return InvalidInputException(f"Invalid import: {message}")
+    return InvalidInputException(f"Invalid line {int(match.group(1)) + header_lines}: {message}")
+
+def task_import_copy_sql(columns):
+    return f"COPY task_import ({', '.join(columns)}) FROM STDIN WITH (FORMAT csv)"
+
+@query_function
+def merge_task_import(user_id, connection):
+    # One statement moves the staged rows into Task, ids are assigned in upload order
+    query = task_table.insert().from_select(["user_id", *TASK_EDITABLE_COLUMNS],
+                                            sa.select(sa.literal(user_id, sa.Integer), *[task_import_table.c[column] for column in TASK_EDITABLE_COLUMNS]).order_by(task_import_table.c.line))
+    count = connection.execute(query).rowcount
+    connection.execute(sa.text("DROP TABLE task_import"))
+    # A single event for the whole import, subscribers refetch instead of receiving one event per task
+    if count > 0: bump_task_version(user_id, connection, [("imported", None)])
+    return count
+
+class ChunkReader:
+    """ File object for psycopg2's copy_expert over an iterator of byte chunks """
+
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+        self._buffer = b""
+        # psycopg2 replaces exceptions of read() with a generic QueryCanceled, import_tasks re-raises this one
+        self.error = None
+
+    def read(self, size=-1):
+        try:
+            while self._buffer == b"":
+                self._buffer = next(self._chunks)
+        except StopIteration:
+            return b""
+        except Exception as e:
+            self.error = e
+            raise
+        data, self._buffer = (self._buffer, b"") if size < 0 else (self._buffer[:size], self._buffer[size:])
+        return data
+
+@query_function
+def import_tasks(user_id, chunks, connection, format="ndjson"):
+    # chunks: iterable of the uploaded bytes, read as COPY consumes them. Returns the number of imported tasks
+    if not isinstance(user_id, int): raise InvalidInputException("Invalid user_id: Must be int")
+
+    encoder = TaskImportEncoder(format)
+    chunks = iter(chunks)
+    # The COPY column list of a CSV upload comes from its header line
+    pending = []
+    while encoder.columns is None:
+        chunk = next(chunks, None)
+        pending.append(encoder.finish() if chunk is None else encoder.feed(chunk))
+    def encoded():
+        yield from pending
+        for chunk in chunks:
+            yield encoder.feed(chunk)
+        yield encoder.finish()
+
+    connection.execute(sa.text(TASK_IMPORT_TABLE_SQL))
+    reader = ChunkReader(encoded())
+    try:
+        connection.connection.dbapi_connection.cursor().copy_expert(task_import_copy_sql(encoder.columns), reader)
+    except psycopg2.Error as e:
+        if reader.error is not None: raise reader.error
+        if not isinstance(e, (psycopg2.DataError, psycopg2.IntegrityError)): raise
+        raise task_import_error(e.diag.message_primary, e.diag.context, encoder.header_lines)
+
+    return merge_task_import(user_id, connection)
+
+def task_export_query(user_id, format="ndjson", **filters):
+    # (SELECT of the export, COPY options), the SELECT is the task listing query with its values inlined
+    if not isinstance(user_id, int): raise InvalidInputException("Invalid user_id: Must be int")
+    if format not in TASK_TRANSFER_FORMATS: raise InvalidInputException(f"Invalid format: Must be one of {', '.join(TASK_TRANSFER_FORMATS)}")
+
+    query = task_list_query(user_id, **filters)
+    if format == "ndjson":
+        task = query.subquery("task")
+        query = sa.select(sa.func.row_to_json(sa.literal_column("task"))).select_from(task)
+    return str(query.compile(dialect=postgresql.dialect(), compile_kwargs={"literal_binds": True})), TASK_EXPORT_COPY_OPTIONS[format]
+
+def copy_options_sql(options):
+    # Rendered as asyncpg's copy_from_query does, raw control characters are valid inside a string literal
+    def value_sql(value):
+        if isinstance(value, bool): return "TRUE" if value else "FALSE"
+        return "'" + value.replace("'", "''") + "'"
+    return ", ".join(f"{name.upper()} {value_sql(value)}" for name, value in options.items())
 
-    host = os.environ.get("POSTGRES_HOST")
-    port = os.environ.get("POSTGRES_PORT")
-    username = os.environ.get("POSTGRES_USER")
-    password = os.environ.get("POSTGRES_PASSWORD")
-    dbname = os.environ.get("POSTGRES_DB")
+class ChunkWriter:
+    """ File object for psycopg2's copy_expert handing the COPY output over in chunks of about chunk_size bytes """
 
-    engine, connection = create_db_connection(host, port, username, password, dbname)
-    print(get_user_by_username("string", connection))
+    def __init__(self, chunk_size, max_chunks=4):
+        self.chunk_size = chunk_size
+        # Bounded, the COPY waits for the consumer instead of buffering the export
+        self.chunks = queue.Queue(max_chunks)
+        self.stopped = threading.Event()
+        self._buffer = bytearray()
+
+    def write(self, data):
+        # Raising aborts the COPY, psycopg2 leaves the connection usable
+        if self.stopped.is_set(): raise OSError("Export aborted")
+        self._buffer += data
+        if len(self._buffer) >= self.chunk_size: self.flush()
+
+    def flush(self):
+        if self._buffer:
+            self.chunks.put(bytes(self._buffer))
+            self._buffer.clear()
+
+@query_function
+def export_tasks(user_id, connection, format="ndjson", chunk_size=TASK_TRANSFER_CHUNK_SIZE, **filters):
+    # Validates right away, the returned generator runs the COPY and yields the export in chunks.
+    # psycopg2 can only write COPY output to a file object, so the COPY runs on a thread feeding a short queue
+    query, options = task_export_query(user_id, format, **filters)
+    sql = f"COPY ({query}) TO STDOUT WITH ({copy_options_sql(options)})"
+
+    def chunks():
+        writer = ChunkWriter(chunk_size)
+        done = object()
+        def copy():
+            try:
+                connection.connection.dbapi_connection.cursor().copy_expert(sql, writer)
+                writer.flush()
+                writer.chunks.put(done)
+            except Exception as e:
+                writer.chunks.put(e)
+
+        thread = threading.Thread(target=copy, name="task-export", daemon=True)
+        thread.start()
+        try:
+            while True:
+                chunk = writer.chunks.get()
+                if chunk is done: return
+                if isinstance(chunk, Exception): raise chunk
+                yield chunk
+        finally:
+            # Consumer gone early (e.g. client disconnected): unblock the COPY so it aborts
+            writer.stopped.set()
+            while thread.is_alive():
+                try:
+                    writer.chunks.get(timeout=0.1)
+                except queue.Empty:
+                    pass
+            thread.join()
+
+    return chunks()
+
+##################################################
+
+# Archival: completed tasks older than a cutoff are moved from Task to TaskArchive in batches (see archive.py),
+# keeping Task and its indexes limited to live tasks. Archived tasks are read-only and only listed on request
+
+@query_function
+def archive_completed_tasks(connection, completed_before, batch_size=1000):
+    # Moves up to batch_size tasks completed before completed_before, oldest first, returns how many were moved.
+    # Locked rows (tasks being edited right now) are skipped and picked up by a later batch
+    if not isinstance(completed_before, datetime.datetime): raise InvalidInputException("Invalid completed_before: Must be datetime")
+    if not isinstance(batch_size, int) or batch_size < 1: raise InvalidInputException("Invalid batch_size: Must be a positive int")
+
+    batch = sa.select(task_table.c.id).where(task_table.c.is_completed.is_(True), task_table.c.completed_at < completed_before) \
+        .order_by(task_table.c.completed_at).limit(batch_size).with_for_update(skip_locked=True)
+    moved_columns = TASK_FIELDS + ("completed_at",)
+    moved = task_table.delete().where(task_table.c.id.in_(batch.scalar_subquery())) \
+        .returning(*[task_table.c[column] for column in moved_columns]).cte("moved")
+    # DELETE ... RETURNING feeding the INSERT in one statement, a task is never in both tables or in neither
+    query = task_archive_table.insert().from_select(moved_columns, sa.select(*[moved.c[column] for column in moved_columns])) \
+        .returning(task_archive_table.c.user_id, task_archive_table.c.id).add_cte(moved, nest_here=True)
+
+    archived = {}
+    for user_id, task_id in connection.execute(query):
+        archived.setdefault(user_id, []).append(task_id)
+    for user_id, task_ids in archived.items():
+        bump_task_version(user_id, connection, [("archived", task_id) for task_id in sorted(task_ids)])
+    return sum(len(task_ids) for task_ids in archived.values())
+
+##################################################
+
+# Sharding (see shards.py): the directory on shard 0 maps users to shards, every shard draws ids from its own
+# range of the id sequences so ids stay unique across shards and moved users keep theirs
+
+SHARDED_TABLES = (user_table, task_table)
+
+@query_function
+def insert_user_directory_entry(user_id, username, shard, connection):
+    if not isinstance(user_id, int): raise InvalidInputException("Invalid user_id: Must be int")
+    if not isinstance(username, str) or username.strip() == "": raise InvalidInputException("Invalid username: Must be a non-empty string")
+    if not isinstance(shard, int) or shard < 0: raise InvalidInputException("Invalid shard: Must be a non-negative int")
+
+    connection.execute(user_directory_table.insert().values(user_id=user_id, username=username, shard=shard))
+
+@query_function
+def get_user_directory_entry(username, connection):
+    if not isinstance(username, str) or username.strip() == "": raise InvalidInputException("Invalid username: Must be a non-empty string")
+
+    query = sa.select(user_directory_table.c.user_id, user_directory_table.c.shard).where(user_directory_table.c.username == username)
+    entry = connection.execute(query).fetchone()
+
+    if entry is None: return None
+
+    return {"user_id": entry[0], "shard": entry[1]}
+
+@query_function
+def get_user_shard(user_id, connection):
+    if not isinstance(user_id, int): raise InvalidInputException("Invalid user_id: Must be int")
+
+    query = sa.select(user_directory_table.c.shard).where(user_directory_table.c.user_id == user_id)
+    return connection.execute(query).scalar()
+
+@query_function
+def set_user_shard(user_id, shard, connection):
+    if not isinstance(user_id, int): raise InvalidInputException("Invalid user_id: Must be int")
+    if not isinstance(shard, int) or shard < 0: raise InvalidInputException("Invalid shard: Must be a non-negative int")
+
+    result = connection.execute(user_directory_table.update().where(user_directory_table.c.user_id == user_id).values(shard=shard))
+    if result.rowcount == 0: raise InvalidInputException("Invalid user_id: user_id not found")
+
+@query_function
+def get_user_counts_by_shard(connection):
+    query = sa.select(user_directory_table.c.shard, sa.func.count()).group_by(user_directory_table.c.shard)
+    return dict(connection.execute(query).all())
+
+@query_function
+def configure_id_range(connection, low, high):
+    # Restricts the User and Task id sequences to [low, high]. Sequences already restricted to it are left
+    # alone, otherwise they continue after the highest id of the range in use (rows or sequence position)
+    if not isinstance(low, int) or not isinstance(high, int) or not 0 < low <= high: raise InvalidInputException("Invalid id range: Must be 0 < low <= high")
+
+    for table in SHARDED_TABLES:
+        sequence = connection.execute(sa.select(sa.func.pg_get_serial_sequence(f'"{table.name}"', "id"))).scalar()
+        current = connection.execute(sa.text("SELECT seqmin, seqmax FROM pg_sequence WHERE seqrelid = CAST(:sequence AS regclass)"), {"sequence": sequence}).one()
+        if tuple(current) == (low, high): continue
+
+        # Archived tasks keep ids drawn from the Task sequence
+        id_tables = (task_table, task_archive_table) if table is task_table else (table,)
+        used = [connection.execute(sa.select(sa.func.max(id_table.c.id)).where(id_table.c.id.between(low, high))).scalar() for id_table in id_tables]
+        last_value = connection.execute(sa.text(f"SELECT last_value FROM {sequence}")).scalar()
+        used.append(last_value if low <= last_value <= high else None)
+        restart = max([low] + [value + 1 for value in used if value is not None])
+        if restart > high: raise InvalidInputException(f"Invalid id range: {table.name} ids {low}-{high} are used up")
+
+        connection.execute(sa.text(f"ALTER SEQUENCE {sequence} MINVALUE {low} MAXVALUE {high} START WITH {low} RESTART WITH {restart}"))
+
+@query_function
+def copy_user(user_id, source, target, batch_size=1000):
+    # Copies the user with all tasks (live and archived) from the source to the target connection, returns the
+    # number of copied tasks. The user's row stays locked on source until its transaction ends, which holds
+    # back all writes to the user's tasks there (every one bumps the user's task_version)
+    if not isinstance(user_id, int): raise InvalidInputException("Invalid user_id: Must be int")
+
+    user = source.execute(sa.select(user_table).where(user_table.c.id == user_id).with_for_update()).mappings().fetchone()
+    if user is None: raise InvalidInputException("Invalid user_id: user_id not found")
+    target.execute(user_table.insert(), [dict(user)])
+
+    copied = 0
+    for table in (task_table, task_archive_table):
+        # Locked as well, so writers already holding one of the rows finish before the copy instead of deadlocking later
+        query = sa.select(table).where(table.c.user_id == user_id).order_by(table.c.id).with_for_update()
+        result = source.execute(query, execution_options={"stream_results": True, "yield_per": batch_size})
+        for rows in result.mappings().partitions():
+            # Explicit completed_at, the insert trigger would otherwise restamp completed tasks
+            target.execute(table.insert(), [dict(row) for row in rows])
+            copied += len(rows)
+    return copied
+
+@query_function
+def delete_user_rows(user_id, connection):
+    # Removes a moved user's rows from the old shard, unlike delete_user_by_id no hooks and no directory change
+    if not isinstance(user_id, int): raise InvalidInputException("Invalid user_id: Must be int")
+
+    connection.execute(task_table.delete().where(task_table.c.user_id == user_id))
+    connection.execute(task_archive_table.delete().where(task_archive_table.c.user_id == user_id))
+    connection.execute(user_table.delete().where(user_table.c.id == user_id))
+
+##################################################
+
+if __name__ == "__main__":
+    # Same as 'python migrations.py', the schema is only ever dropped by the tests
+    import migrations
+    sys.exit(migrations.main())
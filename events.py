@@ -0,0 +1,249 @@
+import os
+import json
+import time
+import queue
+import select
+import asyncio
+import logging
+import threading
+import collections
+
+import psycopg2
+
+import db
+import shards
+import metrics
+from ServiceUnavailableException import ServiceUnavailableException
+
+# Task change feed. db.bump_task_version NOTIFYs one event per changed task when the write commits; one
+# listener thread per process and database shard LISTENs on a dedicated connection and fans the events out to the subscribed
+# clients' queues (queue.Queue for Flask, asyncio.Queue for the ASGI app, so idle clients hold no thread there).
+#
+# Events of one write share the user's new task_version. Only the last event of a version carries an SSE id
+# (the version), so a Last-Event-ID always marks a fully received write and resuming replays the later
+# versions from a per-process ring buffer. When that is not possible (buffer too short, listener reconnected,
+# client queue overflowed) the client gets a 'resync' event and should refetch GET /tasks.
+
+RESYNC = {"type": "resync"}
+
+logger = logging.getLogger("events")
+
+def format_event(event):
+    message = f"event: {event['type']}\n"
+    if event is not RESYNC:
+        if event["index"] == event["count"] - 1:
+            message = f"id: {event['version']}\n" + message
+        message += "data: " + json.dumps({"id": event["id"], "version": event["version"]}) + "\n"
+    return (message + "\n").encode()
+
+def parse_event_id(value):
+    if value is None or not value.isdigit(): return None
+    return int(value)
+
+class Subscription:
+    """ Queue of one client's events, filled from the listener thread """
+
+    def __init__(self, user_id, max_queue, loop=None):
+        self.user_id = user_id
+        self.loop = loop
+        self.overflowed = False
+        self.queue = asyncio.Queue(max_queue) if loop is not None else queue.Queue(max_queue)
+
+    def deliver(self, event):
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self._put, event)
+        else:
+            self._put(event)
+
+    def _put(self, event):
+        try:
+            self.queue.put_nowait(event)
+        except (queue.Full, asyncio.QueueFull):
+            self.overflowed = True
+
+    def get(self, timeout):
+        try:
+            return self.queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    async def get_async(self, timeout):
+        try:
+            return await asyncio.wait_for(self.queue.get(), timeout)
+        except asyncio.TimeoutError:
+            return None
+
+class EventStream:
+    """ Turns a subscription into SSE messages, shared by the sync and async endpoints """
+
+    def __init__(self, subscription, replay, last_version):
+        self.subscription = subscription
+        self.replay = replay
+        self.sent_version = last_version or 0
+
+    def start(self):
+        messages = [b"retry: 3000\n\n"]
+        if self.replay is None:
+            messages.append(format_event(RESYNC))
+        for event in self.replay or []:
+            messages.append(format_event(event))
+            self.sent_version = event["version"]
+        return messages
+
+    def handle(self, event):
+        if self.subscription.overflowed:
+            # Events were dropped, start over from a refetch
+            self.subscription.overflowed = False
+            return format_event(RESYNC)
+        if event is None:
+            return b": keepalive\n\n"
+        if event is RESYNC:
+            return format_event(RESYNC)
+        # Already sent in the replay
+        if event["version"] <= self.sent_version:
+            return None
+        if event["index"] == event["count"] - 1:
+            self.sent_version = event["version"]
+        return format_event(event)
+
+class TaskEventHub:
+    """ One LISTEN connection per process and shard fanning task events out to the subscribed clients """
+
+    def __init__(self, connects, buffer_size=10000, max_queue=100, max_subscribers=10000, keepalive=15, retry_after=1):
+        # One connect function per shard
+        self.connects = connects
+        self.max_queue = max_queue
+        self.max_subscribers = max_subscribers
+        self.keepalive = keepalive
+        self.retry_after = retry_after
+        self._buffer = collections.deque(maxlen=buffer_size)
+        self._subscriptions = {}
+        self._subscriber_count = 0
+        self._listening = []
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def _ensure_started(self):
+        # Started lazily and per process, so gunicorn workers forked from a preloaded app get their own listener
+        with self._lock:
+            if self._pid != os.getpid():
+                self._pid = os.getpid()
+                self._listening = [threading.Event() for _ in self.connects]
+                for connect, listening in zip(self.connects, self._listening):
+                    threading.Thread(target=self._listen, args=(connect, listening), name="task-events-listener", daemon=True).start()
+        if not all(listening.wait(5) for listening in self._listening):
+            raise ServiceUnavailableException("Service Unavailable: Task events are not available", self.retry_after)
+
+    def _listen(self, connect, listening):
+        connected_before = False
+        while True:
+            connection = None
+            try:
+                connection = connect()
+                connection.set_session(autocommit=True)
+                connection.cursor().execute(f"LISTEN {db.TASK_EVENTS_CHANNEL}")
+                # Anything committed while disconnected is lost
+                if connected_before: self.reset()
+                connected_before = True
+                listening.set()
+
+                # poll, not select: under many open client sockets this connection's fd can exceed select's 1024 limit
+                poller = select.poll()
+                poller.register(connection, select.POLLIN)
+                while True:
+                    if not poller.poll(self.keepalive * 1000):
+                        connection.cursor().execute("SELECT 1")
+                        continue
+                    connection.poll()
+                    while connection.notifies:
+                        self.publish(json.loads(connection.notifies.pop(0).payload))
+            except Exception as e:
+                # Anything else (e.g. a malformed payload) must not end the thread either, reconnecting resyncs the clients
+                if not isinstance(e, (psycopg2.Error, OSError)): logger.exception("Task events listener failed, reconnecting")
+                listening.clear()
+                if connection is not None: connection.close()
+                time.sleep(1)
+
+    def publish(self, event):
+        with self._lock:
+            self._buffer.append(event)
+            subscriptions = list(self._subscriptions.get(event["user_id"], ()))
+        for subscription in subscriptions:
+            subscription.deliver(event)
+
+    def reset(self):
+        with self._lock:
+            self._buffer.clear()
+            subscriptions = [subscription for user_subscriptions in self._subscriptions.values() for subscription in user_subscriptions]
+        for subscription in subscriptions:
+            subscription.deliver(RESYNC)
+
+    def subscribe(self, user_id, loop=None):
+        self._ensure_started()
+        with self._lock:
+            if self._subscriber_count >= self.max_subscribers:
+                raise ServiceUnavailableException("Service Unavailable: Too many task event subscribers", self.retry_after)
+            subscription = Subscription(user_id, self.max_queue, loop)
+            self._subscriptions.setdefault(user_id, set()).add(subscription)
+            self._subscriber_count += 1
+        metrics.TASK_EVENT_SUBSCRIBERS.inc()
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            user_subscriptions = self._subscriptions.get(subscription.user_id, set())
+            if subscription not in user_subscriptions: return
+            user_subscriptions.discard(subscription)
+            if not user_subscriptions: del self._subscriptions[subscription.user_id]
+            self._subscriber_count -= 1
+        metrics.TASK_EVENT_SUBSCRIBERS.dec()
+
+    def replay(self, user_id, last_version, current_version):
+        # Events after last_version, or None when the buffer can not account for all of them
+        if last_version is None or current_version is None or last_version > current_version: return None
+
+        with self._lock:
+            events = [event for event in self._buffer if event["user_id"] == user_id and event["version"] > last_version]
+
+        # Every version in between must be buffered with all of its events
+        counts = collections.Counter(event["version"] for event in events)
+        expected_counts = {event["version"]: event["count"] for event in events}
+        if any(counts[version] != expected_counts.get(version) for version in range(last_version + 1, current_version + 1)): return None
+
+        return [event for event in events if event["version"] <= current_version]
+
+    def clear(self):
+        with self._lock:
+            self._buffer.clear()
+
+    def stats(self):
+        return {"listening": len(self._listening) > 0 and all(listening.is_set() for listening in self._listening) and self._pid == os.getpid(), "subscribers": self._subscriber_count, "buffered": len(self._buffer)}
+
+def create_task_event_hub(host, port, username, password, dbname):
+    # Listens on the POSTGRES_* database and every shard of POSTGRES_SHARDS
+    addresses = [(host, port, dbname)] + shards.parse_shard_dsns(os.environ.get("POSTGRES_SHARDS"), dbname)
+    return TaskEventHub([lambda host=host, port=port, dbname=dbname: psycopg2.connect(host=host, port=port, user=username, password=password, dbname=dbname) for host, port, dbname in addresses],
+                        int(os.environ.get("TASK_EVENTS_BUFFER_SIZE", 10000)),
+                        int(os.environ.get("TASK_EVENTS_QUEUE_SIZE", 100)),
+                        int(os.environ.get("TASK_EVENTS_MAX_SUBSCRIBERS", 10000)),
+                        int(os.environ.get("TASK_EVENTS_KEEPALIVE", 15)))
+
+def stream(hub, subscription, event_stream):
+    # Blocks a thread per client, used by the Flask app
+    try:
+        yield from event_stream.start()
+        while True:
+            message = event_stream.handle(subscription.get(hub.keepalive))
+            if message is not None: yield message
+    finally:
+        hub.unsubscribe(subscription)
+
+async def stream_async(hub, subscription, event_stream):
+    try:
+        for message in event_stream.start():
+            yield message
+        while True:
+            message = event_stream.handle(await subscription.get_async(hub.keepalive))
+            if message is not None: yield message
+    finally:
+        hub.unsubscribe(subscription)
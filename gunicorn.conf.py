@@ -0,0 +1,26 @@
+import os
+import shutil
+
+# Loaded automatically by gunicorn from the working directory
+
+# Threaded workers: open /tasks/stream subscriptions (and POST /admin/profile) each hold a thread, with the
+# default sync worker a single subscriber would block the worker and get it killed by the timeout. The gthread
+# worker's heartbeat does not depend on its requests, so long streams do not count against GUNICORN_TIMEOUT.
+# Keep POSTGRES_POOL_SIZE + POSTGRES_POOL_MAX_OVERFLOW at least GUNICORN_THREADS
+worker_class = "gthread"
+workers = int(os.environ.get("GUNICORN_WORKERS", 2))
+threads = int(os.environ.get("GUNICORN_THREADS", 8))
+timeout = int(os.environ.get("GUNICORN_TIMEOUT", 30))
+
+def on_starting(server):
+    # Start every run with an empty Prometheus multiprocess directory
+    multiproc_dir = os.environ.get("PROMETHEUS_MULTIPROC_DIR")
+    if multiproc_dir:
+        shutil.rmtree(multiproc_dir, ignore_errors=True)
+        os.makedirs(multiproc_dir, exist_ok=True)
+
+def child_exit(server, worker):
+    # Drop the live gauges (in-flight requests, pool usage) of workers that exited
+    if os.environ.get("PROMETHEUS_MULTIPROC_DIR"):
+        from prometheus_client import multiprocess
+        multiprocess.mark_process_dead(worker.pid)
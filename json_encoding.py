@@ -0,0 +1,64 @@
+import os
+import json
+import datetime
+
+from flask.json.provider import JSONProvider
+from werkzeug.http import http_date
+
+# JSON encoding shared by app.py and async_app.py. Uses orjson (C, serializes dicts/lists/datetimes without
+# Python callbacks) when installed and falls back to the standard library otherwise.
+# JSON_DATETIME_FORMAT=http keeps the RFC 822 dates Flask's jsonify produced ("Wed, 01 Jan 2025 00:00:00 GMT"),
+# iso emits ISO 8601 ("2025-01-01T00:00:00", the format accepted on input) natively and is the faster option.
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+JSON_DATETIME_FORMAT = os.environ.get("JSON_DATETIME_FORMAT", "http")
+if JSON_DATETIME_FORMAT not in ("http", "iso"): raise ValueError("JSON_DATETIME_FORMAT must be 'http' or 'iso'")
+
+WEEKDAYS = ("Mon", "Tue", "Wed", "Thu", "Fri", "Sat", "Sun")
+MONTHS = ("Jan", "Feb", "Mar", "Apr", "May", "Jun", "Jul", "Aug", "Sep", "Oct", "Nov", "Dec")
+
+def format_http_date(value):
+    # Same output as werkzeug's http_date (naive datetimes are UTC) at a fraction of the cost
+    if value.tzinfo is not None:
+        value = value.astimezone(datetime.timezone.utc)
+    return f"{WEEKDAYS[value.weekday()]}, {value.day:02d} {MONTHS[value.month - 1]} {value.year:04d} {value.hour:02d}:{value.minute:02d}:{value.second:02d} GMT"
+
+def json_default(value):
+    if isinstance(value, datetime.datetime):
+        return format_http_date(value) if JSON_DATETIME_FORMAT == "http" else value.isoformat()
+    if isinstance(value, datetime.date):
+        return http_date(value) if JSON_DATETIME_FORMAT == "http" else value.isoformat()
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+# With http dates orjson has to hand datetimes back to json_default
+ORJSON_OPTIONS = orjson.OPT_PASSTHROUGH_DATETIME if orjson is not None and JSON_DATETIME_FORMAT == "http" else 0
+
+def dumps_bytes(content):
+    if orjson is not None:
+        return orjson.dumps(content, default=json_default, option=ORJSON_OPTIONS)
+    return json.dumps(content, default=json_default, separators=(",", ":")).encode()
+
+def dumps(content):
+    return dumps_bytes(content).decode()
+
+def loads(content):
+    if orjson is not None:
+        return orjson.loads(content)
+    return json.loads(content)
+
+class FastJSONProvider(JSONProvider):
+    """ Flask JSON provider (app.json) backed by dumps_bytes/loads, used by jsonify and request.json """
+
+    def dumps(self, obj, **kwargs):
+        return dumps(obj)
+
+    def loads(self, s, **kwargs):
+        return loads(s)
+
+    def response(self, *args, **kwargs):
+        # Skips the bytes -> str -> bytes round trip of the default implementation
+        return self._app.response_class(dumps_bytes(self._prepare_response_obj(args, kwargs)), mimetype="application/json")
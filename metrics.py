@@ -0,0 +1,84 @@
+import os
+import time
+
+import sqlalchemy as sa
+from flask import request, g
+from prometheus_client import Counter, Gauge, Histogram, CollectorRegistry, REGISTRY, generate_latest, multiprocess, CONTENT_TYPE_LATEST
+
+import db
+
+# Prometheus metrics. When PROMETHEUS_MULTIPROC_DIR is set (see gunicorn.conf.py) every worker process
+# writes its samples to that directory and /metrics aggregates all of them, otherwise only the
+# current process is reported.
+
+# gunicorn.conf.py empties the directory on start, other processes importing this module (uvicorn, migrations.py,
+# scripts) only need it to exist before the collectors below write their files
+if os.environ.get("PROMETHEUS_MULTIPROC_DIR"):
+    os.makedirs(os.environ["PROMETHEUS_MULTIPROC_DIR"], exist_ok=True)
+
+REQUEST_COUNT = Counter("http_requests_total", "HTTP requests", ["method", "route", "status"])
+REQUEST_LATENCY = Histogram("http_request_duration_seconds", "HTTP request latency", ["method", "route", "status"])
+REQUESTS_IN_FLIGHT = Gauge("http_requests_in_flight", "HTTP requests currently being handled", multiprocess_mode="livesum")
+
+DB_QUERY_LATENCY = Histogram("db_query_duration_seconds", "Database query latency by db.py function", ["function"],
+                             buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, float("inf")))
+DB_POOL_SIZE = Gauge("db_pool_size", "Configured connection pool size", multiprocess_mode="livesum")
+DB_POOL_CHECKED_OUT = Gauge("db_pool_checked_out", "Pooled connections currently checked out", multiprocess_mode="livesum")
+
+RATE_LIMITED_REQUESTS = Counter("rate_limited_requests_total", "Requests rejected with 429 by rate limit budget", ["budget"])
+
+TASK_EVENT_SUBSCRIBERS = Gauge("task_event_subscribers", "Clients subscribed to GET /tasks/stream", multiprocess_mode="livesum")
+
+BCRYPT_LATENCY = Histogram("bcrypt_duration_seconds", "bcrypt hashing/verification time including pool queueing", ["operation"],
+                           buckets=(0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, float("inf")))
+
+def observe_bcrypt(operation, seconds):
+    BCRYPT_LATENCY.labels(operation).observe(seconds)
+
+##################################################
+
+def before_cursor_execute(connection, cursor, statement, parameters, context, executemany):
+    connection.info.setdefault("query_start_time", []).append(time.perf_counter())
+
+def after_cursor_execute(connection, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - connection.info["query_start_time"].pop()
+    DB_QUERY_LATENCY.labels(db.current_function.get() or "other").observe(elapsed)
+
+def instrument_engine(engine):
+    sa.event.listen(engine, "before_cursor_execute", before_cursor_execute)
+    sa.event.listen(engine, "after_cursor_execute", after_cursor_execute)
+    sa.event.listen(engine, "checkout", lambda *args: DB_POOL_CHECKED_OUT.inc())
+    sa.event.listen(engine, "checkin", lambda *args: DB_POOL_CHECKED_OUT.dec())
+    DB_POOL_SIZE.inc(engine.pool.size())
+
+##################################################
+
+def before_request():
+    g.metrics_start_time = time.perf_counter()
+    REQUESTS_IN_FLIGHT.inc()
+
+def after_request(response):
+    # Label by route template, not path, to keep cardinality bounded
+    route = request.url_rule.rule if request.url_rule is not None else "unmatched"
+    elapsed = time.perf_counter() - g.get("metrics_start_time", time.perf_counter())
+    REQUEST_COUNT.labels(request.method, route, response.status_code).inc()
+    REQUEST_LATENCY.labels(request.method, route, response.status_code).observe(elapsed)
+    return response
+
+def teardown_request(exception):
+    if g.pop("metrics_start_time", None) is not None:
+        REQUESTS_IN_FLIGHT.dec()
+
+def instrument_flask(app):
+    app.before_request(before_request)
+    app.after_request(after_request)
+    app.teardown_request(teardown_request)
+
+def render():
+    if os.environ.get("PROMETHEUS_MULTIPROC_DIR"):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+
+    return generate_latest(registry), CONTENT_TYPE_LATEST
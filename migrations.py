@@ -0,0 +1,149 @@
+import os
+import sys
+import argparse
+
+import sqlalchemy as sa
+from dotenv import load_dotenv
+
+import db
+import shards
+
+# Versioned schema management, run once per deploy before the app starts, e.g.
+# 'python migrations.py' (or 'python migrations.py --env .env.testing').
+# Applied versions are recorded in schema_migrations. Every statement is idempotent, so databases created
+# by the old drop/create startup are adopted without losing data. New schema changes are appended to
+# MIGRATIONS (never edit an applied one) and mirrored in db.metadata.
+
+MIGRATIONS = [
+    (1, "create user and task tables", [
+        '''CREATE TABLE IF NOT EXISTS "User" (
+               id SERIAL PRIMARY KEY,
+               username VARCHAR UNIQUE,
+               password_hash VARCHAR
+           )''',
+        '''CREATE TABLE IF NOT EXISTS "Task" (
+               id SERIAL PRIMARY KEY,
+               user_id INTEGER REFERENCES "User" (id),
+               title VARCHAR,
+               description VARCHAR,
+               due_date TIMESTAMP WITHOUT TIME ZONE,
+               is_completed BOOLEAN
+           )''',
+    ]),
+    (2, "index per-user task listings", [
+        'CREATE INDEX IF NOT EXISTS ix_task_user_id_id ON "Task" (user_id, id)',
+        'CREATE INDEX IF NOT EXISTS ix_task_user_id_due_date ON "Task" (user_id, due_date, id)',
+        'CREATE INDEX IF NOT EXISTS ix_task_user_id_open ON "Task" (user_id, id) WHERE is_completed IS NOT true',
+    ]),
+    (3, "add user task_version", [
+        'ALTER TABLE "User" ADD COLUMN IF NOT EXISTS task_version BIGINT NOT NULL DEFAULT 0',
+    ]),
+    (4, "add task full-text search", [
+        '''CREATE INDEX IF NOT EXISTS ix_task_search_vector ON "Task" USING gin ((
+               setweight(to_tsvector('simple'::regconfig, coalesce(title, '')), 'A') || setweight(to_tsvector('simple'::regconfig, coalesce(description, '')), 'B')
+           ))''',
+    ]),
+    (5, "index task summary", [
+        'CREATE INDEX IF NOT EXISTS ix_task_user_id_is_completed_due_date ON "Task" (user_id, is_completed, due_date)',
+    ]),
+    (6, "add task archive", [
+        'ALTER TABLE "Task" ADD COLUMN IF NOT EXISTS completed_at TIMESTAMP WITHOUT TIME ZONE',
+        # Completion time of existing tasks is unknown, they are archived counting from the migration
+        'UPDATE "Task" SET completed_at = now() WHERE is_completed IS TRUE AND completed_at IS NULL',
+        '''CREATE OR REPLACE FUNCTION task_set_completed_at() RETURNS trigger AS $$
+               BEGIN
+                   NEW.completed_at := CASE WHEN NEW.is_completed IS TRUE THEN now() END;
+                   RETURN NEW;
+               END
+               $$ LANGUAGE plpgsql''',
+        'CREATE OR REPLACE TRIGGER task_completed_at_insert BEFORE INSERT ON "Task" FOR EACH ROW WHEN (NEW.is_completed IS TRUE) EXECUTE FUNCTION task_set_completed_at()',
+        'CREATE OR REPLACE TRIGGER task_completed_at_update BEFORE UPDATE OF is_completed ON "Task" FOR EACH ROW WHEN (OLD.is_completed IS DISTINCT FROM NEW.is_completed) EXECUTE FUNCTION task_set_completed_at()',
+        'CREATE INDEX IF NOT EXISTS ix_task_completed_at ON "Task" (completed_at) WHERE is_completed IS TRUE',
+        '''CREATE TABLE IF NOT EXISTS "TaskArchive" (
+               id INTEGER PRIMARY KEY,
+               user_id INTEGER REFERENCES "User" (id),
+               title VARCHAR,
+               description VARCHAR,
+               due_date TIMESTAMP WITHOUT TIME ZONE,
+               is_completed BOOLEAN,
+               completed_at TIMESTAMP WITHOUT TIME ZONE,
+               archived_at TIMESTAMP WITHOUT TIME ZONE NOT NULL DEFAULT now()
+           )''',
+        'CREATE INDEX IF NOT EXISTS ix_task_archive_user_id_id ON "TaskArchive" (user_id, id)',
+        'CREATE INDEX IF NOT EXISTS ix_task_archive_user_id_due_date ON "TaskArchive" (user_id, due_date, id)',
+    ]),
+    (7, "add user directory", [
+        '''CREATE TABLE IF NOT EXISTS "UserDirectory" (
+               user_id INTEGER PRIMARY KEY,
+               username VARCHAR NOT NULL UNIQUE,
+               shard INTEGER NOT NULL DEFAULT 0
+           )''',
+        # Existing users are on the first database. On the other shards the table stays empty
+        'INSERT INTO "UserDirectory" (user_id, username) SELECT id, username FROM "User" WHERE username IS NOT NULL ON CONFLICT DO NOTHING',
+        # Tasks copied between shards keep their completion time
+        '''CREATE OR REPLACE FUNCTION task_set_completed_at() RETURNS trigger AS $$
+               BEGIN
+                   NEW.completed_at := CASE WHEN NEW.is_completed IS TRUE THEN coalesce(NEW.completed_at, now()) END;
+                   RETURN NEW;
+               END
+               $$ LANGUAGE plpgsql''',
+    ]),
+]
+
+# Arbitrary key, serializes concurrent migration runs (e.g. several containers starting at once)
+MIGRATION_LOCK_ID = 4274301
+
+def get_applied_versions(connection):
+    return set(connection.execute(sa.text("SELECT version FROM schema_migrations")).scalars())
+
+def migrate(engine, target=None):
+    # Applies pending migrations up to target (default all), each in its own transaction. Returns the applied versions
+    applied = []
+    with engine.begin() as connection:
+        connection.execute(sa.text("SELECT pg_advisory_xact_lock(:lock_id)"), {"lock_id": MIGRATION_LOCK_ID})
+        connection.execute(sa.text('''CREATE TABLE IF NOT EXISTS schema_migrations (
+                                          version INTEGER PRIMARY KEY,
+                                          name VARCHAR NOT NULL,
+                                          applied_at TIMESTAMP WITHOUT TIME ZONE NOT NULL DEFAULT now()
+                                      )'''))
+        done = get_applied_versions(connection)
+
+        for version, name, statements in MIGRATIONS:
+            if version in done or (target is not None and version > target): continue
+
+            with connection.begin_nested():
+                for statement in statements:
+                    connection.execute(sa.text(statement))
+                connection.execute(sa.text("INSERT INTO schema_migrations (version, name) VALUES (:version, :name)"), {"version": version, "name": name})
+            applied.append(version)
+
+    return applied
+
+def get_schema_version(engine):
+    with engine.connect() as connection:
+        if not sa.inspect(connection).has_table("schema_migrations"): return 0
+        return max(get_applied_versions(connection), default=0)
+
+def main():
+    parser = argparse.ArgumentParser(description="Apply pending schema migrations")
+    parser.add_argument("--env", default=".env", help="dotenv file with the POSTGRES_* settings")
+    parser.add_argument("--target", type=int, help="stop after this version")
+    parser.add_argument("--status", action="store_true", help="only print the current schema version")
+    args = parser.parse_args()
+
+    load_dotenv(args.env)
+    engine = db.create_db_engine(os.environ.get("POSTGRES_HOST"), os.environ.get("POSTGRES_PORT"), os.environ.get("POSTGRES_USER"), os.environ.get("POSTGRES_PASSWORD"), os.environ.get("POSTGRES_DB"))
+    # Every shard (POSTGRES_SHARDS) gets the same schema
+    engines = shards.create_shard_map(engine, os.environ.get("POSTGRES_USER"), os.environ.get("POSTGRES_PASSWORD"), os.environ.get("POSTGRES_DB"), pool_size=1, max_overflow=0).engines
+
+    for shard, engine in enumerate(engines):
+        prefix = f"Shard {shard}: " if len(engines) > 1 else ""
+        if not args.status:
+            applied = migrate(engine, args.target)
+            print(prefix + (f"Applied migrations: {applied}" if applied else "No pending migrations"))
+
+        print(prefix + f"Schema version: {get_schema_version(engine)} (latest {MIGRATIONS[-1][0]})")
+        engine.dispose()
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,287 @@
+import os
+import re
+import sys
+import json
+import time
+import queue
+import logging
+import secrets
+import threading
+import contextlib
+import contextvars
+from collections import Counter
+
+import sqlalchemy as sa
+from flask import request, g
+
+import db
+from ServiceUnavailableException import ServiceUnavailableException
+
+# Opt-in request profiling for app.py. With PROFILING_ENABLED=true every request records how long it spent in
+# its phases: the auth decorator (with jwt.decode), bcrypt, every db.py function and JSON serialization, plus
+# the SQL it ran. Requests slower than PROFILING_SLOW_REQUEST_MS are logged (logger 'profiling') as one JSON
+# line with that breakdown, without the bound SQL parameters unless PROFILING_LOG_PARAMETERS=true (password
+# hashes are never logged); PROFILING_EXPLAIN=true adds EXPLAIN ANALYZE plans of their slowest SELECTs, run
+# again afterwards on a separate connection by one background thread per worker, at most once per
+# PROFILING_EXPLAIN_INTERVAL seconds and dropped while PROFILING_EXPLAIN_QUEUE_SIZE are waiting. Bodies streamed after the handler returns are not covered.
+# POST /admin/profile with an 'X-Admin-Token: <PROFILING_ADMIN_TOKEN>' header samples the stacks of all threads
+# of the worker serving it for ?seconds=N (at most PROFILING_MAX_SECONDS) on a background thread and streams
+# them in collapsed format ('thread;outer;...;inner count' lines) for flamegraph.pl or speedscope. This needs
+# a threaded worker, the other requests of a sync worker wait for the profile instead of showing up in it.
+
+PROFILING_ENABLED = os.environ.get("PROFILING_ENABLED", "false").lower() == "true"
+PROFILING_SLOW_REQUEST_MS = float(os.environ.get("PROFILING_SLOW_REQUEST_MS", 500))
+PROFILING_MAX_QUERIES = int(os.environ.get("PROFILING_MAX_QUERIES", 100))
+PROFILING_LOG_PARAMETERS = os.environ.get("PROFILING_LOG_PARAMETERS", "false").lower() == "true"
+PROFILING_EXPLAIN = os.environ.get("PROFILING_EXPLAIN", "false").lower() == "true"
+PROFILING_EXPLAIN_MAX = int(os.environ.get("PROFILING_EXPLAIN_MAX", 3))
+PROFILING_EXPLAIN_INTERVAL = float(os.environ.get("PROFILING_EXPLAIN_INTERVAL", 10))
+PROFILING_EXPLAIN_QUEUE_SIZE = int(os.environ.get("PROFILING_EXPLAIN_QUEUE_SIZE", 4))
+PROFILING_ADMIN_TOKEN = os.environ.get("PROFILING_ADMIN_TOKEN", "")
+# Kept well below the gunicorn worker timeout (see gunicorn.conf.py)
+PROFILING_MAX_SECONDS = min(float(os.environ.get("PROFILING_MAX_SECONDS", 10)), int(os.environ.get("GUNICORN_TIMEOUT", 30)) / 2)
+
+# Bounds the re-run of a slow query for its plan
+EXPLAIN_TIMEOUT_MS = 5000
+# Bind parameters (e.g. password_hash of insert_user) masked even with PROFILING_LOG_PARAMETERS=true
+SECRET_PARAMETER = re.compile(r"password", re.IGNORECASE)
+
+logger = logging.getLogger("profiling")
+
+current_profile = contextvars.ContextVar("request_profile", default=None)
+
+class RequestProfile:
+    """ Phases and SQL statements of one request, times in seconds since its start """
+
+    def __init__(self, max_queries=PROFILING_MAX_QUERIES):
+        self.start = time.perf_counter()
+        self.max_queries = max_queries
+        self.phases = []
+        self.queries = []
+        self.dropped_queries = 0
+
+    def add_phase(self, name, seconds):
+        self.phases.append((name, time.perf_counter() - seconds - self.start, seconds))
+
+    def add_query(self, function, statement, parameters, seconds, engine):
+        if len(self.queries) >= self.max_queries:
+            self.dropped_queries += 1
+            return
+        self.queries.append({"function": function, "statement": statement, "parameters": parameters, "seconds": seconds, "engine": engine})
+
+    def totals(self):
+        # Phase name -> (count, seconds)
+        totals = {}
+        for name, _, seconds in self.phases:
+            count, total = totals.get(name, (0, 0.0))
+            totals[name] = (count + 1, total + seconds)
+        return totals
+
+    def report(self, seconds, **details):
+        return {
+            **details,
+            "duration_ms": round(seconds * 1000, 3),
+            "phases": [{"name": name, "start_ms": round(start * 1000, 3), "duration_ms": round(duration * 1000, 3)} for name, start, duration in self.phases],
+            "totals": {name: {"count": count, "duration_ms": round(total * 1000, 3)} for name, (count, total) in self.totals().items()},
+            "queries": [{"function": query["function"], "duration_ms": round(query["seconds"] * 1000, 3), "statement": query["statement"], **loggable_parameters(query["parameters"])} for query in self.queries],
+            "dropped_queries": self.dropped_queries,
+        }
+
+def loggable_parameters(parameters):
+    # {"parameters": ...} for the log record, {} unless enabled. Positional ones can not be told apart
+    if not PROFILING_LOG_PARAMETERS or parameters is None: return {}
+    if not isinstance(parameters, dict): return {"parameters": "<redacted>"}
+    return {"parameters": repr({name: "<redacted>" if SECRET_PARAMETER.search(name) else value for name, value in parameters.items()})[:1000]}
+
+@contextlib.contextmanager
+def phase(name):
+    profile = current_profile.get()
+    if profile is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        profile.add_phase(name, time.perf_counter() - start)
+
+def record_query_function(name, seconds):
+    profile = current_profile.get()
+    if profile is not None: profile.add_phase(f"db.{name}", seconds)
+
+db.query_function_hooks.append(record_query_function)
+
+##################################################
+
+def explain(query):
+    # Only SELECTs are re-run, EXPLAIN ANALYZE executes the statement. Rolled back all the same
+    if query["engine"] is None or not isinstance(query["parameters"], (dict, tuple)) or not query["statement"].lstrip().upper().startswith("SELECT"): return None
+    with query["engine"].connect() as connection:
+        try:
+            connection.exec_driver_sql(f"SET LOCAL statement_timeout = {EXPLAIN_TIMEOUT_MS}")
+            rows = connection.exec_driver_sql("EXPLAIN (ANALYZE, BUFFERS) " + query["statement"], query["parameters"]).all()
+            return "\n".join(row[0] for row in rows)
+        except sa.exc.DBAPIError as e:
+            return f"EXPLAIN failed: {e.orig}"
+        finally:
+            connection.rollback()
+
+def log_slow_request(profile, record, with_explain):
+    if with_explain:
+        slowest = sorted(profile.queries, key=lambda query: query["seconds"], reverse=True)[:PROFILING_EXPLAIN_MAX]
+        record["explain"] = [{"function": query["function"], "statement": query["statement"], "plan": plan} for query in slowest if (plan := explain(query)) is not None]
+    logger.warning("Slow request %s", json.dumps(record, default=str))
+
+class ExplainQueue:
+    """ Captures the plans of slow requests on one background thread, so a latency spike adds a single connection
+        re-running queries at a time. Requests within interval seconds of the last one or while max_size are
+        waiting are dropped """
+
+    def __init__(self, max_size, interval, clock=time.monotonic):
+        self.max_size = max_size
+        self.interval = interval
+        self.clock = clock
+        self.dropped = 0
+        self._jobs = None
+        self._pid = None
+        self._last = None
+        self._lock = threading.Lock()
+
+    def _ensure_started(self):
+        # Created lazily and per process, so gunicorn workers forked from a preloaded app get their own thread
+        if self._pid != os.getpid():
+            self._jobs = queue.Queue(self.max_size)
+            threading.Thread(target=self._run, args=(self._jobs,), name="profiling-explain", daemon=True).start()
+            self._pid = os.getpid()
+
+    def submit(self, profile, record):
+        # False when dropped, the caller logs the request without plans
+        with self._lock:
+            self._ensure_started()
+            now = self.clock()
+            if self._last is not None and now - self._last < self.interval:
+                self.dropped += 1
+                return False
+            try:
+                self._jobs.put_nowait((profile, record))
+            except queue.Full:
+                self.dropped += 1
+                return False
+            self._last = now
+            return True
+
+    def _run(self, jobs):
+        while True:
+            profile, record = jobs.get()
+            try:
+                log_slow_request(profile, record, True)
+            except Exception:
+                # E.g. no pooled connection in time, the request is still logged
+                logger.exception("Capturing query plans failed")
+                log_slow_request(profile, record, False)
+
+explain_queue = ExplainQueue(PROFILING_EXPLAIN_QUEUE_SIZE, PROFILING_EXPLAIN_INTERVAL)
+
+##################################################
+
+def before_cursor_execute(connection, cursor, statement, parameters, context, executemany):
+    if current_profile.get() is not None:
+        connection.info.setdefault("profiling_start_time", []).append(time.perf_counter())
+
+def after_cursor_execute(connection, cursor, statement, parameters, context, executemany):
+    profile = current_profile.get()
+    if profile is None or not connection.info.get("profiling_start_time"): return
+    elapsed = time.perf_counter() - connection.info["profiling_start_time"].pop()
+    profile.add_query(db.current_function.get() or "other", statement, None if executemany else parameters, elapsed, connection.engine)
+
+def instrument_engine(engine):
+    sa.event.listen(engine, "before_cursor_execute", before_cursor_execute)
+    sa.event.listen(engine, "after_cursor_execute", after_cursor_execute)
+
+##################################################
+
+def before_request():
+    if not PROFILING_ENABLED: return
+    g.profile_token = current_profile.set(RequestProfile())
+
+def after_request(response):
+    profile = current_profile.get()
+    if profile is None: return response
+    elapsed = time.perf_counter() - profile.start
+    if elapsed * 1000 >= PROFILING_SLOW_REQUEST_MS:
+        route = request.url_rule.rule if request.url_rule is not None else "unmatched"
+        record = profile.report(elapsed, method=request.method, route=route, path=request.path, status=response.status_code)
+        # The plans are captured off the request thread, so the slow request itself is not held up further
+        if not (PROFILING_EXPLAIN and profile.queries and explain_queue.submit(profile, record)):
+            log_slow_request(profile, record, False)
+    return response
+
+def teardown_request(exception):
+    token = g.pop("profile_token", None)
+    if token is not None: current_profile.reset(token)
+
+def instrument_flask(app):
+    app.before_request(before_request)
+    app.after_request(after_request)
+    app.teardown_request(teardown_request)
+
+    # jsonify and dict return values are serialized by app.json.response
+    response = app.json.response
+    def timed_response(*args, **kwargs):
+        with phase("serialization"):
+            return response(*args, **kwargs)
+    app.json.response = timed_response
+
+##################################################
+
+def admin_authorized(token):
+    # The endpoint does not exist while no PROFILING_ADMIN_TOKEN is configured
+    return PROFILING_ADMIN_TOKEN != "" and token is not None and secrets.compare_digest(token.encode(), PROFILING_ADMIN_TOKEN.encode())
+
+def frame_name(frame):
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+_sampling = threading.Lock()
+
+def start_profile(seconds, interval=0.005):
+    # Samples every other thread of this process on a background thread, one profile at a time. Returns an
+    # iterator yielding the collapsed stacks once done, for a response body streamed while sampling
+    if not _sampling.acquire(blocking=False): raise ServiceUnavailableException("Service Unavailable: A profile is already running", int(seconds) + 1)
+    counts = Counter()
+    # The caller only waits for the result
+    exclude = {threading.get_ident()}
+    try:
+        sampler = threading.Thread(target=sample_into, args=(counts, seconds, interval, exclude), name="profiling-sampler", daemon=True)
+        sampler.start()
+    except Exception:
+        _sampling.release()
+        raise
+
+    def collapsed_stacks():
+        sampler.join()
+        for stack, count in counts.most_common():
+            yield f"{stack} {count}\n"
+    return collapsed_stacks()
+
+def sample_into(counts, seconds, interval, exclude):
+    # Wall-clock samples, counted per collapsed stack ('thread;outer;...;inner')
+    try:
+        exclude = exclude | {threading.get_ident()}
+        deadline = time.monotonic() + seconds
+        while time.monotonic() < deadline:
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident in exclude: continue
+                stack = []
+                while frame is not None:
+                    stack.append(frame_name(frame))
+                    frame = frame.f_back
+                stack.append(names.get(ident, f"thread-{ident}"))
+                counts[";".join(reversed(stack))] += 1
+            time.sleep(interval)
+    finally:
+        _sampling.release()
+
+def sample_stacks(seconds, interval=0.005):
+    return "".join(start_profile(seconds, interval))
@@ -0,0 +1,158 @@
+import os
+import math
+import time
+import threading
+from functools import wraps
+from collections import OrderedDict
+
+import metrics
+from TooManyRequestsException import TooManyRequestsException
+
+# Token bucket rate limiting. Budgets are '<requests>/<seconds>': a client may burst up to <requests> and
+# regains them at <requests>/<seconds> per second, '0' disables the budget. Protected routes are limited per
+# user id, /register and /login per client address on the separate 'auth' budget as every call costs a bcrypt
+# run, other unauthenticated routes per client address.
+# Buckets live in the worker process (so limits apply per worker) unless CACHE_REDIS_URL is set.
+
+def parse_budget(value):
+    # -> (capacity, tokens per second) or None when disabled
+    if value is None or value.strip() in ("", "0"): return None
+    requests, _, seconds = value.partition("/")
+    capacity, seconds = int(requests), float(seconds or 1)
+    if capacity < 1 or seconds <= 0: raise ValueError(f"Invalid rate limit budget '{value}': Must be '<requests>/<seconds>'")
+    return capacity, capacity / seconds
+
+class TokenBucketStore:
+    """ Bounded in-process token buckets, least recently used buckets are dropped (refilled) first """
+
+    def __init__(self, maxsize=100000, clock=time.monotonic):
+        self.maxsize = maxsize
+        self.clock = clock
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def take(self, key, capacity, rate):
+        # Takes a token, returns 0 on success or the seconds until the next token
+        with self._lock:
+            now = self.clock()
+            tokens, updated = self._buckets.get(key, (capacity, now))
+            tokens = min(capacity, tokens + (now - updated) * rate)
+
+            retry_after = 0
+            if tokens >= 1:
+                tokens -= 1
+            else:
+                retry_after = (1 - tokens) / rate
+
+            self._buckets[key] = (tokens, now)
+            self._buckets.move_to_end(key)
+            while len(self._buckets) > self.maxsize:
+                self._buckets.popitem(last=False)
+            return retry_after
+
+    def clear(self):
+        with self._lock:
+            self._buckets.clear()
+
+    def stats(self):
+        return {"backend": "memory", "buckets": len(self._buckets), "maxsize": self.maxsize}
+
+# Refill and take in one round trip, timed by the Redis clock so all workers agree
+TAKE_SCRIPT = """
+local capacity = tonumber(ARGV[1])
+local rate = tonumber(ARGV[2])
+local time = redis.call('TIME')
+local now = tonumber(time[1]) + tonumber(time[2]) / 1000000
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'updated')
+local tokens = math.min(capacity, (tonumber(bucket[1]) or capacity) + (now - (tonumber(bucket[2]) or now)) * rate)
+local retry_after = 0
+if tokens >= 1 then tokens = tokens - 1 else retry_after = (1 - tokens) / rate end
+redis.call('HSET', KEYS[1], 'tokens', tokens, 'updated', now)
+redis.call('PEXPIRE', KEYS[1], math.ceil(capacity / rate * 1000))
+return tostring(retry_after)
+"""
+
+class RedisTokenBucketStore:
+    """ Token buckets shared between worker processes """
+
+    def __init__(self, url, namespace):
+        # Optional dependency, only needed when a shared backend is configured
+        import redis
+
+        self.client = redis.Redis.from_url(url)
+        self.namespace = namespace
+        self.errors = 0
+        self._redis_error = redis.RedisError
+        self._take = self.client.register_script(TAKE_SCRIPT)
+
+    def take(self, key, capacity, rate):
+        try:
+            return float(self._take(keys=[f"{self.namespace}:{key}"], args=[capacity, rate]))
+        except self._redis_error:
+            # Fail open, an unavailable limiter must not take the API down with it
+            self.errors += 1
+            return 0
+
+    def clear(self):
+        for key in self.client.scan_iter(match=f"{self.namespace}:*"):
+            self.client.delete(key)
+
+    def stats(self):
+        return {"backend": "redis", "errors": self.errors}
+
+def create_rate_limit_store(namespace, maxsize=100000):
+    redis_url = os.environ.get("CACHE_REDIS_URL")
+    if redis_url:
+        return RedisTokenBucketStore(redis_url, namespace)
+
+    return TokenBucketStore(maxsize)
+
+class RateLimiter:
+    """ Checks requests against named budgets, raising TooManyRequestsException once a key's bucket is empty """
+
+    def __init__(self, store, budgets):
+        self.store = store
+        self.budgets = budgets
+
+    def check(self, budget, key):
+        limit = self.budgets.get(budget)
+        if limit is None: return
+
+        retry_after = self.store.take(f"{budget}:{key}", *limit)
+        if retry_after > 0:
+            metrics.RATE_LIMITED_REQUESTS.labels(budget).inc()
+            raise TooManyRequestsException("Too Many Requests: Rate limit exceeded", math.ceil(retry_after))
+
+    def clear(self):
+        self.store.clear()
+
+    def stats(self):
+        return self.store.stats()
+
+rate_limiter = RateLimiter(create_rate_limit_store("rate_limit", int(os.environ.get("RATE_LIMIT_MAX_BUCKETS", 100000))), {
+    "user": parse_budget(os.environ.get("RATE_LIMIT_USER", "1200/60")),
+    "client": parse_budget(os.environ.get("RATE_LIMIT_CLIENT", "600/60")),
+    "auth": parse_budget(os.environ.get("RATE_LIMIT_AUTH", "20/60")),
+})
+
+# Number of reverse proxies in front of the app appending to X-Forwarded-For, 0 uses the peer address
+RATE_LIMIT_TRUSTED_PROXIES = int(os.environ.get("RATE_LIMIT_TRUSTED_PROXIES", 0))
+
+def client_address(peer_address, forwarded_for):
+    # Only the entries added by trusted proxies can not be forged by the client
+    if RATE_LIMIT_TRUSTED_PROXIES == 0 or not forwarded_for: return peer_address
+    addresses = [address.strip() for address in forwarded_for.split(",")]
+    return addresses[max(0, len(addresses) - RATE_LIMIT_TRUSTED_PROXIES)]
+
+from flask import request
+
+def limit_by_client(budget):
+    def decorator(func):
+        @wraps(func)
+        def inner_func(*args, **kwargs):
+            rate_limiter.check(budget, client_address(request.remote_addr, request.headers.get("X-Forwarded-For")))
+            return func(*args, **kwargs)
+
+        return inner_func
+
+    return decorator
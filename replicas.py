@@ -0,0 +1,126 @@
+import os
+import time
+import itertools
+import threading
+
+import sqlalchemy as sa
+
+import db
+import cache
+
+# Read routing to optional streaming replicas of the primary, listed in POSTGRES_REPLICAS as
+# 'host:port,host:port' (same user, password and database as the primary).
+# Reads go round robin to the healthy replicas. A background thread checks every REPLICA_CHECK_INTERVAL seconds
+# which replicas are reachable, in recovery and at most REPLICA_MAX_LAG_BYTES of WAL behind, a replica whose
+# query fails with a connection error leaves the rotation right away.
+# Read-your-writes: after a user's write commits the primary's WAL position is stored for REPLICA_PIN_SECONDS,
+# in that window the user only reads from replicas that replayed past it (or from the primary). Pins are shared
+# between workers through CACHE_REDIS_URL, otherwise they only hold within the worker that served the write.
+
+def parse_lsn(lsn):
+    # '16/B374D848' -> position in bytes
+    high, low = lsn.split("/")
+    return (int(high, 16) << 32) + int(low, 16)
+
+def parse_replica_hosts(value):
+    hosts = []
+    for item in (value or "").split(","):
+        if item.strip() == "": continue
+        host, _, port = item.strip().rpartition(":")
+        hosts.append((host, port) if host else (port, "5432"))
+    return hosts
+
+class ReplicaRouter:
+    """ Picks the database for reads: a healthy replica that has the user's latest write, else the primary """
+
+    def __init__(self, primary, replicas, pin_cache, max_lag_bytes=16 * 1024 * 1024, check_interval=1):
+        self.primary = primary
+        # Engines used for health checks, index i stands for the i-th replica in every app
+        self.replicas = replicas
+        self.pin_cache = pin_cache
+        self.max_lag_bytes = max_lag_bytes
+        self.check_interval = check_interval
+        # Replayed WAL position per replica, None while out of rotation (also before the first check)
+        self._replay_lsns = [None] * len(replicas)
+        self._next = itertools.count()
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def watch(self, index, engine):
+        # Takes a replica out of rotation as soon as one of its connections fails
+        def handle_error(context):
+            if context.is_disconnect or isinstance(context.sqlalchemy_exception, sa.exc.OperationalError):
+                self.mark_unhealthy(index)
+        sa.event.listen(engine, "handle_error", handle_error)
+
+    def _ensure_started(self):
+        # Started lazily and per process, like the task event listener
+        with self._lock:
+            if self._pid != os.getpid():
+                self._pid = os.getpid()
+                threading.Thread(target=self._run, name="replica-health-check", daemon=True).start()
+
+    def _run(self):
+        while True:
+            self.check()
+            time.sleep(self.check_interval)
+
+    def check(self):
+        try:
+            with self.primary.connect() as connection:
+                primary_lsn = parse_lsn(db.get_current_wal_lsn(connection))
+        except sa.exc.SQLAlchemyError:
+            # Lag can not be judged without the primary, replicas stay in rotation if they answer
+            primary_lsn = None
+
+        for index, engine in enumerate(self.replicas):
+            try:
+                with engine.connect() as connection:
+                    replay_lsn = db.get_replay_lsn(connection)
+            except sa.exc.SQLAlchemyError:
+                replay_lsn = None
+
+            # NULL replay position: not a replica (anymore), e.g. after a promotion
+            healthy = replay_lsn is not None and (primary_lsn is None or primary_lsn - parse_lsn(replay_lsn) <= self.max_lag_bytes)
+            self._replay_lsns[index] = parse_lsn(replay_lsn) if healthy else None
+
+    def mark_unhealthy(self, index):
+        self._replay_lsns[index] = None
+
+    def read_replica(self, user_id=None):
+        # Index of the replica to read from, None for the primary
+        if len(self.replicas) == 0: return None
+        self._ensure_started()
+
+        pinned_lsn = self.pin_cache.get(user_id) if user_id is not None else None
+        required_lsn = parse_lsn(pinned_lsn) if pinned_lsn is not None else 0
+        candidates = [index for index, replay_lsn in enumerate(self._replay_lsns) if replay_lsn is not None and replay_lsn >= required_lsn]
+        if len(candidates) == 0: return None
+        return candidates[next(self._next) % len(candidates)]
+
+    def read_engine(self, user_id=None):
+        index = self.read_replica(user_id)
+        return self.primary if index is None else self.replicas[index]
+
+    def pin(self, user_id, lsn):
+        if len(self.replicas) > 0 and user_id is not None: self.pin_cache.set(user_id, lsn)
+
+    def record_write(self, user_id, connection):
+        # Called after the user's write committed on connection (primary)
+        if len(self.replicas) > 0 and user_id is not None:
+            self.pin(user_id, db.get_current_wal_lsn(connection))
+
+    def stats(self):
+        if len(self.replicas) > 0: self._ensure_started()
+        return {"replicas": len(self.replicas), "healthy": sum(1 for replay_lsn in self._replay_lsns if replay_lsn is not None)}
+
+def create_replica_router(primary, username, password, dbname, **pool_options):
+    hosts = parse_replica_hosts(os.environ.get("POSTGRES_REPLICAS"))
+    replicas = [db.create_db_engine(host, port, username, password, dbname, **pool_options) for host, port in hosts]
+    router = ReplicaRouter(primary, replicas,
+                           cache.create_cache("replica_pin", int(os.environ.get("REPLICA_PIN_CACHE_SIZE", 10000)), int(os.environ.get("REPLICA_PIN_SECONDS", 5))),
+                           int(os.environ.get("REPLICA_MAX_LAG_BYTES", 16 * 1024 * 1024)),
+                           float(os.environ.get("REPLICA_CHECK_INTERVAL", 1)))
+    for index, engine in enumerate(replicas):
+        router.watch(index, engine)
+    return router
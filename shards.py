@@ -0,0 +1,169 @@
+import os
+import sys
+import time
+import zlib
+import argparse
+
+import psycopg2
+import sqlalchemy as sa
+from dotenv import load_dotenv
+
+import db
+import cache
+from InvalidInputException import InvalidInputException
+
+# Horizontal sharding: every user, with all of their tasks, lives on one of several Postgres databases.
+# Shard 0 is the POSTGRES_* database, further shards are listed in POSTGRES_SHARDS as
+# 'host:port/dbname,host:port/dbname' (same user and password). Shard 0 also holds the UserDirectory table
+# mapping every user to its shard, looked up by username at login and by user_id (cached for
+# SHARD_CACHE_SECONDS) on every request. New users are placed by a hash of their username.
+# Each shard draws User and Task ids from its own SHARD_ID_RANGE sized range of the sequences
+# ('python shards.py init'), so ids are unique across shards and users keep theirs when moved.
+# 'python shards.py move <user_id> <shard>' moves a user online, 'python shards.py status' lists the shards.
+
+SHARD_ID_RANGE = int(os.environ.get("SHARD_ID_RANGE", 2 ** 27))
+
+def parse_shard_dsns(value, default_dbname=None):
+    # 'host:port/dbname' items -> [(host, port, dbname)]
+    dsns = []
+    for item in (value or "").split(","):
+        if item.strip() == "": continue
+        address, _, dbname = item.strip().partition("/")
+        host, _, port = address.rpartition(":")
+        dsns.append((host, port, dbname or default_dbname) if host else (port, "5432", dbname or default_dbname))
+    return dsns
+
+class ShardMap:
+    """ Finds the database of a user: shard 0 when there is only one, else the one named by the directory """
+
+    def __init__(self, engines, shard_cache, id_range=SHARD_ID_RANGE):
+        # engines[0] is the primary and holds the directory
+        self.engines = engines
+        self.shard_cache = shard_cache
+        self.id_range = id_range
+
+    @property
+    def sharded(self):
+        return len(self.engines) > 1
+
+    def place(self, username):
+        # Shard of a new user. crc32 as Python's hash() differs between processes
+        return zlib.crc32(username.encode()) % len(self.engines)
+
+    def id_bounds(self, shard):
+        return shard * self.id_range + 1, (shard + 1) * self.id_range
+
+    def cached_shard(self, user_id):
+        if not self.sharded: return 0
+        shard = self.shard_cache.get(user_id)
+        return int(shard) if shard is not None else None
+
+    def remember(self, user_id, shard):
+        if self.sharded and shard is not None: self.shard_cache.set(user_id, str(shard))
+
+    def shard_of(self, user_id, connection=None):
+        # Unknown users are routed to shard 0, where the lookup of the user itself then fails
+        shard = self.cached_shard(user_id)
+        if shard is not None: return shard
+
+        if connection is not None:
+            shard = db.get_user_shard(user_id, connection)
+        else:
+            with self.engines[0].connect() as connection:
+                shard = db.get_user_shard(user_id, connection)
+        self.remember(user_id, shard)
+        return shard or 0
+
+    def engine(self, user_id):
+        return self.engines[self.shard_of(user_id)]
+
+    def configure_id_ranges(self):
+        for shard, engine in enumerate(self.engines):
+            with engine.begin() as connection:
+                db.configure_id_range(connection, *self.id_bounds(shard))
+
+    def move_user(self, user_id, target, drain_seconds=None, retries=3):
+        # Copies the user to target while its rows are locked on the old shard, switches the directory, waits
+        # until no worker routes by a cached shard anymore and deletes the old rows. Writes of the user wait
+        # for the move, writes still sent to the old shard then fail. Returns the number of moved tasks
+        if not isinstance(target, int) or not 0 <= target < len(self.engines): raise InvalidInputException(f"Invalid shard: Must be between 0 and {len(self.engines) - 1}")
+
+        with self.engines[0].connect() as directory:
+            source = db.get_user_shard(user_id, directory)
+            directory.commit()
+            if source is None: raise InvalidInputException("Invalid user_id: user_id not found")
+            if source == target: return 0
+
+            with self.engines[source].connect() as source_connection, self.engines[target].connect() as target_connection:
+                # Only taking the locks can deadlock with a concurrent write, it is retried as nothing changed yet
+                for attempt in range(retries):
+                    try:
+                        moved = db.copy_user(user_id, source_connection, target_connection)
+                        break
+                    except sa.exc.OperationalError as e:
+                        source_connection.rollback()
+                        target_connection.rollback()
+                        if not isinstance(e.orig, psycopg2.errors.DeadlockDetected) or attempt == retries - 1: raise
+                target_connection.commit()
+
+                try:
+                    db.set_user_shard(user_id, target, directory)
+                    directory.commit()
+                except Exception:
+                    directory.rollback()
+                    db.delete_user_rows(user_id, target_connection)
+                    target_connection.commit()
+                    raise
+                self.shard_cache.delete(user_id)
+
+                time.sleep(self.shard_cache.ttl if drain_seconds is None else drain_seconds)
+                db.delete_user_rows(user_id, source_connection)
+                source_connection.commit()
+
+        return moved
+
+    def stats(self):
+        return {"shards": len(self.engines)}
+
+def create_shard_map(primary, username, password, dbname, **pool_options):
+    engines = [primary] + [db.create_db_engine(host, port, username, password, shard_dbname, **pool_options)
+                           for host, port, shard_dbname in parse_shard_dsns(os.environ.get("POSTGRES_SHARDS"), dbname)]
+    return ShardMap(engines, cache.create_cache("user_shard", int(os.environ.get("SHARD_CACHE_SIZE", 10000)), int(os.environ.get("SHARD_CACHE_SECONDS", 5))))
+
+def main():
+    parser = argparse.ArgumentParser(description="Manage the database shards")
+    parser.add_argument("--env", default=".env", help="dotenv file with the POSTGRES_* settings")
+    commands = parser.add_subparsers(dest="command", required=True)
+    commands.add_parser("init", help="give every shard its own id range (run after migrations.py)")
+    commands.add_parser("status", help="print the number of users per shard")
+    move = commands.add_parser("move", help="move a user with all tasks to another shard")
+    move.add_argument("user_id", type=int)
+    move.add_argument("shard", type=int)
+    args = parser.parse_args()
+
+    load_dotenv(args.env)
+    primary = db.create_db_engine(os.environ.get("POSTGRES_HOST"), os.environ.get("POSTGRES_PORT"), os.environ.get("POSTGRES_USER"), os.environ.get("POSTGRES_PASSWORD"), os.environ.get("POSTGRES_DB"))
+    shard_map = create_shard_map(primary, os.environ.get("POSTGRES_USER"), os.environ.get("POSTGRES_PASSWORD"), os.environ.get("POSTGRES_DB"), pool_size=1, max_overflow=0)
+
+    try:
+        if args.command == "init":
+            # A single database keeps the full id range until shards are added
+            if shard_map.sharded: shard_map.configure_id_ranges()
+            print(f"Configured {len(shard_map.engines)} shards")
+        elif args.command == "status":
+            with primary.connect() as connection:
+                counts = db.get_user_counts_by_shard(connection)
+            for shard, engine in enumerate(shard_map.engines):
+                print(f"Shard {shard} ({engine.url.host}:{engine.url.port}/{engine.url.database}): {counts.get(shard, 0)} users, ids {shard_map.id_bounds(shard)[0]}-{shard_map.id_bounds(shard)[1]}")
+        else:
+            moved = shard_map.move_user(args.user_id, args.shard)
+            print(f"Moved user {args.user_id} with {moved} tasks to shard {args.shard}")
+    except InvalidInputException as e:
+        print(e, file=sys.stderr)
+        return 1
+    finally:
+        for engine in shard_map.engines:
+            engine.dispose()
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,3 @@
+#!/bin/sh
+# Second database on testing_postgres for the sharding tests (POSTGRES_SHARDS=localhost:5433/<POSTGRES_DB>_shard1)
+psql -v ON_ERROR_STOP=1 --username "$POSTGRES_USER" --dbname "$POSTGRES_DB" -c "CREATE DATABASE \"${POSTGRES_DB}_shard1\""
@@ -0,0 +1,3 @@
+#!/bin/sh
+# Lets testing_postgres_replica clone and follow this instance (docker-compose --profile testing-replica)
+echo "host replication all all scram-sha-256" >> "$PGDATA/pg_hba.conf"
@@ -0,0 +1,194 @@
+import sqlalchemy as sa
+import pytest
+import os 
+import json
+import asyncio
+
+from dotenv import load_dotenv
+from starlette.testclient import TestClient
+
+if not load_dotenv(".env.testing"):
+    print("ERROR LOADING ENVIRONMENT!")
+
+import auth
+import api_helpers
+import ratelimit
+import db
+import async_app
+from async_app import app as asgi_app, shard_map
+
+@pytest.fixture(autouse=True)
+def empty_db():
+    engine = db.create_db_engine(os.environ.get("POSTGRES_HOST"), os.environ.get("POSTGRES_PORT"), os.environ.get("POSTGRES_USER"), os.environ.get("POSTGRES_PASSWORD"), os.environ.get("POSTGRES_DB"))
+    try:
+        db.recreate_test_schema(engine)
+        for shard_engine in shard_map.engines[1:]:
+            db.recreate_test_schema(shard_engine)
+    except sa.exc.OperationalError:
+        pytest.exit(f"Check if Postgres is running. The test expects a Postgres instance to run on port '{os.environ.get('POSTGRES_PORT')}'.\nThis can be run from Docker with 'docker-compose --profile testing up -d testing_postgres'", returncode=1)
+    engine.dispose()
+    # With POSTGRES_SHARDS set the app spreads the test users over several databases
+    if shard_map.sharded: shard_map.configure_id_ranges()
+    shard_map.shard_cache.clear()
+    auth.user_cache.clear()
+    api_helpers.summary_cache.clear()
+    ratelimit.rate_limiter.clear()
+    yield
+
+@pytest.fixture
+def asgi_client():
+    with TestClient(asgi_app) as client:
+        yield client
+
+@pytest.fixture
+def access_token(asgi_client):
+    response = asgi_client.post(f"/register", json={"username": "test-user", "password": "test-password"})
+    assert response.status_code == 201
+
+    response = asgi_client.post(f"/login", json={"username": "test-user", "password": "test-password"})
+    assert response.status_code == 200
+    yield response.json()["access_token"]
+
+def test_login_incorrect_password(asgi_client, access_token):
+    response = asgi_client.post(f"/login", json={"username": "test-user", "password": "wrong-password"})
+    assert response.status_code == 401
+
+def test_get_tasks_unauthorized(asgi_client):
+    response = asgi_client.get(f"/tasks", headers={"Authorization": f"Bearer {auth.gen_jwt({'id': 99999})}"})
+    assert response.status_code == 401
+
+def test_token_decoded_once(asgi_client, access_token, monkeypatch):
+    calls = []
+    verify_jwt = auth.verify_jwt
+    monkeypatch.setattr(auth, "verify_jwt", lambda header: calls.append(header) or verify_jwt(header))
+    response = asgi_client.get(f"/tasks", headers={"Authorization": f"Bearer {access_token}"})
+    assert response.status_code == 200
+    assert len(calls) == 1
+
+def test_swagger_and_metrics(asgi_client):
+    response = asgi_client.get(f"/swagger.json")
+    assert response.status_code == 200
+    assert response.headers["Content-Type"] == "application/json"
+    assert "/tasks/batch" in response.json()["paths"]
+
+    response = asgi_client.get(f"/metrics")
+    assert response.status_code == 200
+    assert "db_query_duration_seconds" in response.text
+
+def test_task_crud(asgi_client, access_token):
+    headers = {"Authorization": f"Bearer {access_token}"}
+    response = asgi_client.post(f"/tasks", json={"title": "Task-title", "due_date": "2025-01-01T00:00:00"}, headers=headers)
+    assert response.status_code == 200
+
+    response = asgi_client.get(f"/tasks", headers=headers)
+    assert response.status_code == 200
+    task = response.json()[0]
+    assert task["title"] == "Task-title"
+
+    response = asgi_client.put(f"/tasks/{task['id']}", json={"title": "Task-updated"}, headers=headers)
+    assert response.status_code == 200
+
+    response = asgi_client.get(f"/tasks?format=ndjson", headers=headers)
+    assert response.status_code == 200
+    assert "Task-updated" in response.text
+
+    response = asgi_client.delete(f"/tasks/{task['id']}", headers=headers)
+    assert response.status_code == 200
+    assert asgi_client.get(f"/tasks", headers=headers).json() == []
+
+def test_get_tasks_paginated(asgi_client, access_token):
+    headers = {"Authorization": f"Bearer {access_token}"}
+    response = asgi_client.post(f"/tasks/batch", json={"tasks": [{"title": f"Task-{i}"} for i in range(3)]}, headers=headers)
+    assert [result["status"] for result in response.json()] == [201, 201, 201]
+
+    response = asgi_client.get(f"/tasks?limit=2", headers=headers)
+    assert [task["title"] for task in response.json()] == ["Task-0", "Task-1"]
+
+    response = asgi_client.get(f"/tasks?limit=2&cursor={response.headers['X-Next-Cursor']}", headers=headers)
+    assert [task["title"] for task in response.json()] == ["Task-2"]
+
+def test_get_tasks_conditional(asgi_client, access_token):
+    headers = {"Authorization": f"Bearer {access_token}"}
+    etag = asgi_client.get(f"/tasks", headers=headers).headers["ETag"]
+    assert asgi_client.get(f"/tasks", headers=headers | {"If-None-Match": etag}).status_code == 304
+
+    asgi_client.post(f"/tasks", json={"title": "Task-title"}, headers=headers)
+    assert asgi_client.get(f"/tasks", headers=headers | {"If-None-Match": etag}).status_code == 200
+
+def test_search_tasks(asgi_client, access_token):
+    headers = {"Authorization": f"Bearer {access_token}"}
+    asgi_client.post(f"/tasks/batch", json={"tasks": [{"title": "Buy milk"}, {"title": "Laundry"}]}, headers=headers)
+
+    response = asgi_client.get(f"/tasks/search?q=mil&mode=prefix", headers=headers)
+    assert response.status_code == 200
+    assert [task["title"] for task in response.json()] == ["Buy milk"]
+
+def test_task_summary(asgi_client, access_token):
+    headers = {"Authorization": f"Bearer {access_token}"}
+    assert asgi_client.get(f"/tasks/summary", headers=headers).json()["total"] == 0
+
+    asgi_client.post(f"/tasks/batch", json={"tasks": [{"title": "Task-1"}, {"title": "Task-2", "is_completed": True}]}, headers=headers)
+    response = asgi_client.get(f"/tasks/summary", headers=headers)
+    assert response.status_code == 200
+    assert response.json() == {"total": 2, "open": 1, "completed": 1, "overdue": 0, "due_this_week": 0}
+
+def test_shared_cache_calls_off_event_loop(asgi_client, access_token, monkeypatch):
+    # With CACHE_REDIS_URL every lookup is a blocking round trip
+    monkeypatch.setattr(async_app, "SHARED_CACHE", True)
+    on_loop = []
+    def record(func):
+        def inner(*args):
+            try:
+                asyncio.get_running_loop()
+                on_loop.append(func.__name__)
+            except RuntimeError:
+                pass
+            return func(*args)
+        return inner
+    monkeypatch.setattr(auth.user_cache, "get", record(auth.user_cache.get))
+    monkeypatch.setattr(ratelimit.rate_limiter, "check", record(ratelimit.rate_limiter.check))
+    monkeypatch.setattr(api_helpers.summary_cache, "get", record(api_helpers.summary_cache.get))
+
+    response = asgi_client.get(f"/tasks/summary", headers={"Authorization": f"Bearer {access_token}"})
+    assert response.status_code == 200
+    assert on_loop == []
+
+def test_task_event_stream_requires_token(asgi_client):
+    assert asgi_client.get(f"/tasks/stream").status_code == 401
+
+def test_login_rate_limited(asgi_client, monkeypatch):
+    monkeypatch.setitem(ratelimit.rate_limiter.budgets, "auth", (1, 1 / 60))
+    assert asgi_client.post(f"/login", json={"username": "test-user", "password": "test-password"}).status_code == 401
+    response = asgi_client.post(f"/login", json={"username": "test-user", "password": "test-password"})
+    assert response.status_code == 429
+    assert response.headers["Retry-After"] == "60"
+
+def test_get_tasks_fields_compressed(asgi_client, access_token):
+    headers = {"Authorization": f"Bearer {access_token}", "Accept-Encoding": "gzip"}
+    asgi_client.post(f"/tasks/batch", json={"tasks": [{"title": f"Task-{i}", "description": "Task-description"} for i in range(50)]}, headers=headers)
+
+    response = asgi_client.get(f"/tasks?fields=title", headers=headers)
+    assert response.status_code == 200
+    assert response.headers["Content-Encoding"] == "gzip"
+    assert set(response.json()[0].keys()) == {"id", "title"}
+
+    response = asgi_client.get(f"/tasks?stream=true", headers=headers)
+    assert response.headers["Content-Encoding"] == "gzip"
+    assert len(response.json()) == 50
+
+def test_task_import_export(asgi_client, access_token):
+    headers = {"Authorization": f"Bearer {access_token}"}
+    response = asgi_client.post(f"/tasks/import?format=csv", content=b'title,is_completed\nTask-1,true\nTask-2,\n', headers=headers)
+    assert response.status_code == 200
+    assert response.json() == {"imported": 2}
+
+    response = asgi_client.post(f"/tasks/import", content=b'{"title": ""}\n', headers=headers)
+    assert response.status_code == 404
+
+    response = asgi_client.get(f"/tasks/export?sort=-id", headers=headers)
+    assert response.status_code == 200
+    assert response.headers["Content-Type"] == "application/x-ndjson"
+    assert [line["title"] for line in map(json.loads, response.text.splitlines())] == ["Task-2", "Task-1"]
+
+    response = asgi_client.get(f"/tasks/export?format=csv&fields=title,is_completed", headers=headers)
+    assert [line.split(",")[1:] for line in response.text.splitlines()] == [["title", "is_completed"], ["Task-1", "t"], ["Task-2", ""]]
@@ -1,21 +1,49 @@
 import sqlalchemy as sa
 import pytest
 import os 
+import gzip
+import json
+import datetime
 import auth
+import api_helpers
+import ratelimit
+import profiling
+import db
 
 from dotenv import load_dotenv
 
 if not load_dotenv(".env.testing"):
     print("ERROR LOADING ENVIRONMENT!")
-try: 
-    from app import app as flask
-except sa.exc.OperationalError:
-        pytest.exit(f"Check if Postgres is running. The test expects a Postgres instance to run on port '{port}'.\nThis can be run from Docker with 'docker-compose --profile testing up -d testing_postgres'", returncode=1)
+import app as app_module
+from app import app as flask
+
+@pytest.fixture(autouse=True)
+def empty_db():
+    # The app connects lazily, so an unreachable Postgres shows up here instead of on import
+    try:
+        for engine in flask.config["DB"]["shards"].engines:
+            db.recreate_test_schema(engine)
+    except sa.exc.OperationalError:
+        pytest.exit(f"Check if Postgres is running. The test expects a Postgres instance to run on port '{os.environ.get('POSTGRES_PORT')}'.\nThis can be run from Docker with 'docker-compose --profile testing up -d testing_postgres'", returncode=1)
+    # With POSTGRES_SHARDS set the app spreads the test users over several databases
+    if flask.config["DB"]["shards"].sharded: flask.config["DB"]["shards"].configure_id_ranges()
+    flask.config["DB"]["shards"].shard_cache.clear()
+    auth.user_cache.clear()
+    api_helpers.summary_cache.clear()
+    ratelimit.rate_limiter.clear()
+    flask.config["TASK_EVENTS"].clear()
+    yield
 
 @pytest.fixture
 def flask_app():
     yield flask.test_client()
 
+def user_engine(username):
+    # Database holding the user, one of several when POSTGRES_SHARDS is set
+    shard_map = flask.config["DB"]["shards"]
+    with shard_map.engines[0].connect() as connection:
+        return shard_map.engines[db.get_user_directory_entry(username, connection)["shard"]]
+
 
 def test_create_user_correct(flask_app):
     response = flask_app.post(f"/register", json={"username": "test-user", "password": "test-password"})
@@ -95,3 +123,455 @@ def test_insert_task_no_title(flask_app, test_login_correct):
     assert response.status_code == 400
 
 ###########################################
+
+def test_health_reports_pool(flask_app):
+    response = flask_app.get(f"/health")
+    assert response.status_code == 200
+    assert set(response.json["db_pool"].keys()) == set(["size", "checked_in", "checked_out", "overflow"])
+
+def test_connection_returned_to_pool(flask_app, test_login_correct):
+    headers = {"Authorization": f"Bearer {test_login_correct}"}
+    response = flask_app.post(f"/tasks", json={"title": "Task-title"}, headers=headers)
+    assert response.status_code == 200
+
+    assert db.get_pool_status(flask.config["DB"]["engine"])["checked_out"] == 0
+
+###########################################
+
+def test_get_tasks_paginated(flask_app, test_login_correct):
+    headers = {"Authorization": f"Bearer {test_login_correct}"}
+    for i in range(5):
+        response = flask_app.post(f"/tasks", json={"title": f"Task-{i}"}, headers=headers)
+        assert response.status_code == 200
+
+    response = flask_app.get(f"/tasks?limit=3", headers=headers)
+    assert response.status_code == 200
+    assert [task["title"] for task in response.json] == ["Task-0", "Task-1", "Task-2"]
+    assert "X-Next-Cursor" in response.headers
+
+    response = flask_app.get(f"/tasks?limit=3&cursor={response.headers['X-Next-Cursor']}", headers=headers)
+    assert response.status_code == 200
+    assert [task["title"] for task in response.json] == ["Task-3", "Task-4"]
+    assert "X-Next-Cursor" not in response.headers
+
+def test_get_tasks_invalid_cursor(flask_app, test_login_correct):
+    headers = {"Authorization": f"Bearer {test_login_correct}"}
+    response = flask_app.get(f"/tasks?limit=3&cursor=not-a-cursor", headers=headers)
+    assert response.status_code == 404
+
+def test_get_tasks_streamed(flask_app, test_login_correct):
+    headers = {"Authorization": f"Bearer {test_login_correct}"}
+    for i in range(3):
+        flask_app.post(f"/tasks", json={"title": f"Task-{i}"}, headers=headers)
+
+    response = flask_app.get(f"/tasks?stream=true", headers=headers)
+    assert response.status_code == 200
+    assert [task["title"] for task in response.json] == ["Task-0", "Task-1", "Task-2"]
+
+    response = flask_app.get(f"/tasks?format=ndjson", headers=headers)
+    assert response.status_code == 200
+    lines = response.get_data(as_text=True).splitlines()
+    assert len(lines) == 3
+
+def test_get_tasks_streamed_on_etag_engine(flask_app, test_login_correct, monkeypatch):
+    # The body is read where the ETag's version was, not from a freshly picked (possibly more lagged) replica
+    headers = {"Authorization": f"Bearer {test_login_correct}"}
+    flask_app.post(f"/tasks", json={"title": "Task-title"}, headers=headers)
+    def pick_again(user_id):
+        raise AssertionError("read engine picked twice")
+    monkeypatch.setattr(app_module, "read_engine", pick_again)
+
+    response = flask_app.get(f"/tasks?stream=true", headers=headers)
+    assert [task["title"] for task in response.json] == ["Task-title"]
+
+###########################################
+
+def test_get_tasks_filtered_and_sorted(flask_app, test_login_correct):
+    headers = {"Authorization": f"Bearer {test_login_correct}"}
+    flask_app.post(f"/tasks", json={"title": "Task-late", "due_date": "2025-03-01T00:00:00"}, headers=headers)
+    flask_app.post(f"/tasks", json={"title": "Task-early", "due_date": "2025-01-01T00:00:00"}, headers=headers)
+    flask_app.post(f"/tasks", json={"title": "Task-done", "due_date": "2025-02-01T00:00:00", "is_completed": True}, headers=headers)
+
+    response = flask_app.get(f"/tasks?completed=false&sort=due_date", headers=headers)
+    assert response.status_code == 200
+    assert [task["title"] for task in response.json] == ["Task-early", "Task-late"]
+
+    response = flask_app.get(f"/tasks?due_after=2025-01-15T00:00:00&sort=-due_date", headers=headers)
+    assert response.status_code == 200
+    assert [task["title"] for task in response.json] == ["Task-late", "Task-done"]
+
+def test_get_tasks_invalid_filter(flask_app, test_login_correct):
+    headers = {"Authorization": f"Bearer {test_login_correct}"}
+    assert flask_app.get(f"/tasks?completed=maybe", headers=headers).status_code == 400
+    assert flask_app.get(f"/tasks?due_before=not-a-date", headers=headers).status_code == 400
+    assert flask_app.get(f"/tasks?sort=title", headers=headers).status_code == 404
+    assert flask_app.get(f"/tasks?include_archived=yes", headers=headers).status_code == 400
+
+def test_get_tasks_include_archived(flask_app, test_login_correct):
+    headers = {"Authorization": f"Bearer {test_login_correct}"}
+    flask_app.post(f"/tasks", json={"title": "Task-open"}, headers=headers)
+    flask_app.post(f"/tasks", json={"title": "Task-done", "is_completed": True}, headers=headers)
+    with user_engine("test-user").begin() as connection:
+        assert db.archive_completed_tasks(connection, datetime.datetime.now() + datetime.timedelta(days=1)) == 1
+
+    assert [task["title"] for task in flask_app.get(f"/tasks", headers=headers).json] == ["Task-open"]
+    response = flask_app.get(f"/tasks?include_archived=true&limit=1", headers=headers)
+    assert [task["title"] for task in response.json] == ["Task-open"]
+    response = flask_app.get(f"/tasks?include_archived=true&limit=1&cursor={response.headers['X-Next-Cursor']}", headers=headers)
+    assert [task["title"] for task in response.json] == ["Task-done"]
+
+def test_get_tasks_fields(flask_app, test_login_correct):
+    headers = {"Authorization": f"Bearer {test_login_correct}"}
+    flask_app.post(f"/tasks", json={"title": "Task-title", "description": "Task-description"}, headers=headers)
+
+    response = flask_app.get(f"/tasks?fields=title,is_completed", headers=headers)
+    assert response.status_code == 200
+    assert set(response.json[0].keys()) == {"id", "title", "is_completed"}
+    task_id = response.json[0]["id"]
+
+    response = flask_app.get(f"/tasks?format=ndjson&fields=title", headers=headers)
+    assert response.get_data(as_text=True) == f'{{"id":{task_id},"title":"Task-title"}}\n'
+
+    assert flask_app.get(f"/tasks?fields=", headers=headers).status_code == 400
+    assert flask_app.get(f"/tasks?fields=secret", headers=headers).status_code == 404
+
+def test_get_tasks_compressed(flask_app, test_login_correct):
+    headers = {"Authorization": f"Bearer {test_login_correct}"}
+    flask_app.post(f"/tasks/batch", json={"tasks": [{"title": f"Task-{i}", "description": "Task-description"} for i in range(50)]}, headers=headers)
+
+    response = flask_app.get(f"/tasks", headers={**headers, "Accept-Encoding": "gzip"})
+    assert response.status_code == 200
+    assert response.headers["Content-Encoding"] == "gzip"
+    assert "Accept-Encoding" in response.headers["Vary"]
+    assert len(gzip.decompress(response.data)) > len(response.data)
+    assert len(json.loads(gzip.decompress(response.data))) == 50
+
+    response = flask_app.get(f"/tasks?format=ndjson", headers={**headers, "Accept-Encoding": "gzip"})
+    assert len(gzip.decompress(response.data).splitlines()) == 50
+
+    # Small bodies and clients without gzip get plain responses
+    assert "Content-Encoding" not in flask_app.get(f"/tasks?limit=1", headers={**headers, "Accept-Encoding": "gzip"}).headers
+    assert "Content-Encoding" not in flask_app.get(f"/tasks", headers={**headers, "Accept-Encoding": "gzip;q=0"}).headers
+
+###########################################
+
+def test_get_tasks_user_cached(flask_app, test_login_correct):
+    headers = {"Authorization": f"Bearer {test_login_correct}"}
+    flask_app.get(f"/tasks", headers=headers)
+    hits = auth.user_cache.stats()["hits"]
+
+    response = flask_app.get(f"/tasks", headers=headers)
+    assert response.status_code == 200
+    assert auth.user_cache.stats()["hits"] == hits + 1
+
+def test_get_tasks_deleted_user(flask_app, test_login_correct):
+    headers = {"Authorization": f"Bearer {test_login_correct}"}
+    assert flask_app.get(f"/tasks", headers=headers).status_code == 200
+
+    with user_engine("test-user").begin() as connection:
+        user = db.get_user_by_username("test-user", connection)
+        db.delete_user_by_id(user["id"], connection)
+
+    assert flask_app.get(f"/tasks", headers=headers).status_code == 401
+
+###########################################
+
+def test_login_rehashes_password_on_cost_change(flask_app, monkeypatch):
+    response = flask_app.post(f"/register", json={"username": "test-user", "password": "test-password"})
+    assert response.status_code == 201
+
+    monkeypatch.setattr(auth, "BCRYPT_ROUNDS", auth.BCRYPT_ROUNDS + 1)
+    response = flask_app.post(f"/login", json={"username": "test-user", "password": "test-password"})
+    assert response.status_code == 200
+
+    with user_engine("test-user").connect() as connection:
+        user = db.get_user_by_username("test-user", connection)
+    assert not auth.password_needs_rehash(user["password_hash"])
+
+def test_login_password_pool_saturated(flask_app, monkeypatch):
+    monkeypatch.setattr(auth, "password_pool", auth.PasswordPool(1, 0, 5))
+    auth.password_pool._ensure_started()
+    auth.password_pool._slots.acquire()
+
+    response = flask_app.post(f"/login", json={"username": "test-user", "password": "test-password"})
+    assert response.status_code == 503
+    assert response.headers["Retry-After"] == "5"
+
+###########################################
+
+def test_task_batch_endpoints(flask_app, test_login_correct):
+    headers = {"Authorization": f"Bearer {test_login_correct}"}
+    response = flask_app.post(f"/tasks/batch", json={"tasks": [{"title": "Task-1"}, {"description": "no-title"}, {"title": "Task-2", "due_date": "2025-01-01T00:00:00"}]}, headers=headers)
+    assert response.status_code == 200
+    assert [result["status"] for result in response.json] == [201, 400, 201]
+    task_ids = [response.json[0]["id"], response.json[2]["id"]]
+
+    response = flask_app.patch(f"/tasks/batch", json={"tasks": [{"id": task_ids[0], "is_completed": True}, {"id": task_ids[1], "title": "Task-2-updated", "due_date": "2025-02-01T00:00:00"}, {"id": 99999, "title": "missing"}]}, headers=headers)
+    assert response.status_code == 200
+    assert [result["status"] for result in response.json] == [200, 200, 404]
+
+    response = flask_app.get(f"/tasks", headers=headers)
+    assert [(task["title"], task["is_completed"]) for task in response.json] == [("Task-1", True), ("Task-2-updated", None)]
+
+    # JSON booleans are no ids, the rest of the batch still applies
+    response = flask_app.patch(f"/tasks/batch", json={"tasks": [{"id": True, "title": "z"}, {"id": task_ids[0], "title": "Task-1"}, {"id": 2**40, "title": "z"}]}, headers=headers)
+    assert response.status_code == 200
+    assert [result["status"] for result in response.json] == [400, 200, 404]
+
+    response = flask_app.delete(f"/tasks/batch", json={"ids": [task_ids[0], 99999, "x", 2**40, task_ids[0]]}, headers=headers)
+    assert response.status_code == 200
+    assert [result["status"] for result in response.json] == [200, 404, 400, 404, 400]
+    assert response.json[4]["error"] == "Invalid task_id: Duplicate task_id in batch"
+
+    response = flask_app.get(f"/tasks", headers=headers)
+    assert [task["id"] for task in response.json] == [task_ids[1]]
+
+def test_task_batch_too_large(flask_app, test_login_correct, monkeypatch):
+    import app
+    monkeypatch.setattr(app, "TASK_BATCH_MAX_SIZE", 2)
+    headers = {"Authorization": f"Bearer {test_login_correct}"}
+    response = flask_app.post(f"/tasks/batch", json={"tasks": [{"title": "Task"}] * 3}, headers=headers)
+    assert response.status_code == 413
+
+###########################################
+
+def test_get_tasks_conditional(flask_app, test_login_correct):
+    headers = {"Authorization": f"Bearer {test_login_correct}"}
+    response = flask_app.get(f"/tasks", headers=headers)
+    assert response.status_code == 200
+    etag = response.headers["ETag"]
+
+    response = flask_app.get(f"/tasks", headers=headers | {"If-None-Match": etag})
+    assert response.status_code == 304
+    assert response.headers["ETag"] == etag
+
+    response = flask_app.get(f"/tasks?completed=true", headers=headers | {"If-None-Match": etag})
+    assert response.status_code == 200
+
+    flask_app.post(f"/tasks", json={"title": "Task-title"}, headers=headers)
+    response = flask_app.get(f"/tasks", headers=headers | {"If-None-Match": etag})
+    assert response.status_code == 200
+    assert response.headers["ETag"] != etag
+    assert response.json[0]["title"] == "Task-title"
+
+def test_task_event_stream(flask_app, test_login_correct):
+    headers = {"Authorization": f"Bearer {test_login_correct}"}
+    response = flask_app.get(f"/tasks/stream", headers=headers, buffered=False)
+    assert response.status_code == 200
+    assert response.mimetype == "text/event-stream"
+    body = iter(response.response)
+    assert next(body) == b"retry: 3000\n\n"
+
+    flask_app.post(f"/tasks", json={"title": "Task-1"}, headers=headers)
+    assert next(body).startswith(b"id: 1\nevent: created\n")
+    flask_app.post(f"/tasks/batch", json={"tasks": [{"title": "Task-2"}, {"title": "Task-3"}]}, headers=headers)
+    assert next(body).startswith(b"event: created\n")
+    assert next(body).startswith(b"id: 2\nevent: created\n")
+    response.close()
+    task_ids = [task["id"] for task in flask_app.get(f"/tasks", headers=headers).json]
+
+    # Reconnecting after version 1 replays the batch
+    response = flask_app.get(f"/tasks/stream", headers=headers | {"Last-Event-ID": "1"}, buffered=False)
+    body = iter(response.response)
+    assert next(body) == b"retry: 3000\n\n"
+    assert f'"id": {task_ids[1]}'.encode() in next(body)
+    assert f'"id": {task_ids[2]}'.encode() in next(body)
+    response.close()
+
+    # Versions that are no longer buffered can not be replayed
+    flask.config["TASK_EVENTS"].clear()
+    response = flask_app.get(f"/tasks/stream", headers=headers | {"Last-Event-ID": "1"}, buffered=False)
+    body = iter(response.response)
+    next(body)
+    assert next(body) == b"event: resync\n\n"
+    response.close()
+    assert flask.config["TASK_EVENTS"].stats()["subscribers"] == 0
+
+def test_task_event_stream_refused_on_sync_worker(flask_app, test_login_correct):
+    headers = {"Authorization": f"Bearer {test_login_correct}"}
+    response = flask_app.get(f"/tasks/stream", headers=headers, environ_overrides={"SERVER_SOFTWARE": "gunicorn/23.0.0", "wsgi.multithread": False})
+    assert response.status_code == 501
+    assert flask.config["TASK_EVENTS"].stats()["subscribers"] == 0
+
+def test_task_summary(flask_app, test_login_correct):
+    headers = {"Authorization": f"Bearer {test_login_correct}"}
+    response = flask_app.get(f"/tasks/summary", headers=headers)
+    assert response.status_code == 200
+    assert response.json == {"total": 0, "open": 0, "completed": 0, "overdue": 0, "due_this_week": 0}
+
+    # Cached summaries are invalidated by writes
+    flask_app.post(f"/tasks", json={"title": "Task-overdue", "due_date": "2000-01-01T00:00:00"}, headers=headers)
+    flask_app.post(f"/tasks", json={"title": "Task-done", "is_completed": True}, headers=headers)
+    response = flask_app.get(f"/tasks/summary", headers=headers)
+    assert response.json == {"total": 2, "open": 1, "completed": 1, "overdue": 1, "due_this_week": 0}
+
+def test_task_summary_ignores_recached_stale_counts(flask_app, test_login_correct):
+    headers = {"Authorization": f"Bearer {test_login_correct}"}
+    flask_app.get(f"/tasks/summary", headers=headers)
+    user_id = auth.verify_jwt(headers["Authorization"])["user_id"]
+    stale = api_helpers.summary_cache.get(user_id)
+
+    # A read racing the write caches the counts from before its commit again
+    flask_app.post(f"/tasks", json={"title": "Task-title"}, headers=headers)
+    api_helpers.summary_cache.set(user_id, stale)
+    assert flask_app.get(f"/tasks/summary", headers=headers).json["total"] == 1
+
+def test_search_tasks(flask_app, test_login_correct):
+    headers = {"Authorization": f"Bearer {test_login_correct}"}
+    flask_app.post(f"/tasks", json={"title": "Buy milk"}, headers=headers)
+    flask_app.post(f"/tasks", json={"title": "Groceries", "description": "milk"}, headers=headers)
+    flask_app.post(f"/tasks", json={"title": "Laundry"}, headers=headers)
+
+    response = flask_app.get(f"/tasks/search?q=milk&limit=1", headers=headers)
+    assert response.status_code == 200
+    assert [task["title"] for task in response.json] == ["Buy milk"]
+
+    response = flask_app.get(f"/tasks/search?q=milk&limit=1&cursor={response.headers['X-Next-Cursor']}", headers=headers)
+    assert [task["title"] for task in response.json] == ["Groceries"]
+    assert "X-Next-Cursor" not in response.headers
+
+    response = flask_app.get(f"/tasks/search?q=laun&mode=prefix", headers=headers)
+    assert [task["title"] for task in response.json] == ["Laundry"]
+
+    assert flask_app.get(f"/tasks/search", headers=headers).status_code == 400
+    assert flask_app.get(f"/tasks/search?q=milk&mode=regex", headers=headers).status_code == 404
+
+###########################################
+
+def test_login_rate_limited(flask_app, monkeypatch):
+    monkeypatch.setitem(ratelimit.rate_limiter.budgets, "auth", (2, 1 / 60))
+    for _ in range(2):
+        assert flask_app.post(f"/login", json={"username": "test-user", "password": "test-password"}).status_code == 401
+
+    response = flask_app.post(f"/login", json={"username": "test-user", "password": "test-password"})
+    assert response.status_code == 429
+    assert response.headers["Retry-After"] == "60"
+    # Other clients have their own budget
+    assert flask_app.post(f"/register", json={"username": "test-user", "password": "test-password"}, environ_base={"REMOTE_ADDR": "10.0.0.2"}).status_code == 201
+
+def test_tasks_rate_limited_per_user(flask_app, test_login_correct, monkeypatch):
+    monkeypatch.setitem(ratelimit.rate_limiter.budgets, "user", (1, 1))
+    headers = {"Authorization": f"Bearer {test_login_correct}"}
+    assert flask_app.get(f"/tasks", headers=headers).status_code == 200
+    response = flask_app.get(f"/tasks", headers=headers)
+    assert response.status_code == 429
+    assert response.headers["Retry-After"] == "1"
+
+###########################################
+
+def test_metrics(flask_app, test_login_correct):
+    headers = {"Authorization": f"Bearer {test_login_correct}"}
+    flask_app.get(f"/tasks", headers=headers)
+
+    response = flask_app.get(f"/metrics")
+    assert response.status_code == 200
+    body = response.get_data(as_text=True)
+    assert 'http_requests_total{method="GET",route="/tasks",status="200"}' in body
+    assert 'http_request_duration_seconds_bucket{le="0.005",method="POST",route="/login",status="200"}' in body
+    assert 'db_query_duration_seconds_count{function="get_task_list_by_user_id"}' in body
+    assert 'bcrypt_duration_seconds_count{operation="checkpw"}' in body
+    assert "db_pool_checked_out" in body
+    assert "http_requests_in_flight" in body
+
+def test_slow_request_profile_logged(flask_app, test_login_correct, monkeypatch, caplog):
+    headers = {"Authorization": f"Bearer {test_login_correct}"}
+    flask_app.post(f"/tasks", json={"title": "Task-title"}, headers=headers)
+    auth.user_cache.clear()
+    monkeypatch.setattr(profiling, "PROFILING_ENABLED", True)
+    monkeypatch.setattr(profiling, "PROFILING_SLOW_REQUEST_MS", 0)
+
+    with caplog.at_level("WARNING", logger="profiling"):
+        assert flask_app.get(f"/tasks", headers=headers).status_code == 200
+    record = json.loads(caplog.records[-1].getMessage()[len("Slow request "):])
+    assert record["route"] == "/tasks" and record["status"] == 200
+    assert {"auth", "jwt", "db.get_user_by_id", "serialization"} <= set(record["totals"])
+    assert any(name.startswith("db.") and name != "db.get_user_by_id" for name in record["totals"])
+    assert any(query["function"] == "get_user_by_id" and "SELECT" in query["statement"] for query in record["queries"])
+
+    # bcrypt heavy, so likely slow: the password hash of the new user must not reach the log
+    monkeypatch.setattr(profiling, "PROFILING_LOG_PARAMETERS", True)
+    with caplog.at_level("WARNING", logger="profiling"):
+        assert flask_app.post(f"/register", json={"username": "other-user", "password": "other-password"}).status_code == 201
+    record = json.loads(caplog.records[-1].getMessage()[len("Slow request "):])
+    insert = next(query for query in record["queries"] if query["function"] == "insert_user")
+    assert "other-user" in insert["parameters"] and "$2b$" not in caplog.records[-1].getMessage()
+
+def test_slow_request_explain(flask_app, test_login_correct, monkeypatch, caplog):
+    headers = {"Authorization": f"Bearer {test_login_correct}"}
+    monkeypatch.setattr(profiling, "PROFILING_ENABLED", True)
+    monkeypatch.setattr(profiling, "PROFILING_SLOW_REQUEST_MS", 0)
+    profile = profiling.RequestProfile()
+    monkeypatch.setattr(profiling, "RequestProfile", lambda: profile)
+
+    flask_app.get(f"/tasks", headers=headers)
+    with caplog.at_level("WARNING", logger="profiling"):
+        profiling.log_slow_request(profile, {}, True)
+    record = json.loads(caplog.records[-1].getMessage()[len("Slow request "):])
+    assert record["explain"] and all("actual time" in explain["plan"] for explain in record["explain"])
+
+def test_profiling_disabled_by_default(flask_app, test_login_correct, caplog):
+    headers = {"Authorization": f"Bearer {test_login_correct}"}
+    with caplog.at_level("WARNING", logger="profiling"):
+        flask_app.get(f"/tasks", headers=headers)
+    assert caplog.records == []
+
+def test_admin_profile(flask_app, monkeypatch):
+    assert flask_app.post(f"/admin/profile?seconds=0.05").status_code == 404
+    monkeypatch.setattr(profiling, "PROFILING_ADMIN_TOKEN", "admin-secret")
+    assert flask_app.post(f"/admin/profile?seconds=0.05", headers={"X-Admin-Token": "wrong"}).status_code == 404
+
+    headers = {"X-Admin-Token": "admin-secret"}
+    assert flask_app.post(f"/admin/profile?seconds=abc", headers=headers).status_code == 400
+    assert flask_app.post(f"/admin/profile?seconds=3600", headers=headers).status_code == 400
+    response = flask_app.post(f"/admin/profile?seconds=0.05", headers=headers)
+    assert response.status_code == 200
+    assert response.mimetype == "text/plain"
+    assert all(line.rsplit(" ", 1)[1].isdigit() for line in response.get_data(as_text=True).splitlines())
+
+    # A sync worker's other requests would wait for the profile instead of showing up in it
+    response = flask_app.post(f"/admin/profile?seconds=0.05", headers=headers, environ_overrides={"SERVER_SOFTWARE": "gunicorn/23.0.0", "wsgi.multithread": False})
+    assert response.status_code == 501
+
+###########################################
+
+def test_task_import_export(flask_app, test_login_correct):
+    headers = {"Authorization": f"Bearer {test_login_correct}"}
+    body = b'{"title": "Task-1", "due_date": "2025-01-01T00:00:00"}\n{"title": "Task-2", "is_completed": true}\n'
+    response = flask_app.post(f"/tasks/import", data=body, headers=headers)
+    assert response.status_code == 200
+    assert response.json == {"imported": 2}
+
+    response = flask_app.post(f"/tasks/import?format=csv", data=b'title,description\nTask-3,"with, comma"\n', headers=headers)
+    assert response.json == {"imported": 1}
+    assert [task["title"] for task in flask_app.get(f"/tasks", headers=headers).json] == ["Task-1", "Task-2", "Task-3"]
+
+    # A '\.' line is a task titled '\.', not the end of the upload
+    response = flask_app.post(f"/tasks/import?format=csv", data=b'title\n\\.\nTask-5\n', headers=headers)
+    assert response.json == {"imported": 2}
+    assert [task["title"] for task in flask_app.get(f"/tasks", headers=headers).json][3:] == ["\\.", "Task-5"]
+    for task in flask_app.get(f"/tasks", headers=headers).json[3:]:
+        assert flask_app.delete(f"/tasks/{task['id']}", headers=headers).status_code == 200
+
+    response = flask_app.get(f"/tasks/export", headers=headers)
+    assert response.status_code == 200
+    assert response.mimetype == "application/x-ndjson"
+    tasks = [json.loads(line) for line in response.data.splitlines()]
+    assert [(task["title"], task["due_date"], task["is_completed"]) for task in tasks] == [("Task-1", "2025-01-01T00:00:00", None), ("Task-2", None, True), ("Task-3", None, None)]
+
+    response = flask_app.get(f"/tasks/export?format=csv&fields=title&completed=false", headers=headers)
+    assert response.mimetype == "text/csv"
+    assert response.data.decode().splitlines() == ["id,title", f"{tasks[0]['id']},Task-1", f"{tasks[2]['id']},Task-3"]
+
+def test_task_import_invalid(flask_app, test_login_correct):
+    headers = {"Authorization": f"Bearer {test_login_correct}"}
+    response = flask_app.post(f"/tasks/import", data=b'{"title": "Task-1"}\n{"description": "no-title"}\n', headers=headers)
+    assert response.status_code == 404
+    assert response.data.decode().startswith("Invalid line 2")
+
+    response = flask_app.post(f"/tasks/import?format=csv", data=b'title,due_date\nTask-1,2025-01-01\nTask-2,not-a-date\n', headers=headers)
+    assert response.status_code == 404
+    assert response.data.decode().startswith("Invalid line 3")
+
+    assert flask_app.post(f"/tasks/import?format=xml", data=b"", headers=headers).status_code == 400
+    # Nothing of a rejected import is kept
+    assert flask_app.get(f"/tasks", headers=headers).json == []
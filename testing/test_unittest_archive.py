@@ -0,0 +1,43 @@
+import os
+import datetime
+
+import sqlalchemy as sa
+from dotenv import load_dotenv
+
+import pytest
+
+import db
+import archive
+
+if not load_dotenv(".env.testing"):
+    print("ERROR LOADING ENVIRONMENT!")
+
+@pytest.fixture
+def engine():
+    engine = db.create_db_engine(os.environ.get("POSTGRES_HOST"), os.environ.get("POSTGRES_PORT"), os.environ.get("POSTGRES_USER"), os.environ.get("POSTGRES_PASSWORD"), os.environ.get("POSTGRES_DB"))
+    try:
+        db.recreate_test_schema(engine)
+    except sa.exc.OperationalError:
+        pytest.exit(f"Check if Postgres is running. The test expects a Postgres instance to run on port '{os.environ.get('POSTGRES_PORT')}'.\nThis can be run from Docker with 'docker-compose --profile testing up -d testing_postgres'", returncode=1)
+    yield engine
+    engine.dispose()
+
+def test_run_once_archives_in_batches(engine, monkeypatch):
+    with engine.begin() as connection:
+        user_id = db.insert_user("archive-user", "hash", connection)
+        task_ids = db.insert_task_batch([{"title": f"Task {i}", "is_completed": i % 2 == 0} for i in range(7)], user_id, connection)
+        connection.execute(db.task_table.update().where(db.task_table.c.id == task_ids[6]).values(completed_at=datetime.datetime.now()))
+        connection.execute(db.task_table.update().where(db.task_table.c.id != task_ids[6]).values(completed_at=datetime.datetime(2020, 1, 1)))
+
+    batches = []
+    monkeypatch.setattr(archive.time, "sleep", batches.append)
+    archiver = archive.TaskArchiver(engine, datetime.timedelta(days=1), batch_size=2, batch_delay=0.5)
+    with engine.connect() as connection:
+        assert archiver.run_once(connection) == 3
+        assert archiver.run_once(connection) == 0
+    # Sleeps between full batches only
+    assert batches == [0.5]
+
+    with engine.connect() as connection:
+        assert [task["id"] for task in db.get_task_list_by_user_id(user_id, connection)] == task_ids[1:7:2] + task_ids[6:]
+        assert len(db.get_task_list_by_user_id(user_id, connection, include_archived=True)) == 7
@@ -0,0 +1,45 @@
+import pytest
+
+from cache import TTLCache
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0
+
+    def __call__(self):
+        return self.now
+
+@pytest.fixture
+def clock():
+    yield FakeClock()
+
+def test_cache_get_set(clock):
+    user_cache = TTLCache(maxsize=10, ttl=60, clock=clock)
+    assert user_cache.get(1) is None
+    user_cache.set(1, "1")
+    assert user_cache.get(1) == "1"
+    assert user_cache.stats()["hits"] == 1
+    assert user_cache.stats()["misses"] == 1
+
+def test_cache_entry_expires(clock):
+    user_cache = TTLCache(maxsize=10, ttl=60, clock=clock)
+    user_cache.set(1, "1")
+    clock.now = 61
+    assert user_cache.get(1) is None
+    assert user_cache.stats()["size"] == 0
+
+def test_cache_evicts_least_recently_used(clock):
+    user_cache = TTLCache(maxsize=2, ttl=60, clock=clock)
+    user_cache.set(1, "1")
+    user_cache.set(2, "2")
+    user_cache.get(1)
+    user_cache.set(3, "3")
+    assert user_cache.get(2) is None
+    assert user_cache.get(1) == "1"
+    assert user_cache.get(3) == "3"
+
+def test_cache_delete(clock):
+    user_cache = TTLCache(maxsize=10, ttl=60, clock=clock)
+    user_cache.set(1, "1")
+    user_cache.delete(1)
+    assert user_cache.get(1) is None
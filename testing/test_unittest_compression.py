@@ -0,0 +1,40 @@
+import gzip
+import zlib
+
+import pytest
+
+import compression
+
+PREFERRED = "br" if compression.brotli is not None else "gzip"
+
+@pytest.mark.parametrize("accept_encoding, expected", [
+    (None, None),
+    ("gzip", "gzip"),
+    ("gzip, deflate, br", PREFERRED),
+    ("gzip;q=0", None),
+    ("*", PREFERRED),
+    ("deflate", None),
+])
+def test_choose_encoding(accept_encoding, expected):
+    assert compression.choose_encoding(accept_encoding) == expected
+
+def test_compress_chunks_flushes_every_chunk():
+    chunks = compression.compress_chunks(iter([b"[", b'{"id":1}', "]"]), "gzip")
+    first = next(chunks)
+    # Each chunk can be decoded as soon as it arrives
+    assert zlib.decompressobj(31).decompress(first) == b"["
+    assert gzip.decompress(first + b"".join(chunks)) == b'[{"id":1}]'
+
+def test_compress_chunks_closes_wrapped_generator():
+    closed = []
+    def chunks():
+        try:
+            yield b"a"
+            yield b"b"
+        finally:
+            closed.append(True)
+
+    compressed = compression.compress_chunks(chunks(), "gzip")
+    next(compressed)
+    compressed.close()
+    assert closed == [True]
@@ -1,6 +1,7 @@
 import sqlalchemy as sa
 from dotenv import load_dotenv
 import os 
+import datetime
 
 import pytest
 
@@ -20,7 +21,7 @@ dbname = os.environ.get("POSTGRES_DB")
 def empty_db():
 
     try:
-        engine, connection = db.create_db_connection(host, port, username, password, dbname)
+        engine, connection = db.create_test_db_connection(host, port, username, password, dbname)
         yield connection
         connection.close()
     except sa.exc.OperationalError:
@@ -82,3 +83,258 @@ def test_insert_task_invalid_type_username(empty_db, populate_db):
         db.insert_task("Task Title: this is a task. Description: task-description", empty_db)
 
     assert "Task must be of type dict" in str(exc_info.value)
+
+########################################################
+
+def test_get_task_page_by_user_id(empty_db, populate_db):
+    user_id = db.get_user_by_username("testing_username", empty_db)["id"]
+    for i in range(3):
+        db.insert_task({"title": f"Task-{i}", "user_id": user_id}, empty_db)
+
+    task_list, next_cursor = db.get_task_page_by_user_id(user_id, empty_db, 2)
+    assert [task["title"] for task in task_list] == ["Task-0", "Task-1"]
+
+    task_list, next_cursor = db.get_task_page_by_user_id(user_id, empty_db, 2, next_cursor)
+    assert [task["title"] for task in task_list] == ["Task-2"]
+    assert next_cursor is None
+
+def test_get_task_page_by_user_id_invalid_cursor(empty_db, populate_db):
+    with pytest.raises(InvalidInputException) as exc_info:
+        db.get_task_page_by_user_id(1, empty_db, 2, "invalid")
+
+    assert "Invalid cursor" in str(exc_info.value)
+
+########################################################
+
+@pytest.fixture
+def populate_db_many_tasks(empty_db):
+    empty_db.execute(db.user_table.insert(), [{"username": f"testing_username_{i}", "password_hash": "testing_hashed_password_string"} for i in range(20)])
+    due_date = datetime.datetime(2025, 1, 1)
+    tasks = [{"user_id": i % 20 + 1, "title": f"test-task{i}", "due_date": due_date + datetime.timedelta(days=i % 50), "is_completed": i % 10 != 0} for i in range(4000)]
+    empty_db.execute(db.task_table.insert(), tasks)
+    empty_db.execute(sa.text('ANALYZE "Task"'))
+
+def explain(connection, query):
+    compiled = query.compile(dialect=connection.dialect)
+    return "\n".join(row[0] for row in connection.exec_driver_sql("EXPLAIN " + str(compiled), compiled.params))
+
+@pytest.mark.parametrize("filters, index_name", [
+    ({}, "ix_task_user_id_id"),
+    ({"sort": "-id"}, "ix_task_user_id_id"),
+    ({"completed": False}, "ix_task_user_id_open"),
+    ({"sort": "due_date"}, "ix_task_user_id_due_date"),
+    ({"sort": "-due_date", "due_after": datetime.datetime(2025, 1, 1)}, "ix_task_user_id_due_date"),
+    ({"include_archived": True}, "ix_task_archive_user_id_id"),
+    ({"sort": "due_date", "include_archived": True}, "ix_task_archive_user_id_due_date"),
+])
+def test_task_list_query_uses_index(empty_db, populate_db_many_tasks, filters, index_name):
+    plan = explain(empty_db, db.task_list_query(1, **filters).limit(50))
+    assert index_name in plan
+    assert "Seq Scan" not in plan
+
+@pytest.mark.parametrize("sort", ["due_date", "-due_date"])
+def test_get_task_page_by_user_id_sorted_by_due_date(empty_db, populate_db, sort):
+    user_id = db.get_user_by_username("testing_username", empty_db)["id"]
+    due_dates = [datetime.datetime(2025, 1, 2), None, datetime.datetime(2025, 1, 1), datetime.datetime(2025, 1, 2), None]
+    for due_date in due_dates:
+        db.insert_task({"title": "task", "user_id": user_id, "due_date": due_date}, empty_db)
+
+    expected = db.get_task_list_by_user_id(user_id, empty_db, sort=sort)
+    assert len(expected) == len(due_dates)
+
+    task_list, next_cursor = db.get_task_page_by_user_id(user_id, empty_db, 2, sort=sort)
+    while next_cursor is not None:
+        page, next_cursor = db.get_task_page_by_user_id(user_id, empty_db, 2, next_cursor, sort=sort)
+        task_list += page
+
+    assert [task["id"] for task in task_list] == [task["id"] for task in expected]
+
+def test_get_task_list_by_user_id_filter_completed(empty_db, populate_db):
+    user_id = db.get_user_by_username("testing_username", empty_db)["id"]
+    db.insert_task({"title": "open-task", "user_id": user_id}, empty_db)
+    db.insert_task({"title": "done-task", "user_id": user_id, "is_completed": True}, empty_db)
+
+    assert [task["title"] for task in db.get_task_list_by_user_id(user_id, empty_db, completed=False)] == ["open-task"]
+    assert [task["title"] for task in db.get_task_list_by_user_id(user_id, empty_db, completed=True)] == ["done-task"]
+
+def test_get_task_list_by_user_id_fields(empty_db, populate_db):
+    user_id = db.get_user_by_username("testing_username", empty_db)["id"]
+    db.insert_task({"title": "task", "description": "long description", "user_id": user_id, "due_date": datetime.datetime(2025, 1, 1)}, empty_db)
+
+    query = db.task_list_query(user_id, fields=["title", "is_completed"])
+    assert "description" not in str(query)
+    assert db.get_task_list_by_user_id(user_id, empty_db, fields=["title", "is_completed"]) == [{"id": 2, "title": "task", "is_completed": None}]
+
+    # The cursor columns are always selected
+    task_list, next_cursor = db.get_task_page_by_user_id(user_id, empty_db, 1, fields=["title"], sort="due_date")
+    assert set(task_list[0].keys()) == {"id", "title", "due_date"}
+
+    with pytest.raises(InvalidInputException):
+        db.get_task_list_by_user_id(user_id, empty_db, fields=["password_hash"])
+
+########################################################
+
+def test_task_batch_functions(empty_db, populate_db):
+    user_id = db.get_user_by_username("testing_username", empty_db)["id"]
+    task_ids = db.insert_task_batch([{"title": f"Task-{i}"} for i in range(3)], user_id, empty_db)
+    assert [task["id"] for task in db.get_task_list_by_user_id(user_id, empty_db)] == task_ids
+
+    updated_ids = db.update_task_batch([{"id": task_ids[0], "is_completed": True}, {"id": task_ids[1], "is_completed": True}], user_id, empty_db)
+    assert updated_ids == set(task_ids[:2])
+    assert len(db.get_task_list_by_user_id(user_id, empty_db, completed=True)) == 2
+
+    assert db.delete_task_batch(task_ids[1:] + [99999], user_id, empty_db) == set(task_ids[1:])
+    assert [task["id"] for task in db.get_task_list_by_user_id(user_id, empty_db)] == task_ids[:1]
+
+def test_insert_task_batch_no_title(empty_db, populate_db):
+    with pytest.raises(InvalidInputException) as exc_info:
+        db.insert_task_batch([{"title": "Task"}, {"description": "task-description"}], 1, empty_db)
+
+    assert "title is required for creating a task" in str(exc_info.value)
+
+def test_task_version_bumped_on_writes(empty_db, populate_db):
+    user_id = db.get_user_by_username("testing_username", empty_db)["id"]
+    assert db.get_task_version(user_id, empty_db) == 0
+
+    task_id = db.insert_task({"title": "Task", "user_id": user_id}, empty_db)
+    db.update_task({"id": task_id, "is_completed": True}, user_id, empty_db)
+    db.delete_task_by_id(task_id, user_id, empty_db)
+    assert db.get_task_version(user_id, empty_db) == 3
+
+    db.delete_task_batch([task_id], user_id, empty_db)
+    assert db.get_task_version(user_id, empty_db) == 3
+
+@pytest.mark.parametrize("text, mode, expected", [
+    ("milk", "websearch", ["Buy milk", "Groceries"]),
+    ("\"buy milk\" -bread", "websearch", ["Buy milk"]),
+    ("gro mil", "prefix", ["Groceries"]),
+    ("mi", "prefix", ["Buy milk", "Groceries"]),
+])
+def test_search_tasks_by_user_id(empty_db, populate_db, text, mode, expected):
+    user_id = db.get_user_by_username("testing_username", empty_db)["id"]
+    db.insert_task({"title": "Groceries", "description": "milk, bread", "user_id": user_id}, empty_db)
+    db.insert_task({"title": "Buy milk", "user_id": user_id}, empty_db)
+    db.insert_task({"title": "Laundry", "user_id": user_id}, empty_db)
+
+    task_list, next_cursor = db.search_tasks_by_user_id(user_id, text, empty_db, 10, mode=mode)
+    assert [task["title"] for task in task_list] == expected
+    assert next_cursor is None
+
+def test_search_tasks_by_user_id_paginated(empty_db, populate_db):
+    user_id = db.get_user_by_username("testing_username", empty_db)["id"]
+    for i in range(5):
+        db.insert_task({"title": f"milk {i}", "description": "milk" if i % 2 else None, "user_id": user_id}, empty_db)
+    expected, _ = db.search_tasks_by_user_id(user_id, "milk", empty_db, 10)
+
+    task_list, cursor = db.search_tasks_by_user_id(user_id, "milk", empty_db, 2)
+    while cursor is not None:
+        page, cursor = db.search_tasks_by_user_id(user_id, "milk", empty_db, 2, cursor)
+        task_list += page
+    assert task_list == expected
+
+def test_search_tasks_by_user_id_invalid(empty_db, populate_db):
+    with pytest.raises(InvalidInputException):
+        db.search_tasks_by_user_id(1, " ", empty_db, 10)
+    with pytest.raises(InvalidInputException):
+        db.search_tasks_by_user_id(1, "milk", empty_db, 10, mode="regex")
+    with pytest.raises(InvalidInputException):
+        db.search_tasks_by_user_id(1, "milk", empty_db, 10, cursor="invalid")
+
+def test_get_task_summary_by_user_id(empty_db, populate_db):
+    user_id = db.get_user_by_username("testing_username", empty_db)["id"]
+    now = datetime.datetime(2025, 1, 10)
+    db.insert_task_batch([
+        {"title": "overdue", "due_date": datetime.datetime(2025, 1, 1)},
+        {"title": "due soon", "due_date": datetime.datetime(2025, 1, 12)},
+        {"title": "due later", "due_date": datetime.datetime(2025, 2, 1)},
+        {"title": "no due date"},
+        {"title": "completed overdue", "due_date": datetime.datetime(2025, 1, 1), "is_completed": True},
+    ], user_id, empty_db)
+
+    assert db.get_task_summary_by_user_id(user_id, empty_db, now) == {"total": 5, "open": 4, "completed": 1, "overdue": 1, "due_this_week": 1}
+
+def test_task_changed_hooks(empty_db, populate_db):
+    user_id = db.get_user_by_username("testing_username", empty_db)["id"]
+    changed = []
+    db.task_changed_hooks.append(changed.append)
+    try:
+        task_id = db.insert_task({"title": "Task", "user_id": user_id}, empty_db)
+        db.update_task({"id": task_id, "is_completed": True}, user_id, empty_db)
+        db.delete_task_batch([task_id], user_id, empty_db)
+    finally:
+        db.task_changed_hooks.remove(changed.append)
+
+    assert changed == [user_id, user_id, user_id]
+
+def test_task_import_encoder():
+    encoder = db.TaskImportEncoder("ndjson")
+    data = encoder.feed(b'{"title": "a \\"b\\"", "description": "", "id": 1, "user_id": 2}\n{"title": "c", "due_da')
+    data += encoder.feed(b'te": "2025-01-01T00:00:00", "is_completed": false}')
+    data += encoder.finish()
+    # Empty strings are quoted, unquoted empty fields are NULL for COPY
+    assert data == b'"a ""b""","",,\n"c",,"2025-01-01T00:00:00",f\n'
+
+    encoder = db.TaskImportEncoder("csv")
+    assert encoder.feed(b"title,descr") == b""
+    assert encoder.feed(b"iption,due_date,is_completed\nx,y,,\nz") == b'"x","y",,\n'
+    # Re-encoded, a '\.' line can not end the COPY early. Quoted fields may span lines, offsets become UTC
+    assert encoder.feed(b',"w\n\\.\n""q""",2025-01-01T02:00:00+02:00,TRUE\n\\.,,,\n') == b'"z","w\n\\.\n""q""","2025-01-01T00:00:00",t\n"\\.",,,\n'
+    assert encoder.finish() == b""
+    assert encoder.header == ("title", "description", "due_date", "is_completed")
+    assert encoder.columns == db.TASK_EDITABLE_COLUMNS
+
+    with pytest.raises(InvalidInputException):
+        db.TaskImportEncoder("csv").feed(b"title,owner\n")
+    with pytest.raises(InvalidInputException):
+        db.TaskImportEncoder("ndjson").feed(b'{"title": "a"}\n[]\n')
+    with pytest.raises(InvalidInputException, match="Invalid line 3"):
+        db.TaskImportEncoder("csv").feed(b'title,is_completed\na,t\nb,maybe\n')
+    with pytest.raises(InvalidInputException, match="Invalid line 2: Unterminated"):
+        encoder = db.TaskImportEncoder("csv")
+        encoder.feed(b'title\n"a\n')
+        encoder.finish()
+
+def test_import_export_tasks(empty_db, populate_db):
+    user_id = db.get_user_by_username("testing_username", empty_db)["id"]
+    assert db.import_tasks(user_id, iter([b'{"title": "imported-1"}\n{"title": "imp', b'orted-2", "is_completed": true}\n']), empty_db) == 2
+    assert db.get_task_version(user_id, empty_db) == 1
+
+    exported = b"".join(db.export_tasks(user_id, empty_db, "csv", chunk_size=1, fields=["title", "is_completed"]))
+    assert exported.decode().splitlines()[1:] == [f"{task['id']},{task['title']},{'t' if task['is_completed'] else ''}" for task in db.get_task_list_by_user_id(user_id, empty_db)]
+
+    # Abandoning an export leaves the connection usable
+    chunks = db.export_tasks(user_id, empty_db, chunk_size=1)
+    next(chunks)
+    chunks.close()
+    assert db.get_task_version(user_id, empty_db) == 1
+
+def test_completed_at_set_by_trigger(empty_db, populate_db):
+    user_id = db.get_user_by_username("testing_username", empty_db)["id"]
+    task_id = db.insert_task({"title": "Task", "user_id": user_id, "is_completed": True}, empty_db)
+    completed_at = sa.select(db.task_table.c.completed_at).where(db.task_table.c.id == task_id)
+    assert empty_db.execute(completed_at).scalar() is not None
+
+    db.update_task({"id": task_id, "is_completed": False}, user_id, empty_db)
+    assert empty_db.execute(completed_at).scalar() is None
+
+def test_archive_completed_tasks(empty_db, populate_db):
+    user_id = db.get_user_by_username("testing_username", empty_db)["id"]
+    task_ids = db.insert_task_batch([{"title": f"Task {i}", "is_completed": i < 3} for i in range(4)], user_id, empty_db)
+    version = db.get_task_version(user_id, empty_db)
+
+    now = datetime.datetime.now()
+    assert db.archive_completed_tasks(empty_db, now - datetime.timedelta(days=1)) == 0
+    assert db.archive_completed_tasks(empty_db, now + datetime.timedelta(days=1), batch_size=2) == 2
+    assert db.archive_completed_tasks(empty_db, now + datetime.timedelta(days=1), batch_size=2) == 1
+    assert db.get_task_version(user_id, empty_db) == version + 2
+
+    assert [task["id"] for task in db.get_task_list_by_user_id(user_id, empty_db)] == task_ids[3:]
+    assert [task["id"] for task in db.get_task_list_by_user_id(user_id, empty_db, include_archived=True)] == task_ids
+    assert [task["id"] for task in db.get_task_list_by_user_id(user_id, empty_db, include_archived=True, completed=True, sort="-id")] == task_ids[2::-1]
+    assert db.get_task_by_id(task_ids[0], empty_db) is None
+    assert db.get_task_by_id(task_ids[0], empty_db, include_archived=True)["title"] == "Task 0"
+
+    # Archived tasks are read-only
+    with pytest.raises(InvalidInputException):
+        db.delete_task_by_id(task_ids[0], user_id, empty_db)
+    db.delete_user_by_id(user_id, empty_db)
@@ -0,0 +1,135 @@
+import os
+import json
+import types
+import asyncio
+import threading
+
+import pytest
+import psycopg2
+
+import events
+
+def make_event(user_id, version, index=0, count=1, task_id=1, event_type="created"):
+    return {"user_id": user_id, "version": version, "index": index, "count": count, "type": event_type, "id": task_id}
+
+@pytest.fixture
+def hub():
+    hub = events.TaskEventHub(connects=[], buffer_size=5, max_queue=2, max_subscribers=2)
+    # No listener thread, events are published directly
+    hub._ensure_started = lambda: None
+    return hub
+
+def test_format_event():
+    assert events.format_event(make_event(1, 3, 0, 2)) == b'event: created\ndata: {"id": 1, "version": 3}\n\n'
+    assert events.format_event(make_event(1, 3, 1, 2)) == b'id: 3\nevent: created\ndata: {"id": 1, "version": 3}\n\n'
+    assert events.format_event(events.RESYNC) == b"event: resync\n\n"
+
+def test_parse_event_id():
+    assert events.parse_event_id("12") == 12
+    assert events.parse_event_id("abc") is None
+    assert events.parse_event_id(None) is None
+
+def test_publish_to_user_subscriptions(hub):
+    subscription = hub.subscribe(1)
+    other = hub.subscribe(2)
+    hub.publish(make_event(1, 1))
+
+    assert subscription.get(0)["version"] == 1
+    assert other.get(0) is None
+
+def test_subscriber_limit(hub):
+    hub.subscribe(1)
+    subscription = hub.subscribe(1)
+    with pytest.raises(events.ServiceUnavailableException):
+        hub.subscribe(2)
+
+    hub.unsubscribe(subscription)
+    hub.subscribe(2)
+
+def test_replay(hub):
+    hub.publish(make_event(1, 1))
+    hub.publish(make_event(1, 2, 0, 2, task_id=2))
+    hub.publish(make_event(2, 1))
+    hub.publish(make_event(1, 2, 1, 2, task_id=3))
+
+    assert [event["id"] for event in hub.replay(1, 1, 2)] == [2, 3]
+    assert hub.replay(1, 2, 2) == []
+    # Version 3 is missing from the buffer
+    assert hub.replay(1, 1, 3) is None
+    # Reset databases or ids from elsewhere
+    assert hub.replay(1, 5, 2) is None
+
+def test_replay_buffer_overrun(hub):
+    for version in range(1, 8):
+        hub.publish(make_event(1, version))
+
+    assert hub.replay(1, 1, 7) is None
+    assert [event["version"] for event in hub.replay(1, 2, 7)] == [3, 4, 5, 6, 7]
+
+def test_event_stream_skips_replayed_events(hub):
+    subscription = hub.subscribe(1)
+    hub.publish(make_event(1, 2))
+    hub.publish(make_event(1, 3))
+    event_stream = events.EventStream(subscription, hub.replay(1, 1, 2), 1)
+
+    assert len(event_stream.start()) == 2
+    assert event_stream.handle(subscription.get(0)) is None
+    assert event_stream.handle(subscription.get(0)).startswith(b"id: 3\n")
+    assert event_stream.handle(None) == b": keepalive\n\n"
+
+def test_event_stream_overflow(hub):
+    subscription = hub.subscribe(1)
+    for version in range(1, 5):
+        hub.publish(make_event(1, version))
+
+    event_stream = events.EventStream(subscription, [], None)
+    assert event_stream.handle(subscription.get(0)) == b"event: resync\n\n"
+
+def test_async_subscription(hub):
+    async def receive():
+        subscription = hub.subscribe(1, asyncio.get_running_loop())
+        await asyncio.to_thread(hub.publish, make_event(1, 1))
+        return await subscription.get_async(1)
+
+    assert asyncio.run(receive())["version"] == 1
+
+class FakeListenConnection:
+    # Always readable, every poll() receives the next payload until the connection "drops"
+    def __init__(self, payloads):
+        self.payloads = list(payloads)
+        self.notifies = []
+        self.read_fd, self.write_fd = os.pipe()
+        os.write(self.write_fd, b"x")
+
+    def fileno(self):
+        return self.read_fd
+
+    def set_session(self, autocommit):
+        pass
+
+    def cursor(self):
+        return self
+
+    def execute(self, statement):
+        pass
+
+    def poll(self):
+        if not self.payloads: raise psycopg2.OperationalError("connection closed")
+        self.notifies.append(types.SimpleNamespace(payload=self.payloads.pop(0)))
+
+    def close(self):
+        os.close(self.read_fd)
+        os.close(self.write_fd)
+
+def test_listener_survives_malformed_payload(caplog):
+    connections = [FakeListenConnection(["not json"]), FakeListenConnection([json.dumps(make_event(1, 1))])]
+    def connect():
+        if connections: return connections.pop(0)
+        threading.Event().wait()
+
+    hub = events.TaskEventHub(connects=[connect])
+    subscription = hub.subscribe(1)
+    # The listener logs the error and reconnects, which resyncs the subscribers
+    assert subscription.get(5) == events.RESYNC
+    assert subscription.get(5)["version"] == 1
+    assert "Task events listener failed" in caplog.text
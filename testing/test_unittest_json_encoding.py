@@ -0,0 +1,20 @@
+import datetime
+import json
+
+import json_encoding
+import db
+
+def test_dumps_http_datetime(monkeypatch):
+    monkeypatch.setattr(json_encoding, "JSON_DATETIME_FORMAT", "http")
+    assert json.loads(json_encoding.dumps_bytes({"due_date": datetime.datetime(2025, 1, 1)}))["due_date"] == "Wed, 01 Jan 2025 00:00:00 GMT"
+
+def test_dumps_iso_datetime(monkeypatch):
+    monkeypatch.setattr(json_encoding, "JSON_DATETIME_FORMAT", "iso")
+    monkeypatch.setattr(json_encoding, "ORJSON_OPTIONS", 0)
+    assert json.loads(json_encoding.dumps_bytes({"due_date": datetime.datetime(2025, 1, 1)}))["due_date"] == "2025-01-01T00:00:00"
+
+def test_task_rows_to_dicts():
+    rows = [(1, 2, "title", None, datetime.datetime(2025, 1, 1), True)]
+    tasks = db.task_rows_to_dicts(rows)
+    assert tasks == [{"id": 1, "user_id": 2, "title": "title", "description": None, "due_date": datetime.datetime(2025, 1, 1), "is_completed": True}]
+    assert json.loads(json_encoding.dumps_bytes(tasks))[0]["title"] == "title"
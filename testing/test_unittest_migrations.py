@@ -0,0 +1,53 @@
+import sqlalchemy as sa
+from dotenv import load_dotenv
+import os
+
+import pytest
+
+import db
+import migrations
+
+if not load_dotenv(".env.testing"):
+    print("ERROR LOADING ENVIRONMENT!")
+
+@pytest.fixture
+def engine():
+    engine = db.create_db_engine(os.environ.get("POSTGRES_HOST"), os.environ.get("POSTGRES_PORT"), os.environ.get("POSTGRES_USER"), os.environ.get("POSTGRES_PASSWORD"), os.environ.get("POSTGRES_DB"))
+    try:
+        with engine.begin() as connection:
+            connection.execute(sa.text("DROP TABLE IF EXISTS schema_migrations"))
+    except sa.exc.OperationalError:
+        pytest.exit(f"Check if Postgres is running. The test expects a Postgres instance to run on port '{os.environ.get('POSTGRES_PORT')}'.\nThis can be run from Docker with 'docker-compose --profile testing up -d testing_postgres'", returncode=1)
+    db.metadata.drop_all(engine)
+    yield engine
+    engine.dispose()
+
+def test_migrate_empty_database_matches_metadata(engine):
+    applied = migrations.migrate(engine)
+    assert applied == [version for version, _, _ in migrations.MIGRATIONS]
+
+    inspector = sa.inspect(engine)
+    for table in db.metadata.sorted_tables:
+        assert {column["name"] for column in inspector.get_columns(table.name)} == set(table.columns.keys())
+        assert {index["name"] for index in inspector.get_indexes(table.name)} >= {index.name for index in table.indexes}
+
+def test_migrate_is_idempotent(engine):
+    migrations.migrate(engine)
+    assert migrations.migrate(engine) == []
+    assert migrations.get_schema_version(engine) == migrations.MIGRATIONS[-1][0]
+
+def test_migrate_target(engine):
+    assert migrations.migrate(engine, target=1) == [1]
+    assert migrations.get_schema_version(engine) == 1
+
+def test_migrate_keeps_existing_data(engine):
+    # Databases created by the old drop/create startup have the tables but no schema_migrations
+    db.metadata.create_all(engine)
+    with engine.begin() as connection:
+        connection.execute(db.user_table.insert().values(username="existing-user", password_hash="hash"))
+
+    assert migrations.get_schema_version(engine) == 0
+    migrations.migrate(engine)
+
+    with engine.connect() as connection:
+        assert db.get_user_by_username("existing-user", connection)["username"] == "existing-user"
@@ -0,0 +1,132 @@
+import time
+import threading
+
+import pytest
+
+import db
+import profiling
+from ServiceUnavailableException import ServiceUnavailableException
+
+@pytest.fixture
+def profile():
+    profile = profiling.RequestProfile(max_queries=2)
+    token = profiling.current_profile.set(profile)
+    yield profile
+    profiling.current_profile.reset(token)
+
+def test_phase_without_profile_is_noop():
+    with profiling.phase("auth"):
+        pass
+    assert profiling.current_profile.get() is None
+
+def test_phases_and_query_functions_are_recorded(profile):
+    @db.query_function
+    def get_something():
+        with profiling.phase("inner"):
+            time.sleep(0.01)
+
+    with profiling.phase("auth"):
+        get_something()
+
+    assert [name for name, _, _ in profile.phases] == ["inner", "db.get_something", "auth"]
+    totals = profile.totals()
+    assert totals["auth"][0] == 1 and totals["auth"][1] >= totals["db.get_something"][1] >= 0.01
+
+def test_queries_are_bounded(profile):
+    for i in range(3):
+        profile.add_query("get_task_by_id", "SELECT 1", {"id": i}, 0.001, None)
+
+    report = profile.report(0.5, route="/tasks")
+    assert report["route"] == "/tasks" and report["duration_ms"] == 500
+    assert len(report["queries"]) == 2 and report["dropped_queries"] == 1
+
+def test_parameters_redacted(profile, monkeypatch):
+    profile.add_query("insert_user", "INSERT ...", {"username": "alice", "password_hash": "$2b$12$secret"}, 0.001, None)
+    assert "parameters" not in profile.report(0.5)["queries"][0]
+
+    monkeypatch.setattr(profiling, "PROFILING_LOG_PARAMETERS", True)
+    parameters = profile.report(0.5)["queries"][0]["parameters"]
+    assert "alice" in parameters and "$2b$12$secret" not in parameters
+    assert profiling.loggable_parameters(("$2b$12$secret",)) == {"parameters": "<redacted>"}
+
+def test_explain_skips_writes():
+    assert profiling.explain({"engine": None, "statement": "SELECT 1", "parameters": {}}) is None
+    assert profiling.explain({"engine": object(), "statement": "DELETE FROM \"Task\"", "parameters": {}}) is None
+
+def test_explain_queue_bounded(monkeypatch):
+    started, release, explained = threading.Event(), threading.Event(), []
+    def blocking_log(profile, record, with_explain):
+        started.set()
+        release.wait(5)
+        explained.append(record)
+    monkeypatch.setattr(profiling, "log_slow_request", blocking_log)
+
+    explain_queue = profiling.ExplainQueue(max_size=1, interval=0)
+    assert explain_queue.submit(None, {"request": 1})
+    assert started.wait(5)
+    # One request is explained at a time, one waits, further ones are dropped
+    assert explain_queue.submit(None, {"request": 2})
+    assert not explain_queue.submit(None, {"request": 3})
+    assert explain_queue.dropped == 1
+    release.set()
+    for _ in range(100):
+        if len(explained) == 2: break
+        time.sleep(0.01)
+    assert explained == [{"request": 1}, {"request": 2}]
+
+def test_explain_queue_interval():
+    now = [100.0]
+    explain_queue = profiling.ExplainQueue(max_size=10, interval=10, clock=lambda: now[0])
+    # Jobs are only queued, nothing takes them
+    explain_queue._pid = profiling.os.getpid()
+    explain_queue._jobs = profiling.queue.Queue(10)
+    assert explain_queue.submit(None, {})
+    now[0] += 5
+    assert not explain_queue.submit(None, {})
+    now[0] += 5
+    assert explain_queue.submit(None, {})
+
+def test_admin_authorized(monkeypatch):
+    monkeypatch.setattr(profiling, "PROFILING_ADMIN_TOKEN", "")
+    assert not profiling.admin_authorized("")
+    monkeypatch.setattr(profiling, "PROFILING_ADMIN_TOKEN", "secret")
+    assert profiling.admin_authorized("secret")
+    assert not profiling.admin_authorized("wrong") and not profiling.admin_authorized(None)
+
+def busy_function(stop):
+    while not stop.is_set():
+        sum(range(1000))
+
+def test_sample_stacks_collapsed_output():
+    stop = threading.Event()
+    thread = threading.Thread(target=busy_function, args=(stop,), name="busy-thread")
+    thread.start()
+    try:
+        output = profiling.sample_stacks(0.1, 0.005)
+    finally:
+        stop.set()
+        thread.join()
+
+    lines = [line.rsplit(" ", 1) for line in output.splitlines()]
+    assert all(count.isdigit() for _, count in lines)
+    busy = [stack for stack, _ in lines if stack.startswith("busy-thread;")]
+    assert busy and "busy_function (test_unittest_profiling.py:" in busy[0]
+
+def test_start_profile_samples_in_background():
+    start = time.monotonic()
+    stacks = profiling.start_profile(0.2, 0.01)
+    # Returns right away, the caller's own (waiting) thread is not sampled
+    assert time.monotonic() - start < 0.1
+    output = "".join(stacks)
+    assert "test_start_profile_samples_in_background" not in output
+    assert "profiling-sampler" not in output
+
+def test_sample_stacks_one_at_a_time():
+    thread = threading.Thread(target=profiling.sample_stacks, args=(0.2,))
+    thread.start()
+    time.sleep(0.05)
+    try:
+        with pytest.raises(ServiceUnavailableException):
+            profiling.sample_stacks(0.01)
+    finally:
+        thread.join()
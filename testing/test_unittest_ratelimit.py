@@ -0,0 +1,62 @@
+import pytest
+
+import ratelimit
+from ratelimit import TokenBucketStore, RateLimiter
+from TooManyRequestsException import TooManyRequestsException
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0
+
+    def __call__(self):
+        return self.now
+
+@pytest.fixture
+def clock():
+    yield FakeClock()
+
+def test_parse_budget():
+    assert ratelimit.parse_budget("20/60") == (20, 20 / 60)
+    assert ratelimit.parse_budget("5") == (5, 5)
+    assert ratelimit.parse_budget("0") is None
+    with pytest.raises(ValueError):
+        ratelimit.parse_budget("10/0")
+
+def test_bucket_allows_burst_then_refills(clock):
+    store = TokenBucketStore(clock=clock)
+    assert [store.take("key", 3, 1) for _ in range(3)] == [0, 0, 0]
+    assert store.take("key", 3, 1) == 1
+
+    clock.now = 0.5
+    assert store.take("key", 3, 1) == 0.5
+    clock.now = 1
+    assert store.take("key", 3, 1) == 0
+    # Idle time refills up to the capacity only
+    clock.now = 100
+    assert [store.take("key", 3, 1) for _ in range(4)] == [0, 0, 0, 1]
+
+def test_bucket_store_evicts_least_recently_used(clock):
+    store = TokenBucketStore(maxsize=2, clock=clock)
+    store.take("a", 1, 1)
+    store.take("b", 1, 1)
+    store.take("a", 1, 1)
+    store.take("c", 1, 1)
+    assert store.stats()["buckets"] == 2
+    assert store.take("b", 1, 1) == 0
+
+def test_rate_limiter_budgets(clock):
+    limiter = RateLimiter(TokenBucketStore(clock=clock), {"user": (1, 0.5), "auth": None})
+    limiter.check("user", 1)
+    limiter.check("user", 2)
+    with pytest.raises(TooManyRequestsException) as e:
+        limiter.check("user", 1)
+    assert e.value.retry_after == 2
+
+    for _ in range(10):
+        limiter.check("auth", "127.0.0.1")
+
+def test_client_address(monkeypatch):
+    assert ratelimit.client_address("10.0.0.1", "1.2.3.4") == "10.0.0.1"
+    monkeypatch.setattr(ratelimit, "RATE_LIMIT_TRUSTED_PROXIES", 1)
+    assert ratelimit.client_address("10.0.0.1", "6.6.6.6, 1.2.3.4") == "1.2.3.4"
+    assert ratelimit.client_address("10.0.0.1", None) == "10.0.0.1"
@@ -0,0 +1,96 @@
+import os
+import time
+
+import sqlalchemy as sa
+from dotenv import load_dotenv
+
+import pytest
+
+import db
+import cache
+import replicas
+
+if not load_dotenv(".env.testing"):
+    print("ERROR LOADING ENVIRONMENT!")
+
+# The routing tests against a real replica run when POSTGRES_REPLICAS points to a streaming replica of the
+# testing database, e.g. 'docker-compose --profile testing-replica up -d' and POSTGRES_REPLICAS=localhost:5434
+REPLICA_HOSTS = replicas.parse_replica_hosts(os.environ.get("POSTGRES_REPLICAS"))
+
+def create_engine(host=None, port=None):
+    return db.create_db_engine(host or os.environ.get("POSTGRES_HOST"), port or os.environ.get("POSTGRES_PORT"), os.environ.get("POSTGRES_USER"), os.environ.get("POSTGRES_PASSWORD"), os.environ.get("POSTGRES_DB"))
+
+@pytest.fixture
+def router(monkeypatch):
+    # Health checks are run by the tests instead of the background thread
+    monkeypatch.setattr(replicas.ReplicaRouter, "_ensure_started", lambda self: None)
+    engines = [create_engine()] + [create_engine(host, port) for host, port in REPLICA_HOSTS]
+    router = replicas.ReplicaRouter(engines[0], engines[1:], cache.TTLCache(ttl=60))
+    for index, engine in enumerate(router.replicas):
+        router.watch(index, engine)
+    yield router
+    for engine in engines:
+        engine.dispose()
+
+def test_parse_lsn():
+    assert replicas.parse_lsn("0/0") == 0
+    assert replicas.parse_lsn("16/B374D848") == (0x16 << 32) + 0xB374D848
+
+def test_parse_replica_hosts():
+    assert replicas.parse_replica_hosts(None) == []
+    assert replicas.parse_replica_hosts("replica-1:5432, replica-2") == [("replica-1", "5432"), ("replica-2", "5432")]
+
+def test_reads_go_to_primary_without_replicas(router):
+    if REPLICA_HOSTS: router.replicas = []
+    assert router.read_replica(1) is None
+    assert router.read_engine(1) is router.primary
+
+def test_unreachable_replica_out_of_rotation(router):
+    router.replicas = [create_engine("localhost", 1)]
+    router._replay_lsns = [0]
+    router.check()
+    assert router.read_replica() is None
+    assert router.stats() == {"replicas": 1, "healthy": 0}
+    router.replicas[0].dispose()
+
+def test_pinned_user_waits_for_replay(router):
+    router.replicas = [router.primary, router.primary]
+    router._replay_lsns = [replicas.parse_lsn("0/100"), replicas.parse_lsn("0/200")]
+    assert {router.read_replica(1) for _ in range(4)} == {0, 1}
+
+    router.pin(1, "0/180")
+    assert {router.read_replica(1) for _ in range(4)} == {1}
+    router.pin(1, "0/300")
+    assert router.read_replica(1) is None
+    # Other users are not pinned
+    assert router.read_replica(2) is not None
+
+@pytest.mark.skipif(not REPLICA_HOSTS, reason="POSTGRES_REPLICAS is not set")
+def test_read_your_writes_on_replica(router):
+    router.check()
+    assert router.read_replica() == 0
+
+    with router.primary.connect() as connection:
+        user_id = db.insert_user(f"replica-user-{time.time()}", "hash", connection)
+        connection.commit()
+        router.record_write(user_id, connection)
+
+    # Pinned to the primary until the replica has replayed the write
+    deadline = time.monotonic() + 10
+    while router.read_replica(user_id) is None and time.monotonic() < deadline:
+        time.sleep(0.05)
+        router.check()
+
+    with router.read_engine(user_id).connect() as connection:
+        assert router.read_engine(user_id) is router.replicas[0]
+        assert db.get_user_by_id(user_id, connection) is not None
+
+@pytest.mark.skipif(not REPLICA_HOSTS, reason="POSTGRES_REPLICAS is not set")
+def test_failed_replica_query_leaves_rotation(router):
+    router.check()
+    assert router.read_replica() == 0
+
+    with router.replicas[0].connect() as connection:
+        with pytest.raises(sa.exc.OperationalError):
+            connection.execute(sa.text("SELECT pg_terminate_backend(pg_backend_pid())"))
+    assert router.read_replica() is None
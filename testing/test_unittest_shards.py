@@ -0,0 +1,99 @@
+import os
+import datetime
+
+import sqlalchemy as sa
+from dotenv import load_dotenv
+
+import pytest
+
+import db
+import cache
+import shards
+from InvalidInputException import InvalidInputException
+
+if not load_dotenv(".env.testing"):
+    print("ERROR LOADING ENVIRONMENT!")
+
+# The tests moving users between databases run when POSTGRES_SHARDS lists further testing databases, e.g.
+# 'docker-compose --profile testing up -d testing_postgres' and POSTGRES_SHARDS=localhost:5433/citizix_db_shard1
+SHARD_DSNS = shards.parse_shard_dsns(os.environ.get("POSTGRES_SHARDS"), os.environ.get("POSTGRES_DB"))
+
+def create_engine(host=None, port=None, dbname=None):
+    return db.create_db_engine(host or os.environ.get("POSTGRES_HOST"), port or os.environ.get("POSTGRES_PORT"), os.environ.get("POSTGRES_USER"), os.environ.get("POSTGRES_PASSWORD"), dbname or os.environ.get("POSTGRES_DB"))
+
+@pytest.fixture
+def shard_map():
+    engines = [create_engine()] + [create_engine(*dsn) for dsn in SHARD_DSNS]
+    try:
+        for engine in engines:
+            db.recreate_test_schema(engine)
+    except sa.exc.OperationalError:
+        pytest.exit(f"Check if Postgres is running. The test expects a Postgres instance to run on port '{os.environ.get('POSTGRES_PORT')}'.\nThis can be run from Docker with 'docker-compose --profile testing up -d testing_postgres'", returncode=1)
+    shard_map = shards.ShardMap(engines, cache.TTLCache(ttl=60))
+    if shard_map.sharded: shard_map.configure_id_ranges()
+    yield shard_map
+    for engine in engines:
+        engine.dispose()
+
+def register(shard_map, username, shard):
+    with shard_map.engines[shard].begin() as connection:
+        user_id = db.insert_user(username, "hash", connection)
+    with shard_map.engines[0].begin() as connection:
+        db.insert_user_directory_entry(user_id, username, shard, connection)
+    return user_id
+
+def test_parse_shard_dsns():
+    assert shards.parse_shard_dsns(None) == []
+    assert shards.parse_shard_dsns("shard-1:5433/tasks_1, shard-2", "tasks") == [("shard-1", "5433", "tasks_1"), ("shard-2", "5432", "tasks")]
+
+def test_place_spreads_users():
+    shard_map = shards.ShardMap([None] * 4, cache.TTLCache())
+    placements = [shard_map.place(f"user-{i}") for i in range(1000)]
+    assert placements == [shard_map.place(f"user-{i}") for i in range(1000)]
+    assert all(200 < placements.count(shard) < 300 for shard in range(4))
+
+def test_single_database_routes_to_shard_0(shard_map):
+    shard_map = shards.ShardMap(shard_map.engines[:1], cache.TTLCache())
+    user_id = register(shard_map, "directory-user", 0)
+    assert shard_map.shard_of(user_id) == 0
+    with shard_map.engines[0].connect() as connection:
+        assert db.get_user_directory_entry("directory-user", connection) == {"user_id": user_id, "shard": 0}
+
+@pytest.mark.skipif(not SHARD_DSNS, reason="POSTGRES_SHARDS is not set")
+def test_ids_unique_across_shards(shard_map):
+    user_ids = [register(shard_map, f"range-user-{shard}", shard) for shard in range(len(shard_map.engines))]
+    for shard, user_id in enumerate(user_ids):
+        low, high = shard_map.id_bounds(shard)
+        assert low <= user_id <= high
+        assert shard_map.shard_of(user_id) == shard
+
+    # Configuring again leaves the sequences where they are
+    shard_map.configure_id_ranges()
+    assert register(shard_map, "range-user-again", 0) == user_ids[0] + 1
+    with shard_map.engines[0].connect() as connection:
+        assert db.get_user_counts_by_shard(connection) == {shard: 2 if shard == 0 else 1 for shard in range(len(shard_map.engines))}
+
+@pytest.mark.skipif(not SHARD_DSNS, reason="POSTGRES_SHARDS is not set")
+def test_move_user(shard_map):
+    user_id = register(shard_map, "moving-user", 0)
+    with shard_map.engines[0].begin() as connection:
+        task_ids = db.insert_task_batch([{"title": "Open"}, {"title": "Done", "is_completed": True}], user_id, connection)
+        assert db.archive_completed_tasks(connection, datetime.datetime.now() + datetime.timedelta(days=1)) == 1
+        before = db.get_task_list_by_user_id(user_id, connection, include_archived=True)
+        task_version = db.get_task_version(user_id, connection)
+    assert shard_map.shard_of(user_id) == 0
+
+    assert shard_map.move_user(user_id, 1, drain_seconds=0) == 2
+    assert shard_map.shard_of(user_id) == 1
+    with shard_map.engines[1].connect() as connection:
+        assert db.get_task_list_by_user_id(user_id, connection, include_archived=True) == before
+        assert db.get_task_version(user_id, connection) == task_version
+        # Moved users keep drawing new task ids from the range of their new shard
+        assert db.insert_task({"title": "New", "user_id": user_id}, connection) >= shard_map.id_bounds(1)[0]
+    with shard_map.engines[0].connect() as connection:
+        assert db.get_user_by_id(user_id, connection) is None
+        assert db.get_task_by_id(task_ids[1], connection, include_archived=True) is None
+
+    assert shard_map.move_user(user_id, 1) == 0
+    with pytest.raises(InvalidInputException):
+        shard_map.move_user(user_id, len(shard_map.engines))